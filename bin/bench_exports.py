@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+import argparse
+import sys
+import time
+import urllib.parse
+
+import psycopg2
+
+sys.path.append(".")
+
+import nels_galaxy_api.db as nels_galaxy_db
+
+# Compares the old (fetch every archive, keep the newest pr history in python) and the new
+# (DISTINCT ON in sql) way of finding the latest export/import pr history, on a synthetic
+# set of galaxy tables created in their own schema. Needs a postgres database it can create a schema in.
+
+schema = 'nga_bench'
+
+
+def create_fixture(url: str, users: int, histories: int, archives: int) -> None:
+    conn = psycopg2.connect(nels_galaxy_db.libpq_url(url))
+    conn.autocommit = True
+    cursor = conn.cursor()
+
+    cursor.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+    cursor.execute(f"CREATE SCHEMA {schema}")
+    cursor.execute(f"SET search_path TO {schema}")
+
+    cursor.execute("CREATE TABLE galaxy_user (id SERIAL PRIMARY KEY, email VARCHAR(255))")
+    cursor.execute("CREATE TABLE history (id SERIAL PRIMARY KEY, user_id INT, name TEXT)")
+    cursor.execute("CREATE TABLE job (id SERIAL PRIMARY KEY, create_time TIMESTAMP, state VARCHAR(64))")
+    cursor.execute("CREATE TABLE job_export_history_archive (id SERIAL PRIMARY KEY, job_id INT, history_id INT, dataset_id INT)")
+    cursor.execute("CREATE TABLE job_import_history_archive (id SERIAL PRIMARY KEY, job_id INT, history_id INT)")
+
+    cursor.execute("INSERT INTO galaxy_user (email) SELECT 'user' || g || '@example.org' FROM generate_series(1, %s) g", [users])
+    cursor.execute("INSERT INTO history (user_id, name) SELECT 1 + g %% %s, 'history ' || g FROM generate_series(1, %s) g",
+                   [users, histories])
+    # two archives per job id, some sharing create_time to exercise the tie-breaking
+    cursor.execute('''INSERT INTO job (create_time, state)
+                      SELECT now() - ((g / 2) || ' minutes')::interval, (array['ok', 'error', 'running', 'new'])[1 + g %% 4]
+                      FROM generate_series(1, %s) g''', [2 * archives])
+    cursor.execute('''INSERT INTO job_export_history_archive (job_id, history_id, dataset_id)
+                      SELECT g, 1 + (g::bigint * 7919) %% %s, g FROM generate_series(1, %s) g''', [histories, archives])
+    cursor.execute('''INSERT INTO job_import_history_archive (job_id, history_id)
+                      SELECT %s + g, 1 + (g::bigint * 104729) %% %s FROM generate_series(1, %s) g''',
+                   [archives, histories, archives])
+    cursor.execute("ANALYZE")
+    conn.close()
+
+
+def latest_pr_history(entries: []) -> []:
+    # the way db.py used to do it
+    cleaned = {}
+
+    for entry in entries:
+        if entry['history_id'] not in cleaned:
+            cleaned[entry['history_id']] = entry
+
+        elif cleaned[entry['history_id']]['create_time'] < entry['create_time']:
+            cleaned[entry['history_id']] = entry
+
+    return list(cleaned.values())
+
+
+def as_set(entries: []) -> set:
+    return set(tuple(sorted(entry.items())) for entry in entries)
+
+
+def timed(func, repeats: int):
+    best = None
+    res = None
+    for _ in range(repeats):
+        start = time.time()
+        res = func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best, res
+
+
+def main():
+    parser = argparse.ArgumentParser(description='bench_exports: old vs new latest export/import pr history lookups')
+
+    parser.add_argument('-d', '--db-url', required=True, help="postgres url to create the benchmark schema in")
+    parser.add_argument('-u', '--users', default=1000, type=int, help="number of users")
+    parser.add_argument('-H', '--histories', default=20000, type=int, help="number of histories")
+    parser.add_argument('-a', '--archives', default=200000, type=int, help="number of export and import archives")
+    parser.add_argument('-r', '--repeats', default=3, type=int, help="best of n runs")
+    parser.add_argument('-k', '--keep', default=False, action='store_true', help="keep the benchmark schema")
+
+    args = parser.parse_args()
+
+    create_fixture(args.db_url, args.users, args.histories, args.archives)
+
+    # all queries from the DB object goes into the benchmark schema
+    db_url = args.db_url
+    db_url += '&' if '?' in db_url else '?'
+    db_url += "options=" + urllib.parse.quote(f"-c search_path={schema}")
+
+    db = nels_galaxy_db.DB()
+    db.connect(db_url)
+
+    failed = False
+    for name, all_func, latest_func in [('exports', db.get_all_exports, db.get_exports),
+                                        ('imports', db.get_all_imports, db.get_imports)]:
+        for state in ['', 'ok']:
+            old_time, old = timed(lambda: [e for e in latest_pr_history(all_func())
+                                           if state == '' or e['state'] == state], args.repeats)
+            new_time, new = timed(lambda: latest_func(state=state), args.repeats)
+
+            same = as_set(old) == as_set(new)
+            failed = failed or not same
+            print(f"{name:8} state={state or 'any':4} rows={len(new):7} old={old_time * 1000:9.1f}ms "
+                  f"new={new_time * 1000:9.1f}ms speedup={old_time / new_time:6.1f}x identical={same}")
+
+        # paging through the results should give the same rows as one go
+        pages = []
+        after_id = 0
+        while True:
+            page = latest_func(after_id=after_id, limit=1000)
+            if not page:
+                break
+            pages += page
+            after_id = page[-1]['history_id']
+
+        same = as_set(pages) == as_set(latest_func())
+        failed = failed or not same
+        print(f"{name:8} paged rows={len(pages):7} identical={same}")
+
+    db.disconnect()
+
+    if not args.keep:
+        conn = psycopg2.connect(nels_galaxy_db.libpq_url(args.db_url))
+        conn.autocommit = True
+        conn.cursor().execute(f"DROP SCHEMA {schema} CASCADE")
+        conn.close()
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+import argparse
+import codecs
+import random
+import sys
+import timeit
+
+from Crypto.Cipher import Blowfish
+
+sys.path.append(".")
+
+import nels_galaxy_api.utils as utils
+
+# Micro-benchmark of the id encryption used when serialising result sets: the old one value
+# at a time path against the memoised and batched ones. Checks that all give the same ids.
+
+
+def old_encrypt_value(cipher, value: str) -> str:
+    value = str(value).encode('utf-8')
+    s = (b"!" * (8 - len(value) % 8)) + value
+    return codecs.encode(cipher.encrypt(s), 'hex').decode("utf-8")
+
+
+def old_list_encrypt_ids(cipher, entries: []) -> []:
+    for entry in entries:
+        for key in entry.keys():
+            if key == 'nels_id':
+                continue
+
+            if key == 'id' or key.find('_id') > -1 and isinstance(entry[key], int):
+                entry[key] = old_encrypt_value(cipher, entry[key])
+
+    return entries
+
+
+def make_rows(rows: int, users: int) -> []:
+    # looks like the /history/exports/all rows, few users and many histories
+    return [{'export_id': i, 'dataset_id': i * 3, 'history_id': random.randint(1, rows // 2),
+             'history_name': f"history {i}", 'user_id': random.randint(1, users), 'state': 'ok'}
+            for i in range(rows)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='bench_ids: id encryption of result sets')
+
+    parser.add_argument('-r', '--rows', default=100000, type=int, help="rows in the result set")
+    parser.add_argument('-u', '--users', default=1000, type=int, help="distinct users in the result set")
+    parser.add_argument('-n', '--number', default=5, type=int, help="runs to time")
+
+    args = parser.parse_args()
+
+    secret = "USING THE DEFAULT IS NOT SECURE!"
+    utils.init(secret)
+    cipher = Blowfish.new(secret.encode('utf-8'), mode=Blowfish.MODE_ECB)
+
+    rows = make_rows(args.rows, args.users)
+
+    def copy():
+        return [dict(row) for row in rows]
+
+    old = old_list_encrypt_ids(cipher, copy())
+    new = utils.list_encrypt_ids(copy())
+    if old != new:
+        print("Batched ids differ from the single value ones!")
+        sys.exit(1)
+
+    values = [row['history_id'] for row in rows]
+
+    timings = [('old list_encrypt_ids', lambda: old_list_encrypt_ids(cipher, copy())),
+               ('new list_encrypt_ids', lambda: utils.list_encrypt_ids(copy())),
+               ('copy of the rows only', copy),
+               ('old encrypt_value', lambda: [old_encrypt_value(cipher, v) for v in values]),
+               ('memoised encrypt_value', lambda: [utils.encrypt_value(v) for v in values]),
+               ('batched encrypt_values', lambda: utils.encrypt_values(values))]
+
+    for name, func in timings:
+        best = min(timeit.repeat(func, number=1, repeat=args.number))
+        print(f"{name:25} {best * 1000:9.1f} ms")
+
+    print(utils.id_cache_stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,14 @@
 #!/usr/bin/env python3
 
 import argparse
+import functools
 import sys
 import os
 import time
 import json
 
 import pika
-from tornado import iostream
+from tornado.ioloop import IOLoop, PeriodicCallback
 
 sys.path.append(".")
 
@@ -21,9 +22,11 @@ import kbr.mq_utils as mq_utils
 
 import nels_galaxy_api.tornado as tornado
 import nels_galaxy_api.db as nels_galaxy_db
+import nels_galaxy_api.queries as queries
 import nels_galaxy_api.utils as utils
 import nels_galaxy_api.states as states
 import nels_galaxy_api.api_requests as api_requests
+import nels_galaxy_api.cache as cache
 import warnings
 
 warnings.simplefilter("ignore")
@@ -31,7 +34,7 @@ warnings.simplefilter("ignore")
 version = version_utils.as_string()
 DEV = False
 
-db = nels_galaxy_db.DB()
+db = nels_galaxy_db.AsyncDB()
 galaxy_file_path = None
 
 galaxy_url = None
@@ -48,22 +51,99 @@ tos_grace_period = None
 no_proxy = False  # The NGA-master does not need to use the proxy connections.
 mq = mq_utils.Mq()
 
+# session-key -> {'user': .., 'tos': ..}, saves the session/user/tos lookups on every page load. An
+# entry is only used while galaxy still has the session as valid, see GalaxyHandler.cached_session
+session_cache = cache.TTLCache(size=10000, ttl=60)
+# seconds a cached session is trusted before asking galaxy again if it is still valid, and how many
+# times it has been asked
+session_valid_interval = 5
+session_valid_checks = 0
+
+# most export/history ids that can be asked for in one /history/exports/status/ request
+max_status_ids = 1000
+
+# archives of a bulk export that galaxy builds at the same time, the rest wait their turn
+bulk_archive_jobs = 4
+# seconds between the checks for bulk exports with trackings waiting and room to release them
+bulk_release_interval = 60
+
+# server processes, with more than one each has its own session cache
+processes = 1
+
 # Main server functionality exposing nga endpoints, defining handlers for them too.
 # It reuses tornado.py and others
 
 class GalaxyHandler(tornado.BaseHandler):
     # Class with some nga useful functionality to make them available for nga endpoint handlers
 
-    def get_tos(self):
+    async def cached_session(self, session_key: str) -> {}:
+        # the cached entry of the session, as long as galaxy has not logged it out. A logout in galaxy
+        # does not go through here to invalidate the cache, so it is checked again every
+        # session_valid_interval seconds, a logged out session can be used for that long
+        global session_valid_checks
+        entry = session_cache.get(session_key, None)
+        if entry is None:
+            return {}
+
+        if entry.get('checked', 0) + session_valid_interval < time.monotonic():
+            session_valid_checks += 1
+            if not await db.get_session_valid(session_key):
+                session_cache.delete(session_key)
+                return {}
+            entry['checked'] = time.monotonic()
+
+        return entry
+
+    async def get_tos(self):
         session_key = self.get_session_key()
 
-        user_tos = db.get_user_tos(session_key)
+        entry = await self.cached_session(session_key)
+        if 'tos' in entry:
+            return dict(entry['tos'])
+
+        user_tos = await db.get_user_tos(session_key)
         if user_tos is None:
+            session_cache.delete(session_key)
             logger.error(f"cannot find user from session-key {session_key}")
             return self.send_response_403()
 
+        # a change made by another process cannot invalidate this cache, so only the final
+        # accepted state is cached when running several
+        if processes == 1 or user_tos['status'] == 'accepted':
+            session_cache.set(session_key, {**entry, 'tos': dict(user_tos)})
         return user_tos
 
+    def page_arguments(self, filter: {}) -> ():
+        # after_id, limit, since and until for the keyset paginated tracking lists. after_id is the
+        # last (encrypted) id of the previous page, since and until are timestamps or 3h, 2d, 1w (ago)
+        after_id = 0
+        if 'after_id' in filter:
+            try:
+                after_id = utils.decrypt_value(filter['after_id'])
+            except ValueError:
+                after_id = ''
+            if not after_id.isdigit():
+                return self.send_response_400(data="Invalid value for after_id {}".format(filter['after_id']))
+            after_id = int(after_id)
+
+        limit = filter.get('limit', None)
+        if limit is not None:
+            if not limit.isdigit():
+                return self.send_response_400(data="Invalid value for limit {}".format(limit))
+            limit = int(limit)
+
+        window = []
+        for name in ['since', 'until']:
+            try:
+                window.append(utils.time_arg(filter[name]) if name in filter else None)
+            except ValueError:
+                return self.send_response_400(data="Invalid value for {} {}".format(name, filter[name]))
+
+        return after_id, limit, window[0], window[1]
+
+    def invalidate_session(self) -> None:
+        session_cache.delete(self.get_session_key())
+
     def get_session_key(self):
         if DEV:
             session_key = 'ed42604e029aab1a5b1644a93288a9fa'
@@ -76,13 +156,26 @@ class GalaxyHandler(tornado.BaseHandler):
 
         return session_key
 
-    def get_user(self):
+    async def get_user(self, cached: bool = True):
+        # cached=False when the current history has to be up to date
         session_key = self.get_session_key()
-        user = db.get_user_from_session(session_key)
+
+        entry = await self.cached_session(session_key)
+        if cached and 'user' in entry:
+            return dict(entry['user'])
+
+        user = await db.get_user_from_session(session_key)
+        if user is None:
+            session_cache.delete(session_key)
+            return None
+
+        session_cache.set(session_key, {**entry, 'user': dict(user)})
         return user
 
 
-def galaxy_init(galaxy_config: dict) -> None:
+def galaxy_init(galaxy_config: dict, db_pool_size: int = 5, db_statement_timeout: int = None,
+                tracking_log_batch: int = 500, tracking_log_interval: float = 1.0,
+                db_stream_pool_size: int = 2) -> None:
     # initialites galaxy configuration using some galaxy setups from galaxy.yml ('galaxy')
     # (database_connection, file_path, id_secret)
 
@@ -95,7 +188,12 @@ def galaxy_init(galaxy_config: dict) -> None:
     if 'database_connection' not in galaxy_config['galaxy']:
         raise RuntimeError('database_connection  entry not found in galaxy config')
     global db
-    db.connect(galaxy_config['galaxy']['database_connection'])
+    db.connect(galaxy_config['galaxy']['database_connection'],
+               pool_size=db_pool_size,
+               statement_timeout=db_statement_timeout,
+               log_batch_size=tracking_log_batch,
+               log_flush_interval=tracking_log_interval,
+               stream_pool_size=db_stream_pool_size)
 
     if 'file_path' not in galaxy_config['galaxy']:
         raise RuntimeError('file_path  entry not found in galaxy config')
@@ -112,21 +210,31 @@ def galaxy_init(galaxy_config: dict) -> None:
     return
 
 
-def init(config_file: dict) -> None:
+def init(config_file: dict, worker: bool = False) -> None:
     # Initialises setup from config file and galaxy config file and
     # also initialites global variables (galaxy_url, master_url, nels_url, instance_id, tos_grace_period),
     # sets (proxy_keys, instances, no_proxy)
+    # worker is set when re-run in a forked server process, the tables are already set up by then
 
     config = config_utils.readin_config_file(config_file)
     galaxy_config = config_utils.readin_config_file(config['galaxy_config'])
 
-    galaxy_init(galaxy_config)
+    galaxy_init(galaxy_config,
+                db_pool_size=config.get('db_pool_size', 5),
+                db_statement_timeout=config.get('db_statement_timeout', None),
+                tracking_log_batch=config.get('tracking_log_batch', 500),
+                tracking_log_interval=config.get('tracking_log_interval', 1.0),
+                db_stream_pool_size=config.get('db_stream_pool_size', 2))
 
     logger.info("init from config ")
 
     # set incoming and proxy keys
     tornado.set_token(config.get('key', None))
     api_requests.set_token(config.get('proxy_key', None))
+    api_requests.configure(size=config.get('api_pool_size', None),
+                           connect_timeout=config.get('api_connect_timeout', None),
+                           read_timeout=config.get('api_read_timeout', None),
+                           max_retries=config.get('api_retries', None))
 
     global galaxy_url, master_url, nels_url, instance_id
     galaxy_url = config['galaxy_url'].rstrip("/")
@@ -134,22 +242,50 @@ def init(config_file: dict) -> None:
     instance_id = config['id'].rstrip("/")
     nels_url = config['nels_url'].rstrip("/")
 
+    global processes
+    processes = config.get('processes', 1)
+
     if 'tos_server' in config and config['tos_server']:
         logger.info("Running with the tos-server")
 
-        db.create_tos_table()
+        if not worker:
+            db.create_tos_table()
         global tos_grace_period
         tos_grace_period = config.get('grace_period', 14)
 
+    session_cache.configure(size=config.get('session_cache_size', 10000),
+                            ttl=config.get('session_cache_ttl', 60))
+    global session_valid_interval
+    session_valid_interval = config.get('session_valid_interval', 5)
+
+    # the export/import callback states, in a sqlite file if several processes need to see them
+    if processes != 1 and config.get('states_backend', 'memory') == 'memory':
+        raise RuntimeError('running several processes needs the sqlite states backend (states_backend/states_file)')
+
+    states.init(config.get('states_backend', 'memory'),
+                ttl=config.get('states_ttl', 3600),
+                path=config.get('states_file', None))
+
+    # a dbm file cannot be shared between processes, so each worker has its own
+    dataset_index = config.get('dataset_index', None)
+    if dataset_index is not None and worker:
+        dataset_index = f"{dataset_index}.{tornado.task_id()}"
+    utils.init_dataset_index(dataset_index, scan_limit=config.get('dataset_scan_limit', 10000))
+
     if 'master' in config and config['master']:
         logger.info("Running with the master API")
-        db.create_export_tracking_table()
-        db.create_export_tracking_logs_table()
-        db.create_import_tracking_table()
-        db.create_import_tracking_logs_table()
+        if not worker:
+            db.create_export_tracking_table()
+            db.create_export_tracking_logs_table()
+            db.create_import_tracking_table()
+            db.create_import_tracking_logs_table()
 
         mq.connect(uri=config['mq_uri'])
 
+        global bulk_archive_jobs, bulk_release_interval
+        bulk_archive_jobs = config.get('bulk_archive_jobs', bulk_archive_jobs)
+        bulk_release_interval = config.get('bulk_release_interval', bulk_release_interval)
+
         global proxy_keys, instances, no_proxy
         proxy_keys = {}
         instances = {}
@@ -176,6 +312,16 @@ def init(config_file: dict) -> None:
 
     #    global mq
 
+    if worker:
+        return config
+
+    applied = db.migrate()
+    if applied:
+        logger.info(f"Applied schema migrations {applied}")
+
+    for table, column in db.missing_galaxy_indexes():
+        logger.warn(f"Galaxy table {table} has no index on {column}, lookups on it will be slow")
+
     return config
 
 
@@ -191,6 +337,37 @@ def submit_mq_job(tracking_id: int, type: str) -> None:
     mq.publish(body=json.dumps(payload))
 
 
+async def submit_bulk_exports(tracking_ids: []) -> None:
+    # sends the released trackings of bulk exports to the runner. The ones that could not be sent go
+    # back to bulk-queued, so the slots are not held by trackings the runner never hears about, and
+    # release_bulk_exports releases them again.
+
+    for i, tracking_id in enumerate(tracking_ids):
+        try:
+            submit_mq_job(utils.encrypt_value(tracking_id), "export")
+        except Exception as e:
+            logger.error(f"submitting bulk export tracking {tracking_id} failed, requeueing: {e}")
+            await db.requeue_bulk_exports(tracking_ids[i:])
+            return
+
+
+async def release_bulk_exports() -> None:
+    # periodic release of the bulk exports, picks up the ones stalled by a failed release or submit
+    try:
+        released = await db.release_queued_bulk_exports(bulk_archive_jobs)
+    except Exception as e:
+        logger.error(f"releasing bulk exports failed: {e}")
+        return
+
+    if released:
+        logger.info(f"released {len(released)} bulk export trackings")
+        await submit_bulk_exports(released)
+
+
+def start_bulk_release() -> None:
+    PeriodicCallback(release_bulk_exports, bulk_release_interval * 1000).start()
+
+
 # ENDPOINTS MANAGEMENT
 
 class RootHandler(tornado.BaseHandler):
@@ -217,6 +394,24 @@ class Info(tornado.BaseHandler):
         return self.send_response(data={"id": instance_id, "perc_free": perc_free, 'free_gb': free_size})
 
 
+class Stats(tornado.BaseHandler):
+
+    def endpoint(self):
+        return ("/stats/")
+
+    def get(self):
+        logger.debug("get stats")
+        self.check_token()
+        return self.send_response(data={'db_pool': db.stats(),
+                                        'queries': queries.stats(),
+                                        'session_cache': {**session_cache.stats(),
+                                                          'valid_checks': session_valid_checks},
+                                        'id_cache': utils.id_cache_stats(),
+                                        'dataset_index': utils.dataset_index_stats(),
+                                        'api_requests': api_requests.stats(),
+                                        'states': len(states.store)})
+
+
 class State(tornado.BaseHandler):
 
     def endpoint(self):
@@ -275,12 +470,11 @@ class Users(GalaxyHandler):
     def endpoint(self):
         return ("/users")
 
-    def get(self):
+    async def get(self):
         logger.debug("get users")
         self.check_token()
 
-        users = utils.encrypt_ids(db.get_users())
-        return self.send_response(data=users)
+        await self.send_response_stream(db.stream('users'), transform=utils.list_encrypt_ids)
 
 
 class User(GalaxyHandler):
@@ -288,22 +482,22 @@ class User(GalaxyHandler):
     def endpoint(self):
         return ("/user/ID/")
 
-    def get(self, user_id):
+    async def get(self, user_id):
         logger.debug("get user")
         self.check_token()
         user_id = utils.decrypt_value(user_id)
 
-        user = db.get_user(id=user_id)
+        user = await db.get_user(id=user_id)
         if user is None or user == []:
             return self.send_response_404()
 
         user = user[0]
 
-        api_key = db.get_api_key(user['id'])
+        api_key = await db.get_api_key(user['id'])
 
         if api_key is None or api_key == []:
             new_key = utils.create_uuid(32)
-            db.add_api_key(user['id'], new_key)
+            await db.add_api_key(user['id'], new_key)
             user['api_key'] = new_key
         else:
             user['api_key'] = api_key['key']
@@ -319,21 +513,21 @@ class UserApikey(GalaxyHandler):
     def endpoint(self):
         return ("/user/EMAIL/api-key")  # uses session
 
-    def get(self, user_email: str = None):
+    async def get(self, user_email: str = None):
         logger.debug("get user api-key")
         self.check_token()
-        user = db.get_user(email=user_email)
+        user = await db.get_user(email=user_email)
         if user is None or user == []:
             return self.send_response_404()
         print(user)
         user = user[0]
-        api_key = db.get_api_key(user['id'])
+        api_key = await db.get_api_key(user['id'])
         #        print( api_key )
         #        print( api_key )
 
         if api_key is None or api_key == []:
             new_key = utils.create_uuid(32)
-            db.add_api_key(user['id'], new_key)
+            await db.add_api_key(user['id'], new_key)
 
             return self.send_response(data={'api_key': new_key})
 
@@ -345,36 +539,62 @@ class UserHistories(GalaxyHandler):
     def endpoint(self):
         return ("/user/ID/histories")
 
-    def get(self, user_email):
+    async def get(self, user_email):
         logger.debug("get user histories")
         self.check_token()
-        user = db.get_user(email=user_email)
+        user = await db.get_user(email=user_email)
         if user is None or user == []:
             return self.send_response_404()
 
         # Should only be one user with a given email!
         user = user[0]
 
-        user_histories = utils.encrypt_ids(db.get_user_histories(user['id']))
+        user_histories = utils.encrypt_ids(await db.get_user_histories(user['id']))
         return self.send_response(data=user_histories)
 
 
+class UsersHistories(GalaxyHandler):
+
+    def endpoint(self):
+        return ("/users/histories/")
+
+    async def get(self):
+        logger.debug("get histories for all users")
+        self.check_token()
+
+        # what /user/ID/histories gives for every user, plus the email, ordered by user
+        await self.send_response_stream(db.stream('users_histories'), transform=utils.list_encrypt_ids)
+
+
+class UsersExports(GalaxyHandler):
+
+    def endpoint(self):
+        return ("/users/exports/")
+
+    async def get(self):
+        logger.debug("get exports for all users")
+        self.check_token()
+
+        # what /user/ID/exports gives for every user, plus the email, ordered by user
+        await self.send_response_stream(db.stream('users_exports'), transform=utils.list_encrypt_ids)
+
+
 class UserExports(GalaxyHandler):
 
     def endpoint(self):
         return ("/")
 
-    def get(self, user_email):
+    async def get(self, user_email):
         logger.debug("get user exports")
         self.check_token()
-        user = db.get_user(email=user_email)
+        user = await db.get_user(email=user_email)
         if user is None or user == []:
             return self.send_response_401()
 
         # Should only be one user with a given email!
         user = user[0]
 
-        user_exports = utils.encrypt_ids(db.get_user_history_exports(user['id']))
+        user_exports = utils.encrypt_ids(await db.get_user_history_exports(user['id']))
         return self.send_response(data=user_exports)
 
 
@@ -383,22 +603,22 @@ class UserExport(GalaxyHandler):
     def endpoint(self):
         return ("/user/export/(ID)/")
 
-    def patch(self, tracking_id):
+    async def patch(self, tracking_id):
         logger.debug("patch tracking details")
-        user = self.get_user()
+        user = await self.get_user()
         if user is None:
             self.send_response_404()
         data = self.arguments()
         self.require_arguments( data, ['show'])
         # need to decrypt the id otherwise things blow up!
         tracking_id = utils.decrypt_value(tracking_id)
-        tracking = db.get_export_tracking(tracking_id)
+        tracking = await db.get_export_tracking(tracking_id)
         logger.debug(tracking)
         if user['email'] != tracking['user_email']:
             self.send_response_401()
 
 
-        db.update_export_tracking(tracking_id, data)
+        await db.update_export_tracking(tracking_id, data)
         return self.send_response_204()
 
 
@@ -407,9 +627,9 @@ class UserImport(GalaxyHandler):
     def endpoint(self):
         return ("/user/import/(ID)/")
 
-    def patch(self, tracking_id):
+    async def patch(self, tracking_id):
         logger.debug("patch tracking details")
-        user = self.get_user()
+        user = await self.get_user()
         logger.debug(f"USER :: {user}"  )
         if user is None:
             self.send_response_404()
@@ -417,13 +637,13 @@ class UserImport(GalaxyHandler):
         self.require_arguments( data, ['show'])
         # need to decrypt the id otherwise things blow up!
         tracking_id = utils.decrypt_value(tracking_id)
-        tracking = db.get_import_tracking(tracking_id)
+        tracking = await db.get_import_tracking(tracking_id)
         logger.debug(f"TRACKING {tracking}")
         if user['id'] != tracking['user_id']:
             self.send_response_401()
 
 
-        db.update_import_tracking(tracking_id, data)
+        await db.update_import_tracking(tracking_id, data)
         return self.send_response_204()
 
 
@@ -432,17 +652,17 @@ class UserImports(GalaxyHandler):
     def endpoint(self):
         return ("/")
 
-    def get(self, user_email):
+    async def get(self, user_email):
         logger.debug("get user imports")
         self.check_token()
-        user = db.get_user(email=user_email)
+        user = await db.get_user(email=user_email)
         if user is None or user == []:
             return self.send_response_401()
 
         # Should only be one user with a given email!
         user = user[0]
 
-        user_imports = utils.encrypt_ids(db.get_user_history_imports(user['id']))
+        user_imports = utils.encrypt_ids(await db.get_user_history_imports(user['id']))
         return self.send_response(data=user_imports)
 
 
@@ -451,10 +671,10 @@ class HistoryExportRequest(GalaxyHandler):
     def endpoint(self):
         return ("/history/export/request")
 
-    def get(self):
+    async def get(self):
         logger.debug("request history export")
 
-        user = self.get_user()
+        user = await self.get_user(cached=False)
         logger.debug("user")
         logger.debug(user)
         if user is None or user == []:
@@ -478,10 +698,10 @@ class HistoryImportRequest(GalaxyHandler):
     def endpoint(self):
         return ("/history/import/request")
 
-    def get(self):
+    async def get(self):
         logger.debug("request history import")
 
-        user = self.get_user()
+        user = await self.get_user(cached=False)
         if user is None or user == []:
             return self.send_response_401()
 
@@ -509,7 +729,7 @@ class HistoryExport(GalaxyHandler):
     def endpoint(self):
         return ("/history/export")
 
-    def get(self, export_id=None):
+    async def get(self, export_id=None):
         logger.debug("get history exports")
         self.check_token()
 
@@ -519,11 +739,11 @@ class HistoryExport(GalaxyHandler):
 
             self.require_arguments(filter, ['history_id', ])
             history_id = utils.decrypt_value(filter['history_id'])
-            export = db.get_latest_export_for_history(history_id)
+            export = await db.get_latest_export_for_history(history_id)
         else:
             logger.debug('getting by export_id')
             export_id = utils.decrypt_value(export_id)
-            export = db.get_export(export_id)
+            export = await db.get_export(export_id)
 
         if len(export):
             export = export[0]
@@ -533,12 +753,49 @@ class HistoryExport(GalaxyHandler):
             return self.send_response_404()
 
 
+class HistoryExportsStatus(GalaxyHandler):
+
+    def endpoint(self):
+        return ("/history/exports/status/")
+
+    async def post(self):
+        logger.debug("get history exports status")
+        self.check_token()
+
+        values = self.post_values()
+        self.valid_arguments(values, ['export_ids', 'history_ids'])
+
+        export_ids = values.get('export_ids', [])
+        history_ids = values.get('history_ids', [])
+
+        if not isinstance(export_ids, list) or not isinstance(history_ids, list):
+            return self.send_response_400(data="export_ids and history_ids should be lists")
+
+        if len(export_ids) + len(history_ids) > max_status_ids:
+            return self.send_response_400(data=f"At most {max_status_ids} ids pr request")
+
+        try:
+            export_ids = [int(utils.decrypt_value(export_id)) for export_id in export_ids]
+            history_ids = [int(utils.decrypt_value(history_id)) for history_id in history_ids]
+        except Exception:
+            return self.send_response_400(data="Invalid id")
+
+        # the exports asked for by id, and the latest one for each of the histories, one query each
+        exports = []
+        if export_ids:
+            exports += await db.get_exports_by_id(export_ids)
+        if history_ids:
+            exports += await db.get_latest_exports_for_histories(history_ids)
+
+        return self.send_response(data=utils.list_encrypt_ids(exports))
+
+
 class HistoryImport(GalaxyHandler):
 
     def endpoint(self):
         return ("/history/import")
 
-    def get(self, import_id=None):
+    async def get(self, import_id=None):
         logger.debug("get history imports")
         self.check_token()
 
@@ -548,11 +805,11 @@ class HistoryImport(GalaxyHandler):
 
             self.require_arguments(filter, ['history_id', ])
             history_id = utils.decrypt_value(filter['history_id'])
-            imp = db.get_latest_import_for_history(history_id)
+            imp = await db.get_latest_import_for_history(history_id)
         else:
             logger.debug('getting by export_id')
             import_id = utils.decrypt_value(import_id)
-            imp = db.get_import(import_id)
+            imp = await db.get_import(import_id)
 
         if len(imp):
             imp = imp[0]
@@ -567,26 +824,30 @@ class HistoryExportsList(GalaxyHandler):
     def endpoint(self):
         return ("/history/exports/")
 
-    def get(self, all=False):
+    async def get(self, all=False):
         logger.debug("get history exports list")
         self.check_token()
         filter = self.arguments()
 
-        self.valid_arguments(filter, ['state', ])
+        self.valid_arguments(filter, ['state', 'after_id', 'limit'])
 
         if 'state' not in filter:
             filter['state'] = ''
 
+        # keyset pagination over the latest export pr history, after_id is the last history_id seen
+        after_id, limit, _, _ = self.page_arguments(filter)
+
         if 'state' in filter and filter['state'] not in ['new', 'upload', 'waiting', '',
                                                          'queued', 'running', 'ok', 'error',
                                                          'paused', 'deleted', 'deleted_new', 'pre-queueing', 'all']:
             return self.send_response_400(data="Invalid value for state {}".format(filter['state']))
 
         if all == 'all':
-            exports = db.get_all_exports(state=filter['state'])
-        else:
-            exports = db.get_exports(state=filter['state'])
+            # every export there is, streamed rather than build up in memory
+            return await self.send_response_stream(db.stream('all_exports', filter['state']),
+                                                   transform=utils.list_encrypt_ids)
 
+        exports = await db.get_exports(state=filter['state'], after_id=after_id, limit=limit)
         exports = utils.list_encrypt_ids(exports)
         return self.send_response(data=exports)
 
@@ -596,25 +857,28 @@ class HistoryImportsList(GalaxyHandler):
     def endpoint(self):
         return ("/history/imports/")
 
-    def get(self, all=False):
+    async def get(self, all=False):
         logger.debug("get history imports list")
         self.check_token()
         filter = self.arguments()
 
-        self.valid_arguments(filter, ['state', ])
+        self.valid_arguments(filter, ['state', 'after_id', 'limit'])
 
         if 'state' not in filter:
             filter['state'] = ''
 
+        # keyset pagination over the latest import pr history, after_id is the last history_id seen
+        after_id, limit, _, _ = self.page_arguments(filter)
+
         if 'state' in filter and filter['state'] not in ['new', 'upload', 'waiting', '',
                                                          'queued', 'running', 'ok', 'error',
                                                          'paused', 'deleted', 'deleted_new', 'pre-queueing', 'all']:
             return self.send_response_400(data="Invalid value for state {}".format(filter['state']))
 
         if all == 'all':
-            imports = db.get_all_imports(state=filter['state'])
+            imports = await db.get_all_imports(state=filter['state'])
         else:
-            imports = db.get_imports(state=filter['state'])
+            imports = await db.get_imports(state=filter['state'], after_id=after_id, limit=limit)
 
         imports = utils.list_encrypt_ids(imports)
         return self.send_response(data=imports)
@@ -625,7 +889,7 @@ class JobsList(GalaxyHandler):
     def endpoint(self):
         return ("/jobs/")
 
-    def get(self, ):
+    async def get(self, ):
         logger.debug("get jobs list")
         self.check_token()
         filter = self.arguments()
@@ -633,14 +897,16 @@ class JobsList(GalaxyHandler):
         self.valid_arguments(filter, ['time_delta', 'user_id'])
 
         time_delta = filter.get('time_delta', "60m") #default 1 hour
-        time_delta = utils.timedelta_to_sec( time_delta )
+        try:
+            time_delta = utils.timedelta_to_sec( time_delta )
+        except ValueError:
+            return self.send_response_400(data="Invalid value for time_delta {}".format(time_delta))
 
         user_id = filter.get('user_id', None)
         if user_id is not None:
             user_id = utils.decrypt_value(user_id)
 
-        jobs = db.get_jobs(time_delta=time_delta, user_id=user_id)
-        return self.send_response(data=utils.list_encrypt_ids(jobs))
+        await self.send_response_stream(db.stream('jobs', time_delta, user_id), transform=utils.list_encrypt_ids)
 
 
 class HistoryDownload(GalaxyHandler):
@@ -648,47 +914,48 @@ class HistoryDownload(GalaxyHandler):
     def endpoint(self):
         return ("/history/download")
 
+    async def export_file(self, export_id) -> str:
+        # the archive file of an (encrypted) export id
+        export_id = utils.decrypt_value(export_id)
+        export = (await db.get_export(export_id))[0]
+
+        try:
+            dataset = await db.get_dataset(export['dataset_id'])
+            return await IOLoop.current().run_in_executor(None, utils.construct_file_path,
+                                                          dataset['id'], galaxy_file_path)
+        except FileNotFoundError as e:
+            # not in the usual places, nor in the part of the tree scanned this time
+            logger.error(e)
+            return self.send_response_404()
+        except Exception as e:
+            logger.error(e)
+            return self.send_response_400(data={'error': str(e)})
+
     async def get(self, export_id=None):
         logger.debug("get history download")
         self.check_token()
 
-        # chunk size to read
-        chunk_size = 1024 * 1024 * 1  # 1 MiB
+        filename = await self.export_file(export_id)
 
-        export_id = utils.decrypt_value(export_id)
-        export = db.get_export(export_id)[0]
+        logger.debug("start the download")
+        # file reads happens in the executor, and a Range request resumes an interrupted download
+        await self.send_file_range(filename)
+        logger.debug("download completed")
 
-        try:
 
-            dataset = db.get_dataset(export['dataset_id'])
-            filename = utils.construct_file_path(obj_id=dataset['id'], file_dir=galaxy_file_path)
-            logger.debug("start the download")
-
-            with open(filename, 'rb') as f:
-                while True:
-                    chunk = f.read(chunk_size)
-                    if not chunk:
-                        break
-                    try:
-                        self.write(chunk)  # write the cunk to response
-                        await self.flush()  # flush the current chunk to socket
-                    except iostream.StreamClosedError:
-                        # this means the client has closed the connection
-                        # so break the loop
-                        break
-                    finally:
-                        # deleting the chunk is very important because
-                        # if many clients are downloading files at the
-                        # same time, the chunks in memory will keep
-                        # increasing and will eat up the RAM
-                        del chunk
-                    time.sleep(0)
+class HistoryDownloadChecksum(HistoryDownload):
 
-        except Exception as e:
-            logger.error(e)
-            self.send_response_400(data={'error': str(e)})
+    def endpoint(self):
+        return ("/history/download/sha256")
 
-        logger.debug("download completed")
+    async def get(self, export_id=None):
+        logger.debug("get history download sha256")
+        self.check_token()
+
+        filename = await self.export_file(export_id)
+        # reads the whole archive the first time, so off the IOLoop
+        checksum = await IOLoop.current().run_in_executor(None, utils.file_sha256, filename)
+        return self.send_response(data=checksum)
 
 
 class Encrypt(tornado.BaseHandler):
@@ -719,11 +986,11 @@ class ExportsListProxy(GalaxyHandler):
     def endpoint(self):
         return ("/user/exports/")
 
-    def get(self):
+    async def get(self):
         logger.debug("proxy export list")
         # Will not check token here as relying on the session id instead
         #        self.check_token()
-        user = self.get_user()
+        user = await self.get_user()
         if user is None:
             self.send_response_404()
 
@@ -731,7 +998,7 @@ class ExportsListProxy(GalaxyHandler):
         if no_proxy:
             logger.debug('accessing the data directly')
             #            print( user )
-            trackings = db.get_export_trackings(user_email=user['email'], instance=instances[instance_id]['name'])
+            trackings = await db.get_export_trackings(user_email=user['email'], instance=instances[instance_id]['name'])
         else:
             logger.debug('accessing the data using the proxy')
             trackings, _ = api_requests.get_user_instance_exports(master_url, user['email'], instance_id)
@@ -739,7 +1006,7 @@ class ExportsListProxy(GalaxyHandler):
         results = []
         for tracking in trackings:
             history_id = utils.decrypt_value(tracking['history_id'])
-            history = db.get_history(history_id)[0]
+            history = (await db.get_history(history_id))[0]
 
             results.append({'name': history['name'],
                             'id': tracking['id'],
@@ -759,17 +1026,17 @@ class UserImportsList(GalaxyHandler):
     def endpoint(self):
         return ("/user/imports/")
 
-    def get(self):
+    async def get(self):
         logger.debug("user import list")
         # Will not check token here as relying on the session id instead
         #        self.check_token()
-        user = self.get_user()
+        user = await self.get_user()
         if user is None:
             self.send_response_404()
 
         logger.debug('accessing the data directly')
         #            print( user )
-        trackings = db.get_import_trackings(user_id=user['id'])
+        trackings = await db.get_import_trackings(user_id=user['id'])
 
         results = []
         for tracking in trackings:
@@ -801,9 +1068,9 @@ class Tos(GalaxyHandler):
     def endpoint(self):
         return ("/tos")
 
-    def get(self):
+    async def get(self):
         logger.debug("get TOS")
-        user_tos = self.get_tos()
+        user_tos = await self.get_tos()
 
         logger.debug("getting tos for {}".format(user_tos['user_id']))
         res = {}
@@ -814,21 +1081,23 @@ class Tos(GalaxyHandler):
                 res['grace_period'] = "{} days".format(time_diff.days + 1)
             else:
                 user_tos['status'] = 'expired'
-                db.update_tos(user_tos)
+                await db.update_tos(user_tos)
+                self.invalidate_session()
 
         res['status'] = user_tos['status']
         return self.send_response(data=res)
 
-    def patch(self):
+    async def patch(self):
         logger.debug("patch TOS")
-        user_tos = self.get_tos()
+        user_tos = await self.get_tos()
         data = tornado.json_decode(self.request.body)
 
         if 'status' in data and data['status'] == 'accepted':
             logger.info("Updating TOS for {}".format(user_tos['user_id']))
             user_tos['status'] = 'accepted'
             user_tos['tos_date'] = datetime.datetime.now()
-            db.update_tos(user_tos)
+            await db.update_tos(user_tos)
+            self.invalidate_session()
             return self.send_response_204()
 
         return self.send_response_404()
@@ -839,7 +1108,7 @@ class RequeueExport(GalaxyHandler):
     def endpoint(self):
         return ("/export/ID/requeue/")
 
-    def post(self, tracking_id):
+    async def post(self, tracking_id):
 
         logger.debug("requeue export tracking")
         self.check_token()
@@ -849,16 +1118,22 @@ class RequeueExport(GalaxyHandler):
         state = values['state']
         try:
             tracking_id = utils.decrypt_value(tracking_id)
-            tracking = db.get_export_tracking(tracking_id)
+            tracking = await db.get_export_tracking(tracking_id)
             tracking['state'] = state
 
             for k in ['id', 'create_time', 'update_time']:
                 del tracking[k]
 
-            tracking['log'] = f"requeue export tracker {tracking_id} and changed state to {state}"
-            tracking_id = db.add_export_tracking(tracking)
-            tracking_id = utils.encrypt_value(tracking_id)
-            submit_mq_job(tracking_id, "export")
+            # a bulk export member that needs its archive built again waits for a slot like the rest
+            if tracking.get('bulk_id') is not None and state in nels_galaxy_db.bulk_building_states:
+                tracking['state'] = 'bulk-queued'
+
+            tracking['log'] = f"requeue export tracker {tracking_id} and changed state to {tracking['state']}"
+            tracking_id = await db.add_export_tracking(tracking)
+            if tracking['state'] == 'bulk-queued':
+                await submit_bulk_exports(await db.release_bulk_exports(tracking_id, bulk_archive_jobs))
+            else:
+                submit_mq_job(utils.encrypt_value(tracking_id), "export")
 
             self.send_response_200()
         except Exception as e:
@@ -871,15 +1146,15 @@ class Export(GalaxyHandler):
     def endpoint(self):
         return ("/export/")
 
-    def get(self, tracking_id):
+    async def get(self, tracking_id):
 
         logger.debug("get tracking details")
         self.check_token()
         tracking_id = utils.decrypt_value(tracking_id)
-        tracking = utils.encrypt_ids(db.get_export_tracking(tracking_id))
+        tracking = utils.encrypt_ids(await db.get_export_tracking(tracking_id))
         self.send_response(data=tracking)
 
-    def patch(self, tracking_id):
+    async def patch(self, tracking_id):
         logger.debug("patch tracking details")
         self.check_token()
         data = self.post_values()
@@ -887,10 +1162,15 @@ class Export(GalaxyHandler):
         # need to decrypt the id otherwise things blow up!
         tracking_id = utils.decrypt_value(tracking_id)
 
-        db.update_export_tracking(tracking_id, data)
+        await db.update_export_tracking(tracking_id, data)
+
+        # an archive of a bulk export is built (or failed), the next one can start
+        if 'state' in data and data['state'] not in nels_galaxy_db.bulk_building_states + ['bulk-queued']:
+            await submit_bulk_exports(await db.release_bulk_exports(tracking_id, bulk_archive_jobs))
+
         return self.send_response_204()
 
-    def _register_export(self, instance: str, user: str, history_id: str, nels_id: int, destination: str):
+    async def _register_export(self, instance: str, user: str, history_id: str, nels_id: int, destination: str):
         logger.debug("registering export")
         tracking = {'instance': instance,
                     'user_email': user,
@@ -901,10 +1181,10 @@ class Export(GalaxyHandler):
 
         # Need this function next
         #        if not db.history_export_exists(tracking):
-        tracking_id = db.add_export_tracking(tracking)
+        tracking_id = await db.add_export_tracking(tracking)
         return tracking_id
 
-    def post(self, instance, state_id):
+    async def post(self, instance, state_id):
 
         # logger.debug(f"POST VALUES: {self.request.body}")
         nels_id = int(self.get_body_argument("nelsId", default=None))
@@ -926,7 +1206,7 @@ class Export(GalaxyHandler):
             instance_name = instances[instance]['name']
             user = state['user']
             history_id = state['history_id']
-            tracking_id = self._register_export(instance_name, user, history_id, nels_id, location)
+            tracking_id = await self._register_export(instance_name, user, history_id, nels_id, location)
 
             tracking_id = utils.encrypt_value(tracking_id)
 
@@ -945,12 +1225,73 @@ class Export(GalaxyHandler):
             self.send_response_400()
 
 
+class ExportBulk(GalaxyHandler):
+    # exports a list of histories of a user (all of them by default) in one go. The trackings are
+    # registered together and the archives built bulk_archive_jobs at a time, see Export.patch
+
+    def endpoint(self):
+        return ("/export/bulk/")
+
+    async def get(self, bulk_id):
+        logger.debug("get bulk export progress")
+        self.check_token()
+
+        bulk = await db.get_bulk_export(utils.decrypt_value(bulk_id))
+        if bulk is None:
+            return self.send_response_404()
+
+        return self.send_response(data=utils.encrypt_ids(bulk))
+
+    async def _user_histories(self, instance: str, user_email: str) -> []:
+        if instance == instance_id:
+            user = await db.get_user(email=user_email)
+            if user is None or user == []:
+                return self.send_response_404()
+
+            return utils.encrypt_ids(await db.get_user_histories(user[0]['id']))
+
+        if 'async_api' not in instances[instance]:
+            api = instances[instance]['api']
+            instances[instance]['async_api'] = api_requests.AsyncApiRequests(api._base_url, api._token)
+
+        return await instances[instance]['async_api'].get_user_histories(user_email)
+
+    async def post(self, instance, user_email):
+        logger.debug("register bulk export")
+        self.check_token()
+
+        values = self.post_values()
+        self.valid_arguments(values, ['nels_id', 'destination', 'history_ids'])
+        self.require_arguments(values, ['nels_id', 'destination'])
+
+        if instance not in instances:
+            return self.send_response_404()
+
+        history_ids = values.get('history_ids', None)
+        if history_ids is None:
+            history_ids = [history['id'] for history in await self._user_histories(instance, user_email)]
+
+        if len(history_ids) == 0:
+            return self.send_response_400(data={'error': 'no histories to export'})
+
+        bulk = {'instance': instances[instance]['name'],
+                'user_email': user_email,
+                'nels_id': int(values['nels_id']),
+                'destination': values['destination']}
+
+        bulk_id, released = await db.add_bulk_export_trackings(bulk, history_ids, bulk_archive_jobs)
+        await submit_bulk_exports(released)
+
+        logger.info(f"bulk export {bulk_id} of {len(history_ids)} histories for {user_email}")
+        return self.send_response(data={'id': utils.encrypt_value(bulk_id), 'trackings': len(history_ids)})
+
+
 class RequeueImport(GalaxyHandler):
 
     def endpoint(self):
         return ("/import/ID/requeue/")
 
-    def post(self, tracking_id):
+    async def post(self, tracking_id):
 
         logger.debug("requeue import tracking")
         self.check_token()
@@ -960,7 +1301,7 @@ class RequeueImport(GalaxyHandler):
         state = values['state']
         try:
             tracking_id = utils.decrypt_value(tracking_id)
-            tracking = db.get_import_tracking(tracking_id)
+            tracking = await db.get_import_tracking(tracking_id)
             print(tracking)
             tracking['state'] = state
 
@@ -968,7 +1309,7 @@ class RequeueImport(GalaxyHandler):
                 del tracking[k]
 
             tracking['log'] = f"requeue import tracker {tracking_id} and changed state to {state}"
-            tracking_id = db.add_import_tracking(tracking)
+            tracking_id = await db.add_import_tracking(tracking)
             tracking_id = utils.encrypt_value(tracking_id)
             submit_mq_job(tracking_id, "import")
 
@@ -984,15 +1325,15 @@ class Import(GalaxyHandler):
     def endpoint(self):
         return ("/import/")
 
-    def get(self, tracking_id):
+    async def get(self, tracking_id):
 
         logger.debug("get tracking details")
         self.check_token()
         tracking_id = utils.decrypt_value(tracking_id)
-        tracking = utils.encrypt_ids(db.get_import_tracking(tracking_id))
+        tracking = utils.encrypt_ids(await db.get_import_tracking(tracking_id))
         self.send_response(data=tracking)
 
-    def patch(self, tracking_id):
+    async def patch(self, tracking_id):
         logger.debug("patch tracking details")
         self.check_token()
         data = self.post_values()
@@ -1000,10 +1341,10 @@ class Import(GalaxyHandler):
         # need to decrypt the id otherwise things blow up!
         tracking_id = utils.decrypt_value(tracking_id)
 
-        db.update_import_tracking(tracking_id, data)
+        await db.update_import_tracking(tracking_id, data)
         return self.send_response_204()
 
-    def _register_import(self, user_id: int, nels_id: int, source: str):
+    async def _register_import(self, user_id: int, nels_id: int, source: str):
         logger.debug("registering export")
         tracking = {'user_id': user_id,
                     'state': 'pre-fetch',
@@ -1012,10 +1353,10 @@ class Import(GalaxyHandler):
 
         # Need this function next
         #        if not db.history_export_exists(tracking):
-        tracking_id = db.add_import_tracking(tracking)
+        tracking_id = await db.add_import_tracking(tracking)
         return tracking_id
 
-    def post(self, state_id):
+    async def post(self, state_id):
 
         logger.debug(f"POST VALUES: {self.request.body}")
         nels_id = int(self.get_body_argument("nelsId", default=None))
@@ -1030,7 +1371,7 @@ class Import(GalaxyHandler):
 
         try:
             user = state['user']
-            tracking_id = self._register_import(user, nels_id, location)
+            tracking_id = await self._register_import(user, nels_id, location)
             tracking_id = utils.encrypt_value(tracking_id)
             submit_mq_job(tracking_id, "import")
             self.redirect(galaxy_url)
@@ -1050,8 +1391,8 @@ class Export_not_used(GalaxyHandler):
     def endpoint(self):
         return ("/export/")
 
-    def _usegalaxy_export(self):
-        user = self.get_user()
+    async def _usegalaxy_export(self):
+        user = await self.get_user()
 
         current_history_id = user['current_history_id']
         if not isinstance(current_history_id, int):
@@ -1065,7 +1406,7 @@ class ExportsList(Export):
     def endpoint(self):
         return ("/export/")
 
-    def get(self, user: str = None, instance_id: str = None):
+    async def get(self, user: str = None, instance_id: str = None):
         logger.debug("get Export list")
         logger.debug(proxy_keys)
         self.check_token(proxy_keys)
@@ -1075,16 +1416,19 @@ class ExportsList(Export):
 
         # Ones we care about when polling: 'new', 'waiting', 'queued', 'running'  + 'pre-queueing'
 
-        self.valid_arguments(filter, ['state', ])
+        self.valid_arguments(filter, ['state', 'after_id', 'limit', 'since', 'until'])
 
         if 'state' in filter and filter['state'] not in ['new', 'upload', 'waiting',
                                                          'queued', 'running', 'ok', 'error',
                                                          'paused', 'deleted', 'deleted_new',
                                                          'pre-queueing', 'fetch-running', 'fetch-ok', 'fetch-error',
                                                          'nels-transfer-queue', 'nels-transfer-running',
-                                                         'nels-transfer-ok', 'nels-transfer-error']:
+                                                         'nels-transfer-ok', 'nels-transfer-error',
+                                                         'bulk-queued', 'finished', 'export-error']:
             return self.send_response_400(data="Invalid value for state {}".format(filter['state']))
 
+        after_id, limit, since, until = self.page_arguments(filter)
+
         if instance_id is not None:
             filter['instance'] = instances[instance_id]['name']
 
@@ -1093,8 +1437,9 @@ class ExportsList(Export):
 
         #        pp.pprint( filter )
 
-        exports = utils.encrypt_ids(db.get_export_trackings(**filter))
-        self.send_response(data=exports)
+        exports = db.stream('export_trackings', filter.get('state'), filter.get('instance'), filter.get('user_email'),
+                            since, until, after_id, limit)
+        await self.send_response_stream(exports, transform=utils.list_encrypt_ids)
 
 
 class ImportsList(Export):
@@ -1102,7 +1447,7 @@ class ImportsList(Export):
     def endpoint(self):
         return ("/import/")
 
-    def get(self, user: str = None):
+    async def get(self, user: str = None):
         logger.debug("get Import list")
         logger.debug(proxy_keys)
         self.check_token(proxy_keys)
@@ -1112,7 +1457,7 @@ class ImportsList(Export):
 
         # Ones we care about when polling: 'new', 'waiting', 'queued', 'running'  + 'pre-queueing'
 
-        self.valid_arguments(filter, ['state', ])
+        self.valid_arguments(filter, ['state', 'after_id', 'limit', 'since', 'until'])
 
         if 'state' in filter and filter['state'] not in ['new', 'upload', 'waiting',
                                                          'queued', 'running', 'ok', 'error',
@@ -1122,19 +1467,11 @@ class ImportsList(Export):
                                                          'nels-transfer-ok', 'nels-transfer-error']:
             return self.send_response_400(data="Invalid value for state {}".format(filter['state']))
 
-        if user is not None:
-            users = db.get_user(email=user)
-            if len(users):
-                filter['user_id'] = users[0]['id']
-
-        imports = []
-        for imp in db.get_import_trackings(**filter):
-            users = db.get_user(id=imp['user_id'])
-            imp['user_email'] = users[0]['email']
-            imports.append( imp )
+        after_id, limit, since, until = self.page_arguments(filter)
 
-        imports = utils.encrypt_ids(imports)
-        self.send_response(data=imports)
+        # the user email comes from a join, rather than a user lookup pr import
+        imports = db.stream('import_trackings', filter.get('state'), user, since, until, after_id, limit)
+        await self.send_response_stream(imports, transform=utils.list_encrypt_ids)
 
 
 
@@ -1173,10 +1510,13 @@ def main():
     # Base functionality
     urls = [('/', RootHandler),  # Done
             (r'/info/?$', Info),  # Done
+            (r'/stats/?$', Stats),  # db pool and query timings
             (r'/state/(\w+)/?$', State),  # Done
 
             # for the cli...
             (r'/users/?$', Users),  # Done
+            (r'/users/histories/?$', UsersHistories),  # histories of all users in one go
+            (r'/users/exports/?$', UsersExports),  # latest export pr history of all users in one go
 
             (r"/user/({email_match})/histories/?$".format(email_match=string_utils.email_match), UserHistories),  # Done
             (r"/user/({email_match})/exports/?$".format(email_match=string_utils.email_match), UserExports),
@@ -1200,11 +1540,13 @@ def main():
             (r'/history/import/(\w+)?$', HistoryImport),  # export_id, last one pr history is default # skip
             (r'/history/import/?$', HistoryImport),  # possible to search by history_id               # ship
 
+            (r'/history/exports/status/?$', HistoryExportsStatus),  # state of a list of exports/histories
             (r'/history/exports/(all)/?$', HistoryExportsList),  # for the local instance, all, brief is default # done
             (r'/history/exports/?$', HistoryExportsList),  # for the local instance, all, brief is default       # done
             (r'/history/imports/(all)/?$', HistoryImportsList),  # for the local instance, all, brief is default # done
             (r'/history/imports/?$', HistoryImportsList),  # for the local instance, all, brief is default       # done
 
+            (r'/history/download/(\w+)/sha256/?$', HistoryDownloadChecksum),  # sha256 of an exported history      # skip
             (r'/history/download/(\w+)/?$', HistoryDownload),  # fetching exported histories                     # skip
 
             ]
@@ -1220,6 +1562,9 @@ def main():
                  (r'/export/(\w+)/requeue/?$', RequeueExport),  # requeue  export request
                  (r'/import/(\w+)/requeue/?$', RequeueImport),  # requeue  export request
 
+                 (r"/export/bulk/(\w+)/?$", ExportBulk),  # progress of a bulk export
+                 (r"/export/(\w+)/({email_match})/bulk/?$".format(email_match=string_utils.email_match), ExportBulk),
+                 # instance-id, user_email (post), a bulk export of the user's histories
                  (r"/export/(\w+)/(\w+)/?$", Export),  # instance-id, state-id (post) #done
                  (r'/export/(\w+)/?$', Export),  # get or patch an export request # skip
                  (r"/import/(\w+)/?$", Import),  # state-id (post) #
@@ -1251,9 +1596,26 @@ def main():
         sid = states.set({'id': 1234, 'name': 'tyt'})
         logger.info(f"TEST STATE ID: {sid}")
 
-    logger.info(f"Running on port: {config.get('port', 8008)}")
+    # the master keeps the bulk exports moving, in every server process as the releases are serialised
+    on_start = None
+    if 'master' in config and config['master']:
+        on_start = start_bulk_release
+
+    worker_init = None
+    if processes != 1:
+        # connections (and the dataset index file) cannot be shared over a fork, each worker makes its own
+        db.disconnect()
+        utils.init_dataset_index()
+        if 'master' in config and config['master']:
+            mq.connection.close()
+
+        worker_init = functools.partial(init, args.config_file, worker=True)
+
+    logger.info(f"Running on port: {config.get('port', 8008)}, processes: {processes}")
     try:
-        tornado.run_app(urls, port=config.get('port', 8008))
+        # disconnecting writes the tracking logs still queued
+        tornado.run_app(urls, port=config.get('port', 8008), processes=processes, worker_init=worker_init,
+                        on_start=on_start, on_stop=db.disconnect, shutdown_timeout=config.get('shutdown_timeout', 10))
     except KeyboardInterrupt:
         logger.info(f'stopping nels_galaxy_api')
 
@@ -6,16 +6,20 @@
 # Kim Brugger (03 Apr 2019), contact: kim@brugger.dk
 
 import sys
+import os
 import pprint
 pp = pprint.PrettyPrinter(indent=4)
 import json
 import argparse
+import contextlib
+import functools
 import re
 import tempfile
 import time
 import requests
 import traceback
 import certifi
+import paramiko
 
 
 
@@ -33,6 +37,9 @@ import kbr.log_utils as logger
 
 import nels_galaxy_api.api_requests as api_requests
 import nels_galaxy_api.utils as utils
+import nels_galaxy_api.workers as workers
+import nels_galaxy_api.scheduler as scheduler
+import nels_galaxy_api.sftp as sftp
 
 version = version_utils.as_string()
 
@@ -47,6 +54,18 @@ nels_storage_client_key = None
 nels_storage_client_secret = None
 nels_storage_url = None
 sleep_time = 5
+pool = None
+export_scheduler = None
+
+# the states of a galaxy export job that is still being built
+pending_export_states = ['new', 'upload', 'waiting', 'queued', 'running']
+# export ids pr bulk status request, the instances allow up to 1000
+bulk_status_size = 500
+# stream finished exports from galaxy into NeLS, rather than fetch and push them through tmp_dir
+stream_exports = False
+stream_buffer = sftp.buffer_size
+# ssh connections to the NeLS hosts, kept open between the transfers of a user
+sftp_pool = sftp.ConnectionPool()
 
 
 
@@ -56,6 +75,10 @@ def init( config_file) -> {}:
 
     # set incoming and proxy keys
     api_requests.set_token(config.get('proxy_key', None))
+    api_requests.configure(size=config.get('api_pool_size', None),
+                           connect_timeout=config.get('api_connect_timeout', None),
+                           read_timeout=config.get('api_read_timeout', None),
+                           max_retries=config.get('api_retries', None))
 
     global master_url, nels_url, instances, master_api, tmp_dir, sleep_time
     master_url = config['master_url'].rstrip("/")
@@ -72,6 +95,32 @@ def init( config_file) -> {}:
     tmp_dir = config.get('tmp_dir', tmp_dir)
     sleep_time = config.get('sleep_time', sleep_time)
 
+    global stream_exports, stream_buffer
+    stream_exports = config.get('stream_exports', stream_exports)
+    # in chunks of sftp.chunk_size (1MB)
+    stream_buffer = config.get('stream_buffer', stream_buffer)
+
+    utils.ssh_credentials.configure(ttl=config.get('nels_credential_ttl', 300))
+
+    global sftp_pool
+    sftp_pool = sftp.ConnectionPool(idle_timeout=config.get('sftp_idle_timeout', 300),
+                                    max_channels=config.get('sftp_max_channels', 8))
+
+    # how many trackers are worked on at the same time, in total and pr stage/instance
+    global pool
+    pool = workers.WorkerPool(config.get('workers', 4))
+    for stage, limit in config.get('stage_workers', {}).items():
+        pool.set_limit(f"stage:{stage}", limit)
+
+    # polls the exports galaxy is building, starting at sleep_time and backing off to max_sleep_time.
+    # One not done max_export_age seconds after its tracker was created is set to export-error
+    global export_scheduler
+    export_scheduler = scheduler.ExportScheduler(poll_exports, export_changed,
+                                                 min_interval=sleep_time,
+                                                 max_interval=config.get('max_sleep_time', 300),
+                                                 failed=export_failed,
+                                                 max_age=config.get('max_export_age', 86400))
+
 
     tmp_instances = config['instances']
 
@@ -86,6 +135,10 @@ def init( config_file) -> {}:
 
         instances[instance['name']] = instance
 
+        instance_workers = instance.get('workers', config.get('instance_workers', None))
+        if instance_workers is not None:
+            pool.set_limit(f"instance:{instance['name']}", instance_workers)
+
 
 
     return config
@@ -99,7 +152,8 @@ def submit_mq_job(tracker_id:int, type:str ) -> None:
         logger.error('MQ not configured, cannot send message')
         return
 
-    mq.publish(body=json.dumps(payload))
+    # called from the workers, the channel belongs to the consumer thread
+    mq.channel.connection.add_callback_threadsafe(functools.partial(mq.publish, body=json.dumps(payload)))
 
 
 def run_cmd(cmd:str, name:str=None, verbose:bool=False):
@@ -129,7 +183,6 @@ def run_history_export( tracker ):
             master_api.update_export(tracker['id'], {'state': 'disk-space-error'})
             return
     except Exception as e:
-#        traceback.print_tb(e.__traceback__)
         logger.error( f"{tracker['id']}: Fetch info error {e}")
 
     try:
@@ -143,35 +196,88 @@ def run_history_export( tracker ):
         export_id = galaxy_instance.histories.export_history(tracker['history_id'], maxwait=1, gzip=True)
     except Exception as e:
         logger.error(f"{tracker['id']}/{tracker['instance']}: bioblend trigger export {e}")
-        master_api.update_export(tracker['id'], {'state': 'bioblend-error', 'log': e['err_msg']})
+        master_api.update_export(tracker['id'], {'state': 'bioblend-error', 'log': str(e)})
         return
 
-    while True:
-
-        if export_id is None or export_id == '':
-            history = instances[instance]['api'].get_history_export(history_id=tracker['history_id'])
-            logger.debug(f"history id not found !{history}")
-            if history is not None and history != '':
-                master_api.update_export(tracker['id'], {"export_id": history['export_id'], 'state': 'new'})
-                export_id = history['export_id']
-            else:
-                logger.error(f"{tracker['id']}: No history id associated with {export_id}")
-                raise RuntimeError(f"{tracker['id']}: No history id associated with {export_id}")
+    if export_id is None or export_id == '':
+        history = instances[instance]['api'].get_history_export(history_id=tracker['history_id'])
+        logger.debug(f"history id not found !{history}")
+        if history is not None and history != '':
+            master_api.update_export(tracker['id'], {"export_id": history['export_id'], 'state': 'new'})
+            export_id = history['export_id']
+            tracker['state'] = 'new'
         else:
-#            print( f" API :: {instance['api']}" )
-            export = instances[instance]['api'].get_history_export(export_id=export_id)
-            logger.debug( export )
-            master_api.update_export(tracker['id'], {"export_id": export_id, 'state': export['state']})
+            logger.error(f"{tracker['id']}: No history id associated with {export_id}")
+            # an error state, so the tracker does not hold on to a bulk export slot
+            master_api.update_export(tracker['id'], {'state': 'export-error', 'log': 'No export id from galaxy'})
+            raise RuntimeError(f"{tracker['id']}: No history id associated with {export_id}")
+
+    # galaxy builds the archive in its own time, the scheduler picks it up from here
+    tracker['export_id'] = export_id
+    export_scheduler.add(tracker)
+    logger.info(f'{tracker["id"]}: history export triggered')
+
+
+def poll_exports(instance:str, export_ids:[]) -> {}:
+    # the current state of the exports on an instance, in one request where the instance supports it
+    api = instances[instance]['api']
+    if instances[instance].get('bulk_status', True):
+        try:
+            states = {}
+            for i in range(0, len(export_ids), bulk_status_size):
+                exports = api.get_history_exports_status(export_ids=export_ids[i: i + bulk_status_size])
+                for export in exports:
+                    states[export['export_id']] = export['state']
+
+            return states
+
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code != 404:
+                raise
+
+            logger.info(f"{instance} has no bulk export status, polling the exports one by one")
+            instances[instance]['bulk_status'] = False
+
+    # one export galaxy no longer knows is left out, one that fails to poll keeps its state for now
+    states = {}
+    for export_id in export_ids:
+        try:
+            export = api.get_history_export(export_id=export_id)
+            states[export_id] = export['state']
+        except Exception as e:
+            if isinstance(e, requests.HTTPError) and e.response is not None and e.response.status_code == 404:
+                continue
+            logger.error(f"{instance}: polling export {export_id} failed: {e}")
+            states[export_id] = None
+
+    return states
+
+
+def export_changed(tracker:{}, state:str) -> None:
+    master_api.update_export(tracker['id'], {"export_id": tracker['export_id'], 'state': state})
+
+    if state in ['ok', 'error']:
+        submit_mq_job(tracker['id'], 'export')
+        logger.info(f'{tracker["id"]}: history export done')
+
 
-            if export['state'] in ['ok', 'error']:
-                submit_mq_job(tracker['id'], 'export')
-                logger.info(f'{tracker["id"]}: history export done')
+def export_failed(tracker:{}, log:str) -> None:
+    # galaxy is never going to finish it, an error state frees its bulk export slot
+    master_api.update_export(tracker['id'], {'state': 'export-error', 'log': log})
 
-                return
 
+def reload_pending_exports() -> None:
+    # exports that were being built when the runner was stopped
+    for state in pending_export_states:
+        for tracker in master_api.iter_exports({'state': state}):
+            if tracker.get('export_id', None) in [None, '']:
+                logger.error(f"{tracker['id']}: export in state {state} without an export id")
+                continue
+
+            export_scheduler.add(tracker)
+
+    logger.info(f"{len(export_scheduler)} pending exports")
 
-        logger.debug("entering sleep cycle")
-        time.sleep( sleep_time )
 
 def run_fetch_export(tracker):
 
@@ -181,15 +287,20 @@ def run_fetch_export(tracker):
     tracker_id = tracker['id']
     instance = tracker['instance']
 
-    outfile = "{}/{}.tgz".format(tempfile.mkdtemp(dir=tmp_dir), export_id)
+    # a requeued fetch carries on with what is already downloaded
+    outfile = tracker.get('tmpfile')
+    if outfile is None or not os.path.isfile(outfile):
+        outfile = "{}/{}.tgz".format(tempfile.mkdtemp(dir=tmp_dir), export_id)
     master_api.update_export(tracker_id, {'tmpfile': outfile, 'state': 'fetch-running'})
 
     try:
 
-        cmd = f"curl -H 'Authorization: bearer {instances[instance]['nga_key']}' -Lo {outfile} {instances[instance]['nga_url']}/history/download/{export_id}/"
-        logger.debug(f'{tracker["id"]}: fetch-cmd: {cmd}')
-        run_cmd(cmd)
-        logger.debug('{tracker["id"]}: fetch cmd done')
+        logger.debug(f'{tracker["id"]}: fetching {export_id} into {outfile}')
+        api = instances[instance]['api']
+        # only the chunks not already fetched and verified are downloaded, the whole is checked at the end
+        sha256 = export_sha256(instance, export_id)
+        received = api.download_history_export(export_id, outfile, sha256=sha256)
+        logger.debug(f'{tracker["id"]}: fetch done, sha256 {received["sha256"]}{"" if sha256 else " (unverified)"}')
         master_api.update_export(tracker_id, {'tmpfile': outfile, 'state': 'fetch-ok'})
         submit_mq_job(tracker_id, "export")
 
@@ -202,6 +313,63 @@ def run_fetch_export(tracker):
     return
 
 
+def export_sha256(instance:str, export_id:str) -> str:
+    # the sha256 galaxy side of an export archive, None if the instance is too old to tell
+    if not instances[instance].get('export_sha256', True):
+        return None
+
+    try:
+        return instances[instance]['api'].get_history_export_sha256(export_id)['sha256']
+    except requests.HTTPError as e:
+        if e.response is None or e.response.status_code != 404:
+            raise
+
+    logger.info(f"{instance} has no export sha256, its archives are fetched unverified")
+    instances[instance]['export_sha256'] = False
+    return None
+
+
+def export_dest_file(tracker:{}) -> str:
+    # where in NeLS the export goes: <destination>/<history name>-<create time>.tgz
+    history = instances[tracker['instance']]['api'].get_history_export(export_id=tracker['export_id'])
+    logger.debug( f"{tracker['id']} history: {history}")
+    create_time = str(tracker['create_time']).replace("-", "").replace(":", "").replace(" ", "_")
+    create_time = re.sub(r'\.\d+', '', create_time)
+    history['name'] = history['name'].replace(" ", "_")
+    return f"{tracker['destination']}/{history['name']}-{create_time}.tgz"
+
+
+def run_stream_export( tracker ):
+    # the fetch and push in one go: the archive is streamed from galaxy straight into NeLS
+
+    tracker_id = tracker['id']
+    instance = tracker['instance']
+    logger.info(f'{tracker_id}: stream export start')
+
+    try:
+        master_api.update_export(tracker_id, {'state': 'nels-transfer-running'})
+
+        dest_file = export_dest_file(tracker)
+        logger.debug(f"{tracker_id} dest file: {dest_file}")
+
+        with nels_connection(tracker['nels_id']) as client:
+            chunks = instances[instance]['api'].iter_history_export(tracker['export_id'], chunk_size=sftp.chunk_size)
+            sent = sftp.upload(client, chunks, dest_file, buffer_size=stream_buffer)
+
+        logger.debug(f"{tracker_id}: streamed {sent['size']} bytes")
+        master_api.update_export(tracker_id, {'state': 'nels-transfer-ok', 'log': f"sha256 {sent['sha256']}"})
+        master_api.update_export(tracker_id, {'state': 'finished'})
+        logger.info(f'{tracker_id}: stream export done')
+
+    except requests.RequestException as e:
+        master_api.update_export(tracker_id, {'state': 'fetch-error', 'log': str(e)})
+        logger.error(f"{tracker_id} fetch error: {e}")
+
+    except Exception as e:
+        master_api.update_export(tracker_id, {'state': 'nels-transfer-error', 'log': str(e)})
+        logger.error(f"{tracker_id} transfer to NeLS error: {e}")
+
+
 def run_push_export( tracker ):
 
     tracker_id = tracker['id']
@@ -209,88 +377,68 @@ def run_push_export( tracker ):
 
     try:
 
-        instance = tracker['instance']
-
         master_api.update_export(tracker_id, {'state': 'nels-transfer-running'})
 
-        history = instances[instance]['api'].get_history_export(export_id=tracker['export_id'])
-        logger.debug( f"{tracker_id} history: {history}")
-        create_time = str(tracker['create_time']).replace("-", "").replace(":", "").replace(" ", "_")
-#        logger.debug( f'{tracker_id} Create time {create_time}')
-        create_time = re.sub(r'\.\d+', '', create_time)
-#        logger.debug( f'{tracker_id} Create time {create_time}')
-        history['name'] = history['name'].replace(" ", "_")
-        dest_file = f"{tracker['destination']}/{history['name']}-{create_time}.tgz"
+        dest_file = export_dest_file(tracker)
         logger.debug(f"{tracker_id} dest file: {dest_file}")
 
-        ssh_info = get_ssh_credential(tracker['nels_id'])
-#        logger.debug(f"{tracker_id} ssh info {ssh_info}")
+        # a retry carries on from what already made it to NeLS
+        with nels_connection(tracker['nels_id']) as client:
+            sent = sftp.put(client, tracker['tmpfile'], dest_file)
 
-        cmd = f'scp -o StrictHostKeyChecking=no -o BatchMode=yes -i {ssh_info["key_file"]} {tracker["tmpfile"]} "{ssh_info["username"]}@{ssh_info["hostname"]}:{dest_file}"'
-#        logger.debug(f"CMD: {cmd}")
-        run_cmd(cmd, 'push data')
-        master_api.update_export(tracker_id, {'state': 'nels-transfer-ok'})
-        cmd = f"rm {tracker['tmpfile']}"
+        master_api.update_export(tracker_id, {'state': 'nels-transfer-ok', 'log': f"sha256 {sent['sha256']}"})
+        os.remove(tracker['tmpfile'])
         master_api.update_export(tracker_id, {'state': 'finished'})
-        logger.debug(f"CMD: {cmd}")
-        run_cmd(cmd, 'cleanup')
         logger.info(f'{tracker_id}: push export done')
     except Exception as e:
-        import traceback
-        traceback.print_tb(e.__traceback__)
+        master_api.update_export(tracker_id, {'state': 'nels-transfer-error', 'log': str(e)})
+        logger.error(f"{tracker_id} transfer to NeLS error: {e}")
 
-        master_api.update_export(tracker_id, {'state': 'nels-transfer-error'})
-        logger.debug(f" tracker-id:{tracker['id']} transfer to NeLS error: {e}")
 
 
+def get_ssh_credential(nels_id: int, refresh: bool = False) -> {}:
+    # cached for a little while, and only kept in memory
+    return utils.nels_ssh_credential(nels_storage_url, nels_storage_client_key, nels_storage_client_secret,
+                                     nels_id, refresh=refresh)
 
-def get_ssh_credential(nels_id: int):
-    # make sure the id is a string
-    nels_id = str(nels_id)
-    #    api_url = 'https://nels.bioinfo.no/'
-    #    api_url = 'https://test-fe.cbu.uib.no/nels-'
 
-    api_url = nels_storage_url + "/users/" + nels_id
-#    logger.debug(f"API URL: {api_url}")
-    response = requests.get(api_url, auth=(nels_storage_client_key, nels_storage_client_secret))
-    if (response.status_code == requests.codes.ok):
-        json_response = response.json()
-        # write key to a tmp file
-        tmp = tempfile.NamedTemporaryFile(mode='w+t', suffix=".txt", dir=tmp_dir, delete=False)
-        tmp.write(json_response['key-rsa'])
-        tmp.close()
-        json_response['key_file'] = tmp.name
-        return json_response
-    else:
-        raise Exception("HTTP response code=%s" % str(response.status_code))
+@contextlib.contextmanager
+def nels_connection(nels_id: int):
+    # an sftp connection as the NeLS user. If the cached key is turned down it is fetched again, once
+    with contextlib.ExitStack() as stack:
+        try:
+            ssh_info = get_ssh_credential(nels_id)
+            client = stack.enter_context(sftp_pool.connection(ssh_info['hostname'], ssh_info['username'],
+                                                              ssh_info['key-rsa']))
+        except paramiko.AuthenticationException:
+            logger.info(f"NeLS key for {nels_id} was turned down, fetching it again")
+            ssh_info = get_ssh_credential(nels_id, refresh=True)
+            client = stack.enter_context(sftp_pool.connection(ssh_info['hostname'], ssh_info['username'],
+                                                              ssh_info['key-rsa']))
+        yield client
 
 
 def get_history_from_nels( tracker ):
 
     tracker_id = tracker['id']
-    logger.info(f'{tracker_id}: push export start')
+    logger.info(f'{tracker_id}: pull from NeLS start')
 
     try:
 
-        master_api.update_import(tracker_id, {'state': 'nels-transfer-running'})
-
-        tmpfile = "{}/{}.tgz".format(tempfile.mkdtemp(dir=tmp_dir), tracker['id'])
-        print( f"TMPFILE {tmpfile}")
+        # a requeued pull carries on with what is already fetched
+        tmpfile = tracker.get('tmpfile')
+        if tmpfile is None or not os.path.isdir(os.path.dirname(tmpfile)):
+            tmpfile = "{}/{}.tgz".format(tempfile.mkdtemp(dir=tmp_dir), tracker['id'])
+        master_api.update_import(tracker_id, {'state': 'nels-transfer-running', 'tmpfile': tmpfile})
 
-        ssh_info = get_ssh_credential(tracker['nels_id'])
-        logger.debug(f"{tracker_id} ssh info {ssh_info}")
+        with nels_connection(tracker['nels_id']) as client:
+            sftp.get(client, tracker['source'], tmpfile)
 
-        cmd = f'scp -o StrictHostKeyChecking=no -o BatchMode=yes -i {ssh_info["key_file"]} "{ssh_info["username"]}@{ssh_info["hostname"]}:{tracker["source"]}" {tmpfile}'
-        #        logger.debug(f"CMD: {cmd}")
-        run_cmd(cmd, 'pull data')
         master_api.update_import(tracker_id, {'state': 'nels-transfer-ok', 'tmpfile': tmpfile})
         submit_mq_job(tracker_id, "import")
     except Exception as e:
-        import traceback
-        traceback.print_tb(e.__traceback__)
-
-        master_api.update_import(tracker_id, {'state': 'nels-transfer-error'})
-        logger.debug(f" tracker-id:{tracker['id']} transfer to NeLS error: {e}")
+        master_api.update_import(tracker_id, {'state': 'nels-transfer-error', 'log': str(e)})
+        logger.error(f"{tracker_id} transfer from NeLS error: {e}")
 
 def import_history( tracker ):
 
@@ -328,32 +476,50 @@ def import_history( tracker ):
 
 
 
-def do_work(ch, method, properties, body):
+def ack(ch, delivery_tag:int) -> None:
+    # the channel is not thread safe, so the ack is done by the consumer thread
+    ch.connection.add_callback_threadsafe(functools.partial(ch.basic_ack, delivery_tag=delivery_tag))
 
-    logger.debug("Callback call::: Method %s Delivery tag: %s Message body: %s\n" % ( method, properties, body))
-    ch.basic_ack(delivery_tag=method.delivery_tag)
+
+def run_job(ch, delivery_tag:int, func, tracker:{}) -> None:
+    # the message is acked once the work is done, if the runner dies before that it is redelivered
+    try:
+        func(tracker)
+    finally:
+        ack(ch, delivery_tag)
+        logger.debug(f"workers: {pool.stats()}")
+        logger.debug(f"api hosts: {api_requests.stats()['hosts']}")
+        logger.debug(f"sftp: {sftp_pool.stats()}, credentials: {utils.ssh_credentials.stats()}")
 
 
+def dispatch(ch, delivery_tag:int, body) -> None:
+
     try:
         payload = json.loads(body)
     except Exception as e:
-        print( e )
+        logger.error(f"Invalid message {body}: {e}")
+        ack(ch, delivery_tag)
         return
 
-    if "tracker_id" not in payload and "type" not in payload:
+    if "tracker_id" not in payload or "type" not in payload:
         logger.error(f"Invalid message {payload}")
-        raise Exception(f"Invalid message {payload}")
+        ack(ch, delivery_tag)
         return
 
     tracker_id = payload['tracker_id']
     type = payload['type']
-    if type == 'export':
-        tracker = master_api.get_export( tracker_id )
-    elif type == 'import':
-        tracker = master_api.get_import( tracker_id )
-    else:
-        logger.error(f"Invalid type '{type}'")
-        raise Exception(f"Invalid type '{type}'")
+    try:
+        if type == 'export':
+            tracker = master_api.get_export( tracker_id )
+        elif type == 'import':
+            tracker = master_api.get_import( tracker_id )
+        else:
+            logger.error(f"Invalid type '{type}'")
+            ack(ch, delivery_tag)
+            return
+    except Exception as e:
+        logger.error(f"Cannot get {type} tracker {tracker_id}: {e}")
+        ack(ch, delivery_tag)
         return
 
 
@@ -363,19 +529,37 @@ def do_work(ch, method, properties, body):
     logger.debug(f"do_work tracker_id: {tracker_id} state: '{state}'")
 
     if type == 'export' and state == 'pre-queueing':
-        run_history_export( tracker )
+        stage, func = 'export', run_history_export
+    elif type == 'export' and state == 'ok' and stream_exports:
+        stage, func = 'push', run_stream_export
     elif type == 'export' and state == 'ok':
-        run_fetch_export( tracker )
+        stage, func = 'fetch', run_fetch_export
     elif type == 'export' and state == 'fetch-ok':
-        run_push_export( tracker )
-    elif state == 'finished':
-        pass
+        stage, func = 'push', run_push_export
     elif type == 'import' and state == 'pre-fetch':
-        get_history_from_nels(tracker)
+        stage, func = 'nels-fetch', get_history_from_nels
     elif type == 'import' and state == 'nels-transfer-ok':
-        import_history( tracker )
+        stage, func = 'import', import_history
     else:
-        logger.error(f"Unknown state {state} for tracker_id: {tracker_id}")
+        # a bulk-queued export is sent on by the master once it has a free archive slot
+        if state not in ['finished', 'bulk-queued']:
+            logger.error(f"Unknown state {state} for tracker_id: {tracker_id}")
+        ack(ch, delivery_tag)
+        return
+
+    keys = [f"stage:{stage}"]
+    if tracker.get('instance', None) is not None:
+        keys.append(f"instance:{tracker['instance']}")
+
+    if not pool.submit(keys, run_job, ch, delivery_tag, func, tracker):
+        logger.debug(f"{tracker_id}: waiting for a free {stage}/{tracker.get('instance', '')} worker")
+
+
+def do_work(ch, method, properties, body):
+
+    logger.debug("Callback call::: Method %s Delivery tag: %s Message body: %s\n" % ( method, properties, body))
+    # the consumer thread only hands the message over, the tracker is looked up and worked on in the pool
+    pool.submit([], dispatch, ch, method.delivery_tag, body)
 
 
 def main():
@@ -404,8 +588,17 @@ def main():
 
 
 
+    # enough unacked messages to keep the workers busy, with some to spare for the ones
+    # waiting on a stage or instance limit
     global mq
-    mq.connect(uri=config['mq_uri'], prefetch_count=1)
+    mq.connect(uri=config['mq_uri'], prefetch_count=config.get('prefetch_count', 2 * config.get('workers', 4)))
+
+    try:
+        reload_pending_exports()
+    except Exception as e:
+        logger.error(f"Could not reload the pending exports: {e}")
+
+    export_scheduler.start()
 
     try:
         mq.consume(route='default', callback=do_work)
@@ -413,8 +606,12 @@ def main():
     except KeyboardInterrupt:
         mq.channel.stop_consuming()
 
-    # Wait for all to complete
- #   logger.debug('waiting for threads')
+    # Wait for all to complete, and get their acks sent
+    logger.debug('waiting for workers')
+    export_scheduler.stop()
+    pool.shutdown(wait=True)
+    sftp_pool.close()
+    mq.channel.connection.process_data_events(time_limit=0)
     mq.channel.close()
 
 
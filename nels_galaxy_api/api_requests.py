@@ -1,10 +1,120 @@
 from requests import Request, Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import requests
 
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
 import json
+import os
+import re
+import threading
+import time
 import kbr.requests_utils as requests_utils
 
+import nels_galaxy_api.transfer as transfer
+
 # Basic library offering programatic access to nga rest-api.
 
+# One keep-alive session pr base url, shared by all ApiRequests talking to it. Set up by configure()
+pool_size = 10
+timeout = (5, 60)
+retries = 3
+backoff = 0.5
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_stats = {}
+_stats_lock = threading.Lock()
+
+# runs the requests of AsyncApiRequests, created on first use
+async_workers = 32
+_executor = None
+
+
+def configure(size:int=None, connect_timeout:float=None, read_timeout:float=None, max_retries:int=None,
+              backoff_factor:float=None) -> None:
+    global pool_size, timeout, retries, backoff
+    if size is not None:
+        pool_size = size
+    if connect_timeout is not None or read_timeout is not None:
+        timeout = (connect_timeout or timeout[0], read_timeout or timeout[1])
+    if max_retries is not None:
+        retries = max_retries
+    if backoff_factor is not None:
+        backoff = backoff_factor
+
+    # new settings, new sessions
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+def session(base_url:str) -> Session:
+    with _sessions_lock:
+        if base_url not in _sessions:
+            # only the idempotent verbs are retried, on connection errors and gateway type responses
+            retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=[502, 503, 504],
+                          allowed_methods=['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'], raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+            s = Session()
+            s.mount('http://', adapter)
+            s.mount('https://', adapter)
+            _sessions[base_url] = s
+
+        return _sessions[base_url]
+
+
+def _endpoint(call:str, path:str) -> str:
+    # ids and emails in the path are replaced, so calls to the same endpoint are counted together
+    path = re.sub(r'/[^/@]+@[^/]+', '/{email}', path)
+    path = re.sub(r'/(\d+|[0-9a-f]{16,})(?=/|$)', '/{id}', path)
+    return f"{call} {path}"
+
+
+def _record(endpoint:str, elapsed:float, failed:bool) -> None:
+    with _stats_lock:
+        stat = _stats.setdefault(endpoint, {'calls': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+        stat['calls'] += 1
+        stat['errors'] += failed
+        stat['total_ms'] += elapsed * 1000
+        stat['max_ms'] = max(stat['max_ms'], elapsed * 1000)
+
+
+def _connections(s:Session) -> (int, int):
+    # (requests, new connections) made through the pools of a session
+    made = opened = 0
+    # the same adapter is mounted for http and https
+    for adapter in set(s.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            if pool is not None:
+                made += pool.num_requests
+                opened += pool.num_connections
+    return made, opened
+
+
+def stats() -> {}:
+    with _stats_lock:
+        endpoints = {endpoint: dict(stat, mean_ms=stat['total_ms'] / stat['calls']) for endpoint, stat in _stats.items()}
+
+    hosts = {}
+    with _sessions_lock:
+        for base_url, s in _sessions.items():
+            made, opened = _connections(s)
+            hosts[base_url] = {'requests': made, 'connections': opened, 'reused': max(made - opened, 0)}
+
+    return {'endpoints': endpoints, 'hosts': hosts}
+
+
+def reset_stats() -> None:
+    with _stats_lock:
+        _stats.clear()
+
+
 class ApiRequests( object ):
     def __init__(self, base_url:str, token:str=None):
         self._token = token
@@ -13,9 +123,10 @@ class ApiRequests( object ):
     def set_token(new_token:str):
         self._token = new_token
 
-    def _request_get(self, url:str, as_json:bool=True, data:{}=None):
+    def _request_get(self, url:str, as_json:bool=True, data:{}=None, read_timeout:float=None):
 
-        return self._generic_request(url, as_json, call='GET', data=data, send_as_json=False)
+        return self._generic_request(url, as_json, call='GET', data=data, send_as_json=False,
+                                     read_timeout=read_timeout)
 
     def _request_post(self, url:str, data:{}):
         return self._generic_request(url, call='POST', data=data)
@@ -29,9 +140,10 @@ class ApiRequests( object ):
 
 
 
-    def _generic_request(self, url:str, as_json:bool=True, call='GET', data:{}=None, send_as_json:bool=True):
+    def _generic_request(self, url:str, as_json:bool=True, call='GET', data:{}=None, send_as_json:bool=True,
+                         read_timeout:float=None):
 
-        s = Session()
+        s = session(self._base_url)
         if send_as_json:
             req = Request(call,  url, json=data)
         else:
@@ -42,7 +154,14 @@ class ApiRequests( object ):
         if self._token is not None:
             prepped.headers['Authorization'] = f"bearer {self._token}"
 
-        r = s.send(prepped)
+        start = time.time()
+        failed = True
+        try:
+            r = s.send(prepped, timeout=timeout if read_timeout is None else (timeout[0], read_timeout))
+            failed = not r.ok
+        finally:
+            _record(_endpoint(call, url[len(self._base_url):]), time.time() - start, failed)
+
 #        print( f"Status code {r.status_code}" )
         r.raise_for_status()
 
@@ -70,6 +189,14 @@ class ApiRequests( object ):
         return self._request_get(f"{self._base_url}/user/{user_id}/")
 
 
+    def get_users_histories(self) -> []:
+        # the histories of all users, each with the email of its user
+        return self._request_get(f"{self._base_url}/users/histories/")
+
+    def get_users_exports(self) -> []:
+        # the latest export of every history, each with the email of its user
+        return self._request_get(f"{self._base_url}/users/exports/")
+
     def get_session_exports(self) -> []:
         return self._request_get(f"{self._base_url}/user/exports/")
 
@@ -100,6 +227,84 @@ class ApiRequests( object ):
         else:
             raise RuntimeError('provide either export_id or history_id.')
 
+    def download_history_export(self, export_id:str, outfile:str, chunk_size:int=1024*1024, retries:int=5,
+                                sha256:str=None) -> {}:
+        # Fetches the export archive into outfile. What is in outfile already is checked against
+        # its progress file (see transfer.py) and only the rest is asked for, also when the
+        # connection drops half way through. If sha256 is given the whole file is verified against
+        # it, and a bad one is removed so the next attempt starts over.
+        progress = transfer.Transfer(outfile)
+        offset = progress.resume()
+
+        with open(outfile, 'r+b' if offset else 'wb') as f:
+            f.truncate(offset)
+            f.seek(offset)
+            for chunk in self.iter_history_export(export_id, chunk_size, retries, offset=offset):
+                f.write(chunk)
+                progress.add(chunk, f)
+
+        if sha256 is not None and progress.sha256 != sha256:
+            received = progress.sha256
+            progress.reset()
+            os.remove(outfile)
+            raise RuntimeError(f"download of {export_id} has sha256 {received}, expected {sha256}")
+
+        progress.done()
+        return {'size': progress.offset, 'sha256': progress.sha256}
+
+    def get_history_export_sha256(self, export_id:str) -> {}:
+        # {'sha256', 'size'} of the export archive, can take a while on a large one not asked for before
+        return self._request_get(f"{self._base_url}/history/download/{export_id}/sha256/", read_timeout=900)
+
+    def iter_history_export(self, export_id:str, chunk_size:int=1024*1024, retries:int=5, offset:int=0):
+        # The export archive as a stream of chunks, from offset on. If the connection drops, the
+        # rest is asked for with a Range request, so no chunk is sent twice.
+        url = f"{self._base_url}/history/download/{export_id}/"
+        etag = None
+
+        for attempt in range(retries + 1):
+            headers = {}
+            if self._token is not None:
+                headers['Authorization'] = f"bearer {self._token}"
+            if offset:
+                headers['Range'] = f"bytes={offset}-"
+                if etag is not None:
+                    headers['If-Range'] = etag
+
+            try:
+                with session(self._base_url).get(url, headers=headers, stream=True, timeout=(timeout[0], 300)) as r:
+                    if r.status_code == 416 and offset:
+                        return
+
+                    r.raise_for_status()
+                    if offset and r.status_code != 206:
+                        # the whole (changed) file again, what has been sent cannot be taken back
+                        raise RuntimeError(f"download of {export_id} cannot be resumed at {offset}")
+
+                    etag = r.headers.get('Etag', etag)
+                    expected = r.headers.get('Content-Length')
+                    received = 0
+                    for chunk in r.iter_content(chunk_size=chunk_size):
+                        received += len(chunk)
+                        offset += len(chunk)
+                        yield chunk
+
+                    if expected is None or received == int(expected):
+                        return
+
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError):
+                if attempt == retries:
+                    raise
+
+            time.sleep(min(2 ** attempt, 30))
+
+        raise RuntimeError(f"download of {export_id} incomplete after {retries} retries")
+
+    def get_history_exports_status(self, export_ids:[]=None, history_ids:[]=None) -> []:
+        # the exports asked for, and the latest export of each of the histories, in one go
+        return self._request_post(f"{self._base_url}/history/exports/status/",
+                                  data={'export_ids': export_ids or [], 'history_ids': history_ids or []})
+
     def history_export_request(self) -> {}:
         return self._request_get(f"{self._base_url}/history/export/request/")
 
@@ -123,8 +328,12 @@ class ApiRequests( object ):
 
 
     def add_bulk_export(self, instance:str, user:str, data:{}):
+        # data: nels_id, destination and optionally history_ids, all the user's histories by default
         return self._request_post(f"{self._base_url}/export/{instance}/{user}/bulk/", data)
 
+    def get_bulk_export(self, bulk_id:str) -> {}:
+        return self._request_get(f"{self._base_url}/export/bulk/{bulk_id}/")
+
     def get_export(self, tracking_id:str):
         return self._request_get(f"{self._base_url}/export/{tracking_id}/")
 
@@ -151,12 +360,46 @@ class ApiRequests( object ):
     def get_instance_exports(self, instance:str, filter=None):
         return self._request_get(f"{self._base_url}/exports/all/{instance}/", data=filter)
 
-    def get_exports(self):
-        return self._request_get(f"{self._base_url}/exports/")
+    def get_exports(self, filter:{}=None):
+        return self._request_get(f"{self._base_url}/exports/", data=filter)
 
     def get_imports(self):
         return self._request_get(f"{self._base_url}/imports/")
 
+    def _pages(self, url:str, filter:{}=None, page_size:int=1000):
+        # lazily pages through a keyset paginated list, a request pr page_size entries
+        filter = dict(filter or {})
+        filter['limit'] = page_size
+
+        while True:
+            page = self._request_get(url, data=filter) or []
+            yield from page
+
+            if len(page) < page_size:
+                return
+
+            filter['after_id'] = page[-1]['id']
+
+    def iter_exports(self, filter:{}=None, user:str=None, instance:str=None, page_size:int=1000):
+        # the export trackings, fetched a page at the time. filter can have state, since and until
+        if instance is not None:
+            url = f"{self._base_url}/exports/{user or 'all'}/{instance}/"
+        elif user is not None:
+            url = f"{self._base_url}/exports/{user}/"
+        else:
+            url = f"{self._base_url}/exports/"
+
+        return self._pages(url, filter, page_size)
+
+    def iter_imports(self, filter:{}=None, user:str=None, page_size:int=1000):
+        # the import trackings, fetched a page at the time. filter can have state, since and until
+        if user is not None:
+            url = f"{self._base_url}/imports/{user}/"
+        else:
+            url = f"{self._base_url}/imports/"
+
+        return self._pages(url, filter, page_size)
+
     def get_proxy(self):
         return self._request_get(f"{self._base_url}/proxy/")
 
@@ -164,6 +407,48 @@ class ApiRequests( object ):
         return self._request_get(f"{self._base_url}/jobs/", data=filter, as_json=True)
 
 
+class AsyncApiRequests( ApiRequests ):
+    # Same methods as ApiRequests, but they are coroutines, and iter_exports/iter_imports are async
+    # generators (the archive download ones are sync only). The requests themselves are made in a
+    # thread pool over the same keep-alive sessions, so many can be in flight at once.
+
+    async def _generic_request(self, url:str, as_json:bool=True, call='GET', data:{}=None, send_as_json:bool=True,
+                               read_timeout:float=None):
+        global _executor
+        if _executor is None:
+            _executor = ThreadPoolExecutor(async_workers, 'nga-api')
+
+        request = functools.partial(ApiRequests._generic_request, self, url, as_json, call, data, send_as_json,
+                                    read_timeout)
+        return await asyncio.get_running_loop().run_in_executor(_executor, request)
+
+    async def _pages(self, url:str, filter:{}=None, page_size:int=1000):
+        # async version of ApiRequests._pages, for async for
+        filter = dict(filter or {})
+        filter['limit'] = page_size
+
+        while True:
+            page = await self._request_get(url, data=filter) or []
+            for entry in page:
+                yield entry
+
+            if len(page) < page_size:
+                return
+
+            filter['after_id'] = page[-1]['id']
+
+
+async def gather(coroutines:[], limit:int=10) -> []:
+    # like asyncio.gather, but with at most limit of the coroutines running at the same time
+    semaphore = asyncio.Semaphore(limit)
+
+    async def limited(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*[limited(coroutine) for coroutine in coroutines])
+
+
 # Need these as the request thingy has changed slightly, prob not anymore!
 def set_token(new_token:str):
     requests_utils.set_token( new_token)
@@ -0,0 +1,70 @@
+import collections
+import threading
+import time
+
+# Small in-process caches. TTLCache is a size bounded LRU where entries also expire after ttl seconds.
+
+
+class TTLCache(object):
+
+    def __init__(self, size: int = 1000, ttl: float = 60):
+        self._size = size
+        self._ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, size: int = None, ttl: float = None) -> None:
+        if size is not None:
+            self._size = size
+        if ttl is not None:
+            self._ttl = ttl
+
+        self.clear()
+
+    def get(self, key: any, default: any = None) -> any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: any, value: any) -> None:
+        if self._size <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self._ttl)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: any) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> {}:
+        return {'size': len(self._entries),
+                'max_size': self._size,
+                'ttl': self._ttl,
+                'hits': self.hits,
+                'misses': self.misses}
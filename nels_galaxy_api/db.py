@@ -1,42 +1,463 @@
-import kbr.db_utils as db
+import kbr.log_utils as logger
+import collections
+import contextlib
 import datetime
+import re
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+import psycopg2.extras
+from psycopg2 import sql
+from tornado.ioloop import IOLoop
+from tornado.locks import Semaphore
+
+import nels_galaxy_api.migrations as migrations
+import nels_galaxy_api.queries as queries
 
 # Manages all database registries related to importing/exporting (and smaller ones required)
 
+# size of the log column in the tracking log tables
+log_size = 80
+
+# the states of a bulk export tracking with its archive being built, at most archive_jobs of the bulk
+# are in one of these at a time
+bulk_building_states = ['pre-queueing', 'new', 'upload', 'waiting', 'queued', 'running']
+# advisory lock serialising the releases of a bulk, the bulk id is the second key
+bulk_lock_id = 4242002
+
+
+def statement_timeout_url(url: str, statement_timeout: int = None) -> str:
+    # Adds a libpq statement_timeout (ms) to the connection url, so it applies to every session
+    if statement_timeout is None:
+        return url
+
+    options = urllib.parse.quote(f"-c statement_timeout={int(statement_timeout)}")
+    separator = '&' if '?' in url else '?'
+    return f"{url}{separator}options={options}"
+
+
+def libpq_url(url: str) -> str:
+    # sqlalchemy style urls can name the driver (postgresql+psycopg2://), libpq does not understand that
+    return re.sub(r'^(postgres(?:ql)?)\+\w+://', r'\1://', url)
+
+
+class TrackingLogWriter(object):
+    # Write-behind for the tracking state change logs. Entries are queued in the order they are
+    # added and written as multi-row inserts from a background thread, when batch_size are
+    # waiting, every flush_interval seconds and on close. A single queue, flushed in order, keeps
+    # the entries of a tracking in the order they were made. The writer has its own connection.
+    # The log rows are written after the state update they belong to has committed, and not in the
+    # same transaction: a crash in between, or a batch dropped, leaves the state without its log.
+    # A batch that fails max_retries flushes in a row is dropped, as are entries added while
+    # max_pending are waiting, both are logged and counted in dropped.
+
+    def __init__(self, url: str, statement_timeout: int = None, batch_size: int = 500,
+                 flush_interval: float = 1.0, max_retries: int = 5, max_pending: int = 100000):
+        self._url = statement_timeout_url(url, statement_timeout)
+        self._conn = None
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._max_retries = max_retries
+        self._max_pending = max_pending
+        self._retries = 0
+        self._full = False
+
+        self._pending = collections.deque()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+
+        self.written = 0
+        self.batches = 0
+        self.failures = 0
+        self.dropped = 0
+
+        self._thread = threading.Thread(target=self._run, name='nga-log-writer', daemon=True)
+        self._thread.start()
+
+    def add(self, table: str, tracking_id: int, create_time: datetime.datetime, log: str) -> None:
+        with self._lock:
+            if len(self._pending) >= self._max_pending:
+                # logged once as the queue fills up, not for every entry after that
+                if not self._full:
+                    logger.error(f"tracking log queue full ({self._max_pending}), dropping new entries")
+                    self._full = True
+                self.dropped += 1
+                return
+
+            self._full = False
+            self._pending.append((table, (create_time, tracking_id, log)))
+            if len(self._pending) >= self._batch_size:
+                self._wakeup.set()
+
+    def _connection(self):
+        if self._conn is None or self._conn.closed:
+            self._conn = psycopg2.connect(libpq_url(self._url))
+
+        return self._conn
+
+    def flush(self) -> int:
+        # writes what is queued, returns the number of entries written
+        with self._flush_lock:
+            with self._lock:
+                entries = list(self._pending)
+                self._pending.clear()
+
+            if not entries:
+                return 0
+
+            tables = {}
+            for table, row in entries:
+                tables.setdefault(table, []).append(row)
+
+            try:
+                conn = self._connection()
+                with conn, conn.cursor() as cursor:
+                    for table, rows in tables.items():
+                        q = sql.SQL("INSERT INTO {} (create_time, tracking_id, log) VALUES %s").format(
+                            sql.Identifier(table))
+                        psycopg2.extras.execute_values(cursor, q, rows, page_size=len(rows))
+            except Exception as e:
+                self.failures += 1
+                self._retries += 1
+                if self._retries >= self._max_retries:
+                    logger.error(f"writing tracking logs failed {self._retries} times, dropping {len(entries)} entries: {e}")
+                    self.dropped += len(entries)
+                    self._retries = 0
+                    raise
+
+                # back at the front of the queue, ahead of anything added since
+                with self._lock:
+                    self._pending.extendleft(reversed(entries))
+                raise
+
+            self._retries = 0
+            self.written += len(entries)
+            self.batches += 1
+            return len(entries)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._wakeup.wait(self._flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"writing tracking logs failed: {e}")
+
+    def close(self) -> None:
+        self._stop.set()
+        self._wakeup.set()
+        self._thread.join()
+
+        try:
+            self.flush()
+        except Exception as e:
+            logger.error(f"writing tracking logs failed, {len(self._pending)} entries lost: {e}")
+
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def stats(self) -> {}:
+        return {'pending': len(self._pending),
+                'written': self.written,
+                'batches': self.batches,
+                'failures': self.failures,
+                'dropped': self.dropped}
+
+
 class DB(object):
 
-    def connect(self, url: str) -> None:
-        self._db = db.DB(url)
+    # state change logs go through this when set, otherwise they are written straight away
+    log_writer = None
+
+    def connect(self, url: str, statement_timeout: int = None) -> None:
+        # the connection is opened on first use, and is the only one this DB has
+        self._url = statement_timeout_url(url, statement_timeout)
+        self._conn = None
+        self._prepared = set()
 
     def disconnect(self) -> None:
 
-        if self._db is not None:
-            self._db.close()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _connection(self):
+        if self._conn is None or self._conn.closed:
+            self._conn = psycopg2.connect(libpq_url(self._url))
+            self._conn.autocommit = True
+            self._prepared = set()
+
+        return self._conn
+
+    def _query(self, name: str, *params) -> []:
+        # runs a query from the catalog as a prepared statement on this DB's own connection
+        conn = self._connection()
+        try:
+            return queries.execute(conn, self._prepared, name, params)
+        except psycopg2.Error:
+            if conn.closed:
+                self._conn = None
+            raise
+
+    def stream(self, name: str, *params, chunk_size: int = 1000):
+        # a catalog query read in chunks through a server side cursor, see queries.stream
+        conn = self._connection()
+        try:
+            yield from queries.stream(conn, name, params, chunk_size)
+        except psycopg2.Error:
+            if conn.closed:
+                self._conn = None
+            raise
+
+    def _execute(self, query: sql.Composable, params: []) -> []:
+        # a single statement on this DB's own connection, in autocommit mode it is its own transaction
+        conn = self._connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(query, params)
+                if cursor.description is None:
+                    return []
+                return cursor.fetchall()
+        except psycopg2.Error:
+            if conn.closed:
+                self._conn = None
+            raise
+
+    def _rows(self, query: sql.Composable, params: []) -> []:
+        # as _execute, with the rows as dicts
+        conn = self._connection()
+        try:
+            with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+                cursor.execute(query, params)
+                if cursor.description is None:
+                    return []
+                return [dict(row) for row in cursor.fetchall()]
+        except psycopg2.Error:
+            if conn.closed:
+                self._conn = None
+            raise
+
+    def _get(self, table: str, order: str = None, limit: int = None, **values) -> []:
+        # the rows of table matching all the values
+        q = sql.SQL("SELECT * FROM {}").format(sql.Identifier(table))
+        if values:
+            q += sql.SQL(" WHERE ") + sql.SQL(" AND ").join(
+                sql.SQL("{} = %s").format(sql.Identifier(column)) for column in values)
+        if order is not None:
+            q += sql.SQL(" ORDER BY " + order)
+        if limit is not None:
+            q += sql.SQL(" LIMIT %s")
+
+        return self._rows(q, list(values.values()) + ([limit] if limit is not None else []))
+
+    def _get_single(self, table: str, **values) -> {}:
+        rows = self._get(table, limit=1, **values)
+        return rows[0] if rows else None
+
+    def _add(self, table: str, values: {}) -> None:
+        self._execute(sql.SQL("INSERT INTO {} ({}) VALUES ({})").format(
+            sql.Identifier(table),
+            sql.SQL(', ').join(map(sql.Identifier, values)),
+            sql.SQL(', ').join(sql.Placeholder() * len(values))), list(values.values()))
+
+    def _update(self, table: str, values: {}, conditions: {}) -> None:
+        self._execute(sql.SQL("UPDATE {} SET {} WHERE {}").format(
+            sql.Identifier(table),
+            sql.SQL(', ').join(sql.SQL("{} = %s").format(sql.Identifier(column)) for column in values),
+            sql.SQL(" AND ").join(sql.SQL("{} = %s").format(sql.Identifier(column)) for column in conditions)),
+            list(values.values()) + list(conditions.values()))
+
+    def _do(self, q: str) -> None:
+        self._execute(sql.SQL(q), [])
+
+    def _log_entry(self, state: str, log: str = None) -> str:
+        if log is None:
+            log = f"Changed state to {state}"
+
+        # a log too long for the column would fail the whole tracking update
+        return log[:log_size]
+
+    def _add_tracking(self, table: str, values: {}, created_log: bool = True) -> int:
+        # inserts the tracking row, and its "Created" log entry, in one statement. RETURNING gives
+        # the new id without selecting the row back.
+        values['create_time'] = datetime.datetime.now()
+        log = values.pop('log', None)
+
+        columns = list(values.keys())
+        insert = sql.SQL("INSERT INTO {table} ({columns}) VALUES ({values}) RETURNING id").format(
+            table=sql.Identifier(table),
+            columns=sql.SQL(', ').join(map(sql.Identifier, columns)),
+            values=sql.SQL(', ').join(sql.Placeholder() * len(columns)))
+        params = [values[column] for column in columns]
+
+        if not created_log:
+            return self._execute(insert, params)[0][0]
+
+        q = sql.SQL('''WITH tracking AS ({insert}),
+                            log AS (INSERT INTO {log_table} (create_time, tracking_id, log)
+                                    SELECT %s, id, %s FROM tracking)
+                       SELECT id FROM tracking''').format(insert=insert, log_table=sql.Identifier(f"{table}_log"))
+        params += [values['create_time'], self._log_entry('Created', log)]
+
+        return self._execute(q, params)[0][0]
+
+    def _update_tracking(self, table: str, tracking_id: int, values: {}) -> None:
+        # updates the tracking row, and logs the state if it changed. The update returns the state
+        # it replaced, so the pollers setting the same state over and over do not fill the log.
+        values['update_time'] = datetime.datetime.now()
+        log = values.pop('log', None)
+
+        columns = list(values.keys())
+        update = sql.SQL('''UPDATE {table} AS tracking SET {columns}
+                            FROM old
+                            WHERE tracking.id = old.id
+                            RETURNING old.state''').format(
+            table=sql.Identifier(table),
+            columns=sql.SQL(', ').join(sql.SQL("{} = %s").format(sql.Identifier(column)) for column in columns))
+        params = [tracking_id] + [values[column] for column in columns]
+
+        if 'state' in values and self.log_writer is None:
+            # the update and its log entry in one statement, so one round-trip and one transaction.
+            # An explicit log is kept even if the state is the same
+            q = sql.SQL('''WITH old AS (SELECT id, state FROM {table} WHERE id = %s FOR UPDATE),
+                                upd AS ({update})
+                           INSERT INTO {log_table} (create_time, tracking_id, log)
+                           SELECT %s, %s, %s FROM upd
+                           WHERE upd.state IS DISTINCT FROM %s OR %s''').format(
+                table=sql.Identifier(table), update=update, log_table=sql.Identifier(f"{table}_log"))
+            params += [values['update_time'], tracking_id, self._log_entry(values['state'], log),
+                       values['state'], log is not None]
+            self._execute(q, params)
+            return
+
+        q = sql.SQL("WITH old AS (SELECT id, state FROM {table} WHERE id = %s FOR UPDATE) {update}").format(
+            table=sql.Identifier(table), update=update)
+        rows = self._execute(q, params)
+
+        if 'state' not in values or not rows:
+            return
+
+        if rows[0][0] == values['state'] and log is None:
+            return
+
+        # through the log_writer, so written after the update has committed and not atomic with it
+        self._add_log(f"{table}_log", tracking_id, values['update_time'], self._log_entry(values['state'], log))
+
+    def _add_log(self, table: str, tracking_id: int, create_time: datetime.datetime, log: str) -> None:
+        # with a log_writer the entry is written later, after and apart from the change it logs
+        if self.log_writer is not None:
+            self.log_writer.add(table, tracking_id, create_time, log)
+            return
+
+        self._execute(sql.SQL("INSERT INTO {} (create_time, tracking_id, log) VALUES (%s, %s, %s)").format(
+            sql.Identifier(table)), [create_time, tracking_id, log])
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # the connection runs in autocommit mode, so transactions are started explicitly
+        conn = self._connection()
+        cursor = conn.cursor()
+        cursor.execute("BEGIN")
+        try:
+            yield cursor
+            cursor.execute("COMMIT")
+        except Exception:
+            if not conn.closed:
+                cursor.execute("ROLLBACK")
+            else:
+                self._conn = None
+            raise
+        finally:
+            cursor.close()
 
     def table_exist(self, name: str) -> bool:
-        q = f"SELECT to_regclass('{name}')"
-        table = self._db.get_as_dict(q)
+        table = self._query('table_exist', name)
         if table[0]['to_regclass'] is None:
             return False
 
         return True
 
+    def create_schema_version_table(self) -> None:
+        if self.table_exist('nels_schema_version'):
+            return
+
+        q = '''CREATE TABLE IF NOT EXISTS nels_schema_version (
+              version        INT PRIMARY KEY,
+              description    VARCHAR(200),
+              applied        TIMESTAMP
+              );
+            '''
+        self._do(q)
+
+    def get_schema_versions(self) -> []:
+        return [entry['version'] for entry in self._get('nels_schema_version')]
+
+    def migrate(self) -> []:
+        # applies the pending migrations whose tables exist, returns the versions applied
+        self.create_schema_version_table()
+
+        applied = []
+        for migration in migrations.migrations:
+            if not all(self.table_exist(table) for table in migration.tables):
+                continue
+
+            with self._transaction() as cursor:
+                cursor.execute("SELECT pg_advisory_xact_lock(%s)", [migrations.lock_id])
+                cursor.execute("SELECT 1 FROM nels_schema_version WHERE version = %s", [migration.version])
+                if cursor.fetchone() is not None:
+                    continue
+
+                for statement in migration.statements:
+                    cursor.execute(statement)
+
+                cursor.execute("INSERT INTO nels_schema_version (version, description, applied) VALUES (%s, %s, %s)",
+                               [migration.version, migration.description, datetime.datetime.now()])
+                applied.append(migration.version)
+
+        return applied
+
+    def missing_galaxy_indexes(self) -> []:
+        # (table, column) pairs from migrations.galaxy_indexes without an index leading with the column
+        indexed = set()
+        for entry in self._query('leading_index_columns', [table for table, _ in migrations.galaxy_indexes]):
+            indexed.add((entry['table_name'], entry['column_name']))
+
+        missing = []
+        for table, column in migrations.galaxy_indexes:
+            if self.table_exist(table) and (table, column) not in indexed:
+                missing.append((table, column))
+
+        return missing
+
     def get_session(self, session_key: str) -> bool:
 
-        return self._db.get('galaxy_session', session_key=session_key)
+        return self._get('galaxy_session', session_key=session_key)
 
     def _init_user_tos(self, user_id: int) -> {}:
-        self._db.add('nels_tos', {'user_id': user_id,
+        self._add('nels_tos', {'user_id': user_id,
                                   'status': 'grace',
                                   'tos_date': datetime.datetime.now() + datetime.timedelta(days=14)})
 
+    def get_session_valid(self, session_key: str) -> bool:
+        rows = self._query('session_valid', session_key)
+        return len(rows) == 1 and rows[0]['is_valid'] is True
+
     def get_user_tos(self, session_key: str) -> {}:
         session = self.get_session(session_key)
 
-        if session is None or session[0]['is_valid'] != True or session[0]['user_id'] is None:
+        if not session or session[0]['is_valid'] != True or session[0]['user_id'] is None:
             return None
 
-        tos = self._db.get('nels_tos', user_id=session[0]['user_id'])
+        tos = self._get('nels_tos', user_id=session[0]['user_id'])
 
         if len(tos) == 0:
             self._init_user_tos(session[0]['user_id'])
@@ -49,10 +470,10 @@ class DB(object):
     def get_user_from_session(self, session_key: str) -> {}:
         session = self.get_session(session_key)
 
-        if session is None or session[0]['is_valid'] != True or session[0]['user_id'] is None:
+        if not session or session[0]['is_valid'] != True or session[0]['user_id'] is None:
             return None
 
-        user = self._db.get('galaxy_user', id=session[0]['user_id'])
+        user = self._get('galaxy_user', id=session[0]['user_id'])
 
         if len(user) == 0:
             self._init_user_tos(session[0]['user_id'])
@@ -65,10 +486,10 @@ class DB(object):
         return user
 
     def get_user(self, **values) -> {}:
-        return self._db.get('galaxy_user', **values)
+        return self._get('galaxy_user', **values)
 
     def update_tos(self, tos: dict) -> None:
-        self._db.update('nels_tos', tos, {'id': tos['id']})
+        self._update('nels_tos', tos, {'id': tos['id']})
 
     def create_tos_table(self) -> None:
         if self.table_exist('nels_tos'):
@@ -81,7 +502,7 @@ class DB(object):
               tos_date       TIMESTAMP
               );
             '''
-        self._db.do(q)
+        self._do(q)
 
     def create_export_tracking_table(self) -> None:
         if self.table_exist('nels_export_tracking'):
@@ -102,34 +523,106 @@ class DB(object):
               show           BOOL DEFAULT 'true'
               );
             '''
-        self._db.do(q)
+        self._do(q)
 
     def add_export_tracking(self, values):
-        values['create_time'] = datetime.datetime.now()
-
-        log = None
-        if 'log' in values:
-            log = values['log']
-            del values['log']
-
-        self._db.add('nels_export_tracking', values)
-        tracking_id = self._db.get_id('nels_export_tracking', **values)
-  #      self.add_export_tracking_log(tracking_id, state="Created", log)
-        return tracking_id
+        return self._add_tracking('nels_export_tracking', values, created_log=False)
 
 
     def update_export_tracking(self, tracking_id: int, values: {}):
-        values['update_time'] = datetime.datetime.now()
-
-        log = None
-        if 'log' in values:
-            log = values['log']
-            del values['log']
-
-        self._db.update('nels_export_tracking', values, {'id': tracking_id})
-        if 'state' in values:
-            self.add_export_tracking_log(tracking_id, state=values['state'], log=log)
+        self._update_tracking('nels_export_tracking', tracking_id, values)
+
+
+    def add_bulk_export_trackings(self, bulk: {}, history_ids: [], archive_jobs: int) -> ():
+        # registers the bulk and a tracking pr history in one transaction. The trackings wait in the
+        # bulk-queued state, the first archive_jobs of them are released straight away. Returns the
+        # bulk id and the ids of the trackings released.
+        now = datetime.datetime.now()
+        with self._transaction() as cursor:
+            cursor.execute('''INSERT INTO nels_export_bulk (instance, user_email, nels_id, destination, create_time)
+                              VALUES (%s, %s, %s, %s, %s) RETURNING id''',
+                           [bulk['instance'], bulk['user_email'], bulk['nels_id'], bulk['destination'], now])
+            bulk_id = cursor.fetchone()[0]
+
+            psycopg2.extras.execute_values(
+                cursor,
+                '''INSERT INTO nels_export_tracking (instance, user_email, history_id, state, nels_id, destination,
+                                                   create_time, bulk_id) VALUES %s''',
+                [(bulk['instance'], bulk['user_email'], history_id, 'bulk-queued', bulk['nels_id'],
+                  bulk['destination'], now, bulk_id) for history_id in history_ids])
+
+            return bulk_id, self._release_bulk_exports(cursor, bulk_id, archive_jobs)
+
+    def release_bulk_exports(self, tracking_id: int, archive_jobs: int) -> []:
+        # the tracking is done with its archive, releases the next ones of its bulk (if it is in one)
+        rows = self._execute(sql.SQL("SELECT bulk_id FROM nels_export_tracking WHERE id = %s"), [tracking_id])
+        if not rows or rows[0][0] is None:
+            return []
+
+        with self._transaction() as cursor:
+            return self._release_bulk_exports(cursor, rows[0][0], archive_jobs)
+
+    def release_queued_bulk_exports(self, archive_jobs: int) -> []:
+        # releases what there is room for in all the bulks with trackings waiting, this picks up bulks
+        # left stalled by a release that failed
+        rows = self._execute(sql.SQL("SELECT DISTINCT bulk_id FROM nels_export_tracking WHERE state = 'bulk-queued'"), [])
+
+        released = []
+        for bulk_id, in rows:
+            with self._transaction() as cursor:
+                released += self._release_bulk_exports(cursor, bulk_id, archive_jobs)
+
+        return released
+
+    def requeue_bulk_exports(self, tracking_ids: []) -> []:
+        # puts released trackings that never made it to the runner back in the bulk queue
+        now = datetime.datetime.now()
+        rows = self._execute(sql.SQL('''WITH requeued AS (
+                                           UPDATE nels_export_tracking SET state = 'bulk-queued', update_time = %s
+                                           WHERE id = ANY(%s) AND state = 'pre-queueing'
+                                           RETURNING id),
+                                        log AS (INSERT INTO nels_export_tracking_log (create_time, tracking_id, log)
+                                                SELECT %s, id, %s FROM requeued)
+                                        SELECT id FROM requeued ORDER BY id'''),
+                             [now, list(tracking_ids), now, self._log_entry('bulk-queued')])
+        return [row[0] for row in rows]
+
+    def _release_bulk_exports(self, cursor, bulk_id: int, archive_jobs: int) -> []:
+        # moves queued trackings of the bulk on to pre-queueing, so at most archive_jobs of them have an
+        # archive being built at a time. Serialised pr bulk, or two releases could both take the last slot.
+        cursor.execute("SELECT pg_advisory_xact_lock(%s, %s)", [bulk_lock_id, bulk_id])
+
+        now = datetime.datetime.now()
+        cursor.execute('''WITH released AS (
+                             UPDATE nels_export_tracking SET state = 'pre-queueing', update_time = %s
+                             WHERE id IN (SELECT id FROM nels_export_tracking
+                                          WHERE bulk_id = %s AND state = 'bulk-queued'
+                                          ORDER BY id
+                                          LIMIT greatest(%s - (SELECT count(*) FROM nels_export_tracking
+                                                               WHERE bulk_id = %s AND state = ANY(%s)), 0))
+                             RETURNING id),
+                          log AS (INSERT INTO nels_export_tracking_log (create_time, tracking_id, log)
+                                  SELECT %s, id, %s FROM released)
+                          SELECT id FROM released ORDER BY id''',
+                       [now, bulk_id, archive_jobs, bulk_id, bulk_building_states, now,
+                        self._log_entry('pre-queueing')])
+
+        return [row[0] for row in cursor.fetchall()]
+
+    def get_bulk_export(self, bulk_id: int) -> {}:
+        bulk = self._query('export_bulk', bulk_id)
+        if not bulk:
+            return None
 
+        bulk = dict(bulk[0])
+        states = {row['state']: row['count'] for row in self._query('export_bulk_progress', bulk_id)}
+        bulk['states'] = states
+        bulk['total'] = sum(states.values())
+        bulk['queued'] = states.get('bulk-queued', 0)
+        bulk['finished'] = states.get('finished', 0)
+        bulk['failed'] = sum(count for state, count in states.items() if state.endswith('error'))
+        bulk['running'] = bulk['total'] - bulk['queued'] - bulk['finished'] - bulk['failed']
+        return bulk
 
     def create_export_tracking_logs_table(self) -> None:
         if self.table_exist('nels_export_tracking_log'):
@@ -141,41 +634,28 @@ class DB(object):
                   tracking_id    INT,
                   log            VARCHAR(80)
                ); '''
-        self._db.do(q)
+        self._do(q)
 
     def add_export_tracking_log(self, tracking_id: int, state: str, log:str=None) -> None:
         values = {'create_time': datetime.datetime.now(),
                   'tracking_id': tracking_id,
-                  'log': log}
-        if log is None:
-            values[ 'log' ] = f"Changed state to {state}"
-
+                  'log': self._log_entry(state, log)}
 
-        self._db.add('nels_export_tracking_log', values)
+        self._add('nels_export_tracking_log', values)
 
     def get_export_trackings(self, **values):
-        return self._db.get('nels_export_tracking', **values)
+        return self._get('nels_export_tracking', **values)
 
     def get_export_tracking(self, tracking_id: int):
-        return self._db.get_single('nels_export_tracking', id=tracking_id)
+        return self._get_single('nels_export_tracking', id=tracking_id)
 
     def get_user_history_exports(self, user_id: int) -> []:
-        exports = self.get_all_user_history_exports(user_id)
-
-        cleaned_exports = {}
-
-        for export in exports:
-            if export['history_id'] not in cleaned_exports:
-                cleaned_exports[export['history_id']] = export
-
-            elif cleaned_exports[export['history_id']]['create_time'] < export['create_time']:
-                cleaned_exports[export['history_id']] = export
-
-        return list(cleaned_exports.values())
+        # latest export for each of the user's histories
+        return self._query('latest_user_history_exports', user_id)
 
     def get_dataset(self, dataset_id: int) -> {}:
 
-        r = self._db.get_by_id('dataset', dataset_id)
+        r = self._get('dataset', id=dataset_id)
 
         if isinstance(r, list) and len(r):
             r = r[0]
@@ -183,105 +663,56 @@ class DB(object):
         return r
 
     def get_all_user_history_exports(self, user_id: int) -> []:
-        q = '''select ha.id as export_id, ha.dataset_id, ha.history_id, h.name, job.create_time, job.state, job.id as job_id  
-               from galaxy_user as ga, history as h, job_export_history_archive as ha, job 
-               where ga.id = {user_id} and 
-                     ga.id = h.user_id and 
-                     h.id = ha.history_id 
-                     and job.id = ha.job_id;
-            '''
-
-        return (self._db.get_as_dict(q.format(user_id=user_id)))
+        return self._query('user_history_exports', user_id)
 
     def get_export(self, export_id: int) -> []:
-        q = '''select ha.id as export_id, ha.dataset_id, ha.history_id, h.name, job.create_time, job.state, job.id as job_id  
-               from history as h, job_export_history_archive as ha, job 
-               where ha.id = {export_id} and  
-                     h.id = ha.history_id 
-                     and job.id = ha.job_id;
-            '''
-
-        return (self._db.get_as_dict(q.format(export_id=export_id)))
-
-    def get_latest_export_for_history(self, history_id: int) -> []:
-        q = '''select ha.id as export_id, ha.dataset_id, ha.history_id, h.name, job.create_time, job.state, job.id as job_id  
-               from history as h, job_export_history_archive as ha, job 
-               where ha.history_id = {history_id} and  
-                     h.id = ha.history_id 
-                     and job.id = ha.job_id
-               ORDER BY ha.id DESC LIMIT 1;
-            '''
-
-        return (self._db.get_as_dict(q.format(history_id=history_id)))
-
-    def get_exports(self, state: str = "") -> []:
-        exports = self.get_all_exports()
-
-        cleaned_exports = {}
+        return self._query('export', export_id)
 
-        for export in exports:
-            if export['history_id'] not in cleaned_exports:
-                cleaned_exports[export['history_id']] = export
+    def get_exports_by_id(self, export_ids: []) -> []:
+        return self._query('exports_by_id', export_ids)
 
-            elif cleaned_exports[export['history_id']]['create_time'] < export['create_time']:
-                cleaned_exports[export['history_id']] = export
+    def get_latest_exports_for_histories(self, history_ids: []) -> []:
+        return self._query('latest_exports_for_histories', history_ids)
 
-        if state != '':
-            tmp_exports = {}
-            for name in cleaned_exports:
-                export = cleaned_exports[name]
-                if export['state'] == state:
-                    tmp_exports[name] = export
-
-            cleaned_exports = tmp_exports
+    def get_latest_export_for_history(self, history_id: int) -> []:
+        return self._query('latest_export_for_history', history_id)
 
-        return list(cleaned_exports.values())
+    def get_exports(self, state: str = "", after_id: int = 0, limit: int = None) -> []:
+        # latest export for each history, optionally only the ones where that export is in a given state.
+        # Ordered by history_id, pass the last history_id seen as after_id to get the next page
+        return self._query('latest_exports', state, after_id or 0, limit)
 
     def get_all_exports(self, state: str = "") -> []:
-        if state != "":
-            state = f" and job.state = '{state}'"
-
-        q = '''select ha.id as export_id, dataset_id, ha.history_id, h.name as history_name, ga.id as user_id, ga.email, job.create_time, job.state  
-               from job_export_history_archive as ha, galaxy_user as ga, history as h, job 
-               where ga.id = h.user_id and 
-                     h.id = ha.history_id and 
-                    job.id = ha.job_id {state} 
-               order by ha.id;
-            '''
-
-        return (self._db.get_as_dict(q.format(state=state)))
+        return self._query('all_exports', state)
 
     def get_user_histories(self, user_id: int) -> []:
-        q = "select id, update_time, name, hid_counter from history where user_id={user_id};"
-        return (self._db.get_as_dict(q.format(user_id=user_id)))
+        return self._query('user_histories', user_id)
 
     def get_all_histories(self) -> []:
-        q = "select id, update_time, user_id, name from history as h order by id;"
-        return (self._db.get_as_dict(q))
+        return self._query('all_histories')
 
     def get_users(self) -> []:
-        q = "select id, email, active, deleted, update_time from galaxy_user;"
-        return (self._db.get_as_dict(q))
+        return self._query('users')
 
     def get_job(self, job_id: int) -> {}:
-        return self._db.get_by_id('job', job_id)
+        return self._get('job', id=job_id)
 
     def update_job(self, values: {}) -> {}:
         # This does not work, look into bioblend it.
-        return self._db.update('job', values, {'id': values['id']})
+        return self._update('job', values, {'id': values['id']})
 
     def get_history(self, history_id: int) -> {}:
-        return self._db.get('history', id=history_id)
+        return self._get('history', id=history_id)
 
     def add_api_key(self, user_id:int, key:str):
         values = {'user_id': user_id,
                   'key': key,
                   'create_time': datetime.datetime.now()
                   }
-        self._db.add('api_keys', values)
+        self._add('api_keys', values)
 
     def get_api_key(self, user_id:int):
-        values = self._db.get('api_keys', user_id=user_id, order=" create_time desc", limit=1)
+        values = self._get('api_keys', user_id=user_id, order="create_time DESC", limit=1)
         if len( values ) == 1:
             return values[ 0 ]
 
@@ -290,79 +721,21 @@ class DB(object):
 
 
 
-    def get_imports(self, state: str = "") -> []:
-        exports = self.get_all_exports()
-
-        cleaned_exports = {}
-
-        for export in exports:
-            if export['history_id'] not in cleaned_exports:
-                cleaned_exports[export['history_id']] = export
-
-            elif cleaned_exports[export['history_id']]['create_time'] < export['create_time']:
-                cleaned_exports[export['history_id']] = export
-
-        if state != '':
-            tmp_exports = {}
-            for name in cleaned_exports:
-                export = cleaned_exports[name]
-                if export['state'] == state:
-                    tmp_exports[name] = export
-
-            cleaned_exports = tmp_exports
-
-        return list(cleaned_exports.values())
-
+    def get_imports(self, state: str = "", after_id: int = 0, limit: int = None) -> []:
+        # latest import for each history, see get_exports
+        return self._query('latest_imports', state, after_id or 0, limit)
 
     def get_all_imports(self, state: str = "") -> []:
-        if state != "":
-            state = f" and job.state = '{state}'"
-
-        q = '''select ha.id as import_id, ha.history_id, h.name as history_name, ga.id as user_id, ga.email, job.create_time, job.state  
-               from job_import_history_archive as ha, galaxy_user as ga, history as h, job 
-               where ga.id = h.user_id and 
-                     h.id = ha.history_id and 
-                    job.id = ha.job_id {state} 
-               order by ha.id;
-            '''
-
-        return (self._db.get_as_dict(q.format(state=state)))
+        return self._query('all_imports', state)
 
     def get_all_user_history_imports(self, user_id: int) -> []:
-        q = '''select ha.id as import_id, ha.history_id, h.name, job.create_time, job.state, job.id as job_id  
-               from galaxy_user as ga, history as h, job_import_history_archive as ha, job 
-               where ga.id = {user_id} and 
-                     ga.id = h.user_id and 
-                     h.id = ha.history_id 
-                     and job.id = ha.job_id;
-            '''
-
-        return (self._db.get_as_dict(q.format(user_id=user_id)))
+        return self._query('user_history_imports', user_id)
 
     def get_import(self, import_id: int) -> []:
-        q = '''select ha.id as import_id, ha.history_id, h.name, job.create_time, job.state, job.id as job_id  
-               from history as h, job_import_history_archive as ha, job 
-               where ha.id = {import_id} and  
-                     h.id = ha.history_id 
-                     and job.id = ha.job_id;
-            '''
-
-        return (self._db.get_as_dict(q.format(import_id=import_id)))
+        return self._query('import', import_id)
 
     def imports(self, user_id: int) -> []:
-        imports = self.get_all_user_history_imports(user_id)
-
-        cleaned_imports = {}
-
-        for imp in imports:
-            if imp['history_id'] not in cleaned_imports:
-                cleaned_imports[imp['history_id']] = imp
-
-            elif cleaned_imports[imp['history_id']]['create_time'] < imp['create_time']:
-                cleaned_imports[imp['history_id']] =imp
-
-        return list(cleaned_imports.values())
-
+        return self.get_user_history_imports(user_id)
 
     def create_import_tracking_table(self) -> None:
         if self.table_exist('nels_import_tracking'):
@@ -381,40 +754,21 @@ class DB(object):
               show           BOOL DEFAULT 'true'
               );
             '''
-        self._db.do(q)
+        self._do(q)
 
     def add_import_tracking(self, values):
-        values['create_time'] = datetime.datetime.now()
-
-        log = None
-        if 'log' in values:
-            log = values['log']
-            del values['log']
-
-        self._db.add('nels_import_tracking', values)
-        tracking_id = self._db.get_id('nels_import_tracking', **values)
-        self.add_import_tracking_log(tracking_id, state="Created", log=log)
-        return tracking_id
+        return self._add_tracking('nels_import_tracking', values)
 
 
     def update_import_tracking(self, tracking_id: int, values: {}):
-        values['update_time'] = datetime.datetime.now()
-
-        log = None
-        if 'log' in values:
-            log = values['log']
-            del values['log']
-
-        self._db.update('nels_import_tracking', values, {'id': tracking_id})
-        if 'state' in values:
-            self.add_import_tracking_log(tracking_id, state=values['state'], log=log)
+        self._update_tracking('nels_import_tracking', tracking_id, values)
 
 
     def get_import_trackings(self, **values):
-        return self._db.get('nels_import_tracking', **values)
+        return self._get('nels_import_tracking', **values)
 
     def get_import_tracking(self, tracking_id: int):
-        return self._db.get_single('nels_import_tracking', id=tracking_id)
+        return self._get_single('nels_import_tracking', id=tracking_id)
 
     def create_import_tracking_logs_table(self) -> None:
         if self.table_exist('nels_import_tracking_log'):
@@ -426,48 +780,165 @@ class DB(object):
                   tracking_id    INT,
                   log            VARCHAR(80)
                ); '''
-        self._db.do(q)
+        self._do(q)
 
 
     def add_import_tracking_log(self, tracking_id: int, state: str, log:str=None) -> None:
         values = {'create_time': datetime.datetime.now(),
                   'tracking_id': tracking_id,
-                  'log': log}
-        if log is None:
-            values[ 'log' ] = f"Changed state to {state}"
+                  'log': self._log_entry(state, log)}
 
-        self._db.add('nels_import_tracking_log', values)
+        self._add('nels_import_tracking_log', values)
 
     def get_user_history_imports(self, user_id: int):
-        imports = self.get_all_user_history_imports(user_id)
-
-        cleaned_imports = {}
-
-        for imp in imports:
-            if imp['history_id'] not in cleaned_imports:
-                cleaned_imports[imp['history_id']] = imp
-
-            elif cleaned_imports[imp['history_id']]['create_time'] < imp['create_time']:
-                cleaned_imports[imp['history_id']] = imp
-
-        return list(cleaned_imports.values())
-
-
+        # latest import for each of the user's histories
+        return self._query('latest_user_history_imports', user_id)
 
     def get_jobs(self, time_delta:int=None, user_id:str=None) -> []:
-        q = 'select  j.update_time, tool_id, j.user_id, email, state, job_runner_name, destination_id from job j, galaxy_user gu where gu.id=j.user_id {filter} order by j.id'
-
-        filter = ""
-
-        if time_delta is not None:
-            print( time_delta )
-            filter += f" and j.update_time > now() - interval '{time_delta}' second "
-
-        if user_id is not None:
-            filter += f" and j.user_id = '{user_id}' "
-
-        q = q.format(filter=filter)
-
-        return (self._db.get_as_dict(q))
-
+        return self._query('jobs', time_delta, user_id)
+
+
+class AsyncDB(object):
+    # Coroutine version of DB for the tornado handlers. The get_*, add_*, update_*, release_* and
+    # requeue_* methods of DB are awaitable here and run in a thread pool against a bounded pool of
+    # DB connections, so a slow query only holds up the request that made it. Everything else (table
+    # creation etc) is called synchronously on the first connection, as it is only used during startup.
+    # Streams are read at the pace of the client downloading them, so they have their own, smaller,
+    # set of connections and never take a slot from the queries.
+
+    ASYNC_PREFIXES = ('get_', 'add_', 'update_', 'release_', 'requeue_')
+
+    def __init__(self):
+        self._url = None
+        self._statement_timeout = None
+        self._pool_size = 0
+        self._idle = []
+        self._connections = []
+        self._semaphore = None
+        self._stream_pool_size = 0
+        self._stream_idle = []
+        self._stream_connections = []
+        self._stream_semaphore = None
+        self._executor = None
+        self._log_writer = None
+
+    def connect(self, url: str, pool_size: int = 5, statement_timeout: int = None, log_batch_size: int = 500,
+                log_flush_interval: float = 1.0, stream_pool_size: int = 2) -> None:
+        self._url = url
+        self._statement_timeout = statement_timeout
+        self._pool_size = max(1, int(pool_size))
+        self._semaphore = Semaphore(self._pool_size)
+        self._stream_pool_size = max(1, int(stream_pool_size))
+        self._stream_semaphore = Semaphore(self._stream_pool_size)
+        self._executor = ThreadPoolExecutor(max_workers=self._pool_size + self._stream_pool_size,
+                                            thread_name_prefix='nga-db')
+        # the tracking logs of all the connections are written behind, in batches
+        self._log_writer = TrackingLogWriter(url, statement_timeout, batch_size=log_batch_size,
+                                             flush_interval=log_flush_interval)
+        # one connection up front, so config errors show up at startup
+        self._idle.append(self._new_connection())
 
+    def disconnect(self) -> None:
+        for connection in self._connections + self._stream_connections:
+            connection.disconnect()
+
+        self._connections = []
+        self._idle = []
+        self._stream_connections = []
+        self._stream_idle = []
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+        # last, writes what the connections have queued
+        if self._log_writer is not None:
+            self._log_writer.close()
+            self._log_writer = None
+
+    def _new_connection(self, connections: [] = None) -> DB:
+        connection = DB()
+        connection.connect(self._url, statement_timeout=self._statement_timeout)
+        connection.log_writer = self._log_writer
+        (self._connections if connections is None else connections).append(connection)
+        return connection
+
+    async def acquire(self) -> DB:
+        await self._semaphore.acquire()
+        if self._idle:
+            return self._idle.pop()
+
+        try:
+            return await IOLoop.current().run_in_executor(self._executor, self._new_connection)
+        except Exception:
+            self._semaphore.release()
+            raise
+
+    def release(self, connection: DB) -> None:
+        self._idle.append(connection)
+        self._semaphore.release()
+
+    async def run(self, name: str, *args, **kwargs):
+        connection = await self.acquire()
+        try:
+            method = getattr(connection, name)
+            return await IOLoop.current().run_in_executor(self._executor, lambda: method(*args, **kwargs))
+        finally:
+            self.release(connection)
+
+    async def _acquire_stream(self) -> DB:
+        await self._stream_semaphore.acquire()
+        if self._stream_idle:
+            return self._stream_idle.pop()
+
+        try:
+            return await IOLoop.current().run_in_executor(self._executor, self._new_connection,
+                                                          self._stream_connections)
+        except Exception:
+            self._stream_semaphore.release()
+            raise
+
+    def _release_stream(self, connection: DB) -> None:
+        self._stream_idle.append(connection)
+        self._stream_semaphore.release()
+
+    async def stream(self, name: str, *params, chunk_size: int = 1000):
+        # async version of DB.stream. The stream connection is kept for as long as the rows are being
+        # read, so at most stream_pool_size streams run at a time and the rest wait for one to end.
+        connection = await self._acquire_stream()
+        rows = connection.stream(name, *params, chunk_size=chunk_size)
+        try:
+            while True:
+                chunk = await IOLoop.current().run_in_executor(self._executor, next, rows, None)
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            await IOLoop.current().run_in_executor(self._executor, rows.close)
+            self._release_stream(connection)
+
+    def stats(self) -> {}:
+        stats = {'pool_size': self._pool_size,
+                 'connections': len(self._connections),
+                 'idle': len(self._idle),
+                 'stream_pool_size': self._stream_pool_size,
+                 'stream_connections': len(self._stream_connections),
+                 'stream_idle': len(self._stream_idle)}
+
+        if self._log_writer is not None:
+            stats['log_writer'] = self._log_writer.stats()
+
+        return stats
+
+    def __getattr__(self, name: str):
+        if name.startswith('_') or not hasattr(DB, name):
+            raise AttributeError(name)
+
+        if not name.startswith(self.ASYNC_PREFIXES):
+            return getattr(self._connections[0], name)
+
+        async def method(*args, **kwargs):
+            return await self.run(name, *args, **kwargs)
+
+        method.__name__ = name
+        return method
@@ -1,16 +1,22 @@
+import datetime
 import pprint as pp
 
+import requests
+
 import kbr.timedate_utils as timedate_utils
 
 import nels_galaxy_api.utils as nga_utils
+import nels_galaxy_api.api_requests as api_requests
 
 # Functionalities for getting users, histories, exports and imports, using nga rest-api to fetch data.
-
-def get_users( config:{}, instance_name:str=None, summary=False, time_delta:int=None ):
-
-    users = []
-    brief = []
-
+# The *_async versions query all instances, and the users on them, at the same time, with at most
+# limit requests in flight.
+# Instances that have the /users/histories/ and /users/exports/ endpoints are asked for all users
+# in one request, older ones one user at a time.
+
+def _instances( config:{}, instance_name:str=None) -> []:
+    # the instances are listed both by id and name, only use the name entries
+    instances = []
     for instance_id in config['instances']:
         if instance_name and instance_id != instance_name:
             continue
@@ -18,30 +24,161 @@ def get_users( config:{}, instance_name:str=None, summary=False, time_delta:int=
         if config['instances'][ instance_id]['name'] != instance_id:
             continue
 
-        instance = config['instances'][ instance_id]
+        instances.append( config['instances'][ instance_id] )
+
+    return instances
+
+
+def _async_api( instance:{} ) -> api_requests.AsyncApiRequests:
+    if 'async_api' not in instance:
+        instance['async_api'] = api_requests.AsyncApiRequests(instance['api']._base_url, instance['api']._token)
+
+    return instance['async_api']
+
+
+def _instance_users( instance:{}, tmp_users:[], time_delta:int=None) -> []:
+
+    instance_users = []
+    for tmp_user in tmp_users:
+
+        if 'update_time' in tmp_user and time_delta:
+            update_time = timedate_utils.datestr_to_ts(tmp_user['update_time'])
+            update_time = timedate_utils.to_sec_since_epoch( update_time)
+            if time_delta > update_time:
+                continue
+
+            del tmp_user['update_time']
+
+        tmp_user['instance'] = instance['name']
+        tmp_user['active'] = bool(tmp_user['active'])
+        tmp_user['deleted'] = bool(tmp_user['deleted'])
+
+        instance_users.append( tmp_user )
+
+    return sorted(instance_users, key=lambda x: x['email'].lower())
+
+
+def _user_histories( instance:{}, user:{}, tmp_histories:[] ) -> []:
+
+    histories = []
+    for tmp_history in tmp_histories:
+        tmp_history['instance'] = instance['name']
+        tmp_history['changed'] = nga_utils.readable_date(tmp_history['update_time'])
+        del tmp_history['update_time']
+
+        tmp_history['user'] = user['email']
+        del tmp_history['hid_counter']
+
+        histories.append( tmp_history )
+
+    return histories
+
+
+def _user_exports( instance:{}, user:{}, tmp_exports:[], full=False ) -> []:
 
-        instance_users = []
+    exports = []
+    for tmp_export in tmp_exports:
+        if not full:
+            del tmp_export['export_id']
+            del tmp_export['job_id']
+            del tmp_export['history_id']
+
+        tmp_export['instance'] = instance['name']
+        tmp_export['user'] = user['email']
+        tmp_export['created'] = nga_utils.readable_date(tmp_export['create_time'])
+        del tmp_export['create_time']
+
+        exports.append( tmp_export )
+
+    return exports
+
+
+def _selected_users( users:[], user_email:str=None ) -> []:
+    users = sorted(users, key=lambda x: x['email'].lower())
+    return [user for user in users if user_email is None or user['email'] == user_email]
+
+
+def _grouped( rows:[] ) -> {}:
+    # email -> rows of the user, as the pr user endpoints would have returned them
+    grouped = {}
+    for row in rows:
+        grouped.setdefault(row.pop('email'), []).append(row)
+
+    return grouped
+
+
+def _no_bulk( instance:{}, e:requests.HTTPError ) -> None:
+    if e.response is None or e.response.status_code != 404:
+        raise e
+
+    instance['bulk_users'] = False
+
+
+def _bulk_user_call( instance:{}, bulk_call:str ) -> {}:
+    # None if the instance does not have the bulk endpoint
+    if not instance.get('bulk_users', True):
+        return None
+
+    try:
+        return _grouped(getattr(instance['api'], bulk_call)())
+    except requests.HTTPError as e:
+        _no_bulk(instance, e)
+        return None
+
+
+async def _bulk_user_call_async( instance:{}, bulk_call:str ) -> {}:
+    if not instance.get('bulk_users', True):
+        return None
+
+    try:
+        return _grouped(await getattr(_async_api(instance), bulk_call)())
+    except requests.HTTPError as e:
+        _no_bulk(instance, e)
+        return None
+
+
+def _user_calls( instance:{}, users:[], user_email:str, call:str, bulk_call:str ) -> []:
+    # [(user, result of the call for the user)]. A single user is cheaper to ask for on its own
+    bulk = None
+    if user_email is None:
+        bulk = _bulk_user_call(instance, bulk_call)
+
+    results = []
+    for user in users:
+        if bulk is not None:
+            results.append((user, bulk.get(user['email'], [])))
+        else:
+            results.append((user, getattr(instance['api'], call)(user['email'])))
+
+    return results
+
+
+def get_users( config:{}, instance_name:str=None, summary=False, time_delta:int=None ):
+
+    users = []
+    brief = []
+
+    for instance in _instances(config, instance_name):
         tmp_users = instance['api'].get_users()
         brief.append({'name': instance['name'], 'users': len(tmp_users)})
+        users += _instance_users(instance, tmp_users, time_delta)
 
+    if summary:
+        return brief
 
-        for tmp_user in tmp_users:
-
-            if 'update_time' in tmp_user and time_delta:
-                update_time = timedate_utils.datestr_to_ts(tmp_user['update_time'])
-                update_time = timedate_utils.to_sec_since_epoch( update_time)
-                if time_delta > update_time:
-                    continue
+    return users
 
-                del tmp_user['update_time']
 
-            tmp_user['instance'] = instance['name']
-            tmp_user['active'] = bool(tmp_user['active'])
-            tmp_user['deleted'] = bool(tmp_user['deleted'])
+async def get_users_async( config:{}, instance_name:str=None, summary=False, time_delta:int=None, limit:int=10 ):
 
-            instance_users.append( tmp_user )
+    instances = _instances(config, instance_name)
+    instance_users = await api_requests.gather([_async_api(instance).get_users() for instance in instances], limit)
 
-        users += sorted(instance_users, key=lambda x: x['email'].lower())
+    users = []
+    brief = []
+    for instance, tmp_users in zip(instances, instance_users):
+        brief.append({'name': instance['name'], 'users': len(tmp_users)})
+        users += _instance_users(instance, tmp_users, time_delta)
 
     if summary:
         return brief
@@ -54,35 +191,50 @@ def get_histories( config:{}, instance_name:str=None, user_email:str=None, summa
     histories = []
     brief     = []
 
+    for instance in _instances(config, instance_name):
+        users = _selected_users(instance['api'].get_users(), user_email)
 
-    for instance_id in config['instances']:
-        if instance_name and instance_id != instance_name:
-            continue
+        for user, tmp_histories in _user_calls(instance, users, user_email, 'get_user_histories', 'get_users_histories'):
+            brief.append({'name':instance['name'], 'user': user['email'], 'histories': len( tmp_histories )})
+            histories += _user_histories(instance, user, tmp_histories)
 
-        if config['instances'][ instance_id]['name'] != instance_id:
-            continue
+    if summary:
+        return brief
 
-        instance = config['instances'][ instance_id]
+    return histories
 
-        users = instance['api'].get_users()
-        users = sorted(users, key=lambda x: x['email'].lower())
 
-        for user in users:
-            if user_email is not None and user['email'] != user_email:
-                continue
+async def _instance_user_calls( config:{}, instance_name:str, user_email:str, call:str, bulk_call:str, limit:int) -> []:
+    # [(instance, user, result of the call for the user)], all users on all instances at once
+    instances = _instances(config, instance_name)
+    instance_users = await api_requests.gather([_async_api(instance).get_users() for instance in instances], limit)
 
-            tmp_histories = instance['api'].get_user_histories(user['email'])
-            brief.append({'name':instance['name'], 'user': user['email'], 'histories': len( tmp_histories )})
-            for tmp_history in tmp_histories:
-                tmp_history['instance'] = instance['name']
-                tmp_history['changed'] = nga_utils.readable_date(tmp_history['update_time'])
-                del tmp_history['update_time']
+    bulks = [None] * len(instances)
+    if user_email is None:
+        bulks = await api_requests.gather([_bulk_user_call_async(instance, bulk_call) for instance in instances], limit)
 
-                tmp_history['user'] = user['email']
-                del tmp_history['hid_counter']
+    async def user_call(instance, user, bulk):
+        if bulk is not None:
+            return bulk.get(user['email'], [])
+        return await getattr(_async_api(instance), call)(user['email'])
 
-                histories.append( tmp_history )
+    triples = []
+    for instance, users, bulk in zip(instances, instance_users, bulks):
+        triples += [(instance, user, bulk) for user in _selected_users(users, user_email)]
 
+    results = await api_requests.gather([user_call(*triple) for triple in triples], limit)
+    return [(instance, user, result) for (instance, user, _), result in zip(triples, results)]
+
+
+async def get_histories_async( config:{}, instance_name:str=None, user_email:str=None, summary=False, limit:int=10):
+
+    histories = []
+    brief     = []
+
+    for instance, user, tmp_histories in await _instance_user_calls(config, instance_name, user_email,
+                                                                    'get_user_histories', 'get_users_histories', limit):
+        brief.append({'name':instance['name'], 'user': user['email'], 'histories': len( tmp_histories )})
+        histories += _user_histories(instance, user, tmp_histories)
 
     if summary:
         return brief
@@ -95,40 +247,36 @@ def get_exports( config:{}, instance_name:str=None, user_email:str=None, summary
     exports = []
     brief     = []
 
-    for instance_id in config['instances']:
-        if instance_name and instance_id != instance_name:
-            continue
-
-        if config['instances'][ instance_id]['name'] != instance_id:
-            continue
-
-        instance = config['instances'][ instance_id]
+    for instance in _instances(config, instance_name):
+        users = _selected_users(instance['api'].get_users(), user_email)
 
-        users = instance['api'].get_users()
-        users = sorted(users, key=lambda x: x['email'].lower())
-
-        for user in users:
-            if user_email is not None and user['email'] != user_email:
-                continue
-
-            tmp_exports = instance['api'].get_user_history_exports(user['email'])
+        for user, tmp_exports in _user_calls(instance, users, user_email, 'get_user_history_exports', 'get_users_exports'):
             nr_exports = len( tmp_exports )
             if not nr_exports:
                 continue
 
             brief.append({'name':instance['name'], 'user': user['email'], 'instance exports':  nr_exports })
-            for tmp_export in tmp_exports:
-                if not full:
-                    del tmp_export['export_id']
-                    del tmp_export['job_id']
-                    del tmp_export['history_id']
+            exports += _user_exports(instance, user, tmp_exports, full)
 
-                tmp_export['instance'] = instance['name']
-                tmp_export['user'] = user['email']
-                tmp_export['created'] = nga_utils.readable_date(tmp_export['create_time'])
-                del tmp_export['create_time']
+    if summary:
+        return brief
 
-                exports.append( tmp_export )
+    return exports
+
+
+async def get_exports_async( config:{}, instance_name:str=None, user_email:str=None, summary=False, full=False, limit:int=10):
+
+    exports = []
+    brief     = []
+
+    for instance, user, tmp_exports in await _instance_user_calls(config, instance_name, user_email,
+                                                                  'get_user_history_exports', 'get_users_exports', limit):
+        nr_exports = len( tmp_exports )
+        if not nr_exports:
+            continue
+
+        brief.append({'name':instance['name'], 'user': user['email'], 'instance exports':  nr_exports })
+        exports += _user_exports(instance, user, tmp_exports, full)
 
     if summary:
         return brief
@@ -176,33 +324,19 @@ def get_imports( config:{}, user_email:str=None, summary=False, full=False):
 
 
 def get_export_requests(config, time_delta) -> []:
+    # time_delta is the epoch time to list the requests made since, 0 is all of them
 
-    exports = []
-
-    for request in config['master_api'].get_exports():
-        create_time = timedate_utils.datestr_to_ts(request['create_time'])
-        create_time = timedate_utils.to_sec_since_epoch(create_time)
+    filter = {}
+    if time_delta:
+        filter['since'] = datetime.datetime.fromtimestamp(time_delta).isoformat()
 
-        if time_delta:
-            if time_delta <= create_time:
-                exports.append(request)
-        else:
-            exports.append(request)
-
-    return exports
+    return list(config['master_api'].iter_exports(filter))
 
 def get_import_requests(config, time_delta) -> []:
+    # time_delta is the epoch time to list the requests made since, 0 is all of them
 
-    imports = []
-
-    for request in config['master_api'].get_imports():
-        create_time = timedate_utils.datestr_to_ts(request['create_time'])
-        create_time = timedate_utils.to_sec_since_epoch(create_time)
-
-        if time_delta:
-            if time_delta <= create_time:
-                imports.append(request)
-        else:
-            imports.append(request)
+    filter = {}
+    if time_delta:
+        filter['since'] = datetime.datetime.fromtimestamp(time_delta).isoformat()
 
-    return imports
\ No newline at end of file
+    return list(config['master_api'].iter_imports(filter))
\ No newline at end of file
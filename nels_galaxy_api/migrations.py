@@ -0,0 +1,63 @@
+# Versioned schema changes for the nels_* tables, applied by DB.migrate() at startup.
+# A migration is only applied once all the tables it touches exist (the tracking tables are
+# only created on the master), until then it stays pending. Applied versions are recorded in
+# nels_schema_version, and every statement is idempotent so a half-applied migration can be rerun.
+
+
+class Migration(object):
+
+    def __init__(self, version: int, description: str, tables: [], statements: []):
+        self.version = version
+        self.description = description
+        self.tables = tables
+        self.statements = statements
+
+
+migrations = [
+    Migration(1, 'export tracking indexes',
+              ['nels_export_tracking', 'nels_export_tracking_log'],
+              ["CREATE INDEX IF NOT EXISTS nels_export_tracking_user_instance_idx ON nels_export_tracking (user_email, instance)",
+               "CREATE INDEX IF NOT EXISTS nels_export_tracking_state_update_idx ON nels_export_tracking (state, update_time)",
+               "CREATE INDEX IF NOT EXISTS nels_export_tracking_log_tracking_idx ON nels_export_tracking_log (tracking_id, create_time)"]),
+
+    Migration(2, 'import tracking indexes',
+              ['nels_import_tracking', 'nels_import_tracking_log'],
+              ["CREATE INDEX IF NOT EXISTS nels_import_tracking_user_idx ON nels_import_tracking (user_id)",
+               "CREATE INDEX IF NOT EXISTS nels_import_tracking_state_update_idx ON nels_import_tracking (state, update_time)",
+               "CREATE INDEX IF NOT EXISTS nels_import_tracking_log_tracking_idx ON nels_import_tracking_log (tracking_id, create_time)"]),
+
+    Migration(3, 'tos user index',
+              ['nels_tos'],
+              ["CREATE INDEX IF NOT EXISTS nels_tos_user_idx ON nels_tos (user_id)"]),
+
+    Migration(4, 'bulk exports',
+              ['nels_export_tracking'],
+              ["""CREATE TABLE IF NOT EXISTS nels_export_bulk (
+                    id             SERIAL PRIMARY KEY,
+                    instance       VARCHAR(80),
+                    user_email     VARCHAR(80),
+                    nels_id        INT,
+                    destination    VARCHAR(80),
+                    create_time    TIMESTAMP
+                  )""",
+               "ALTER TABLE nels_export_tracking ADD COLUMN IF NOT EXISTS bulk_id INT",
+               "CREATE INDEX IF NOT EXISTS nels_export_tracking_bulk_idx ON nels_export_tracking (bulk_id, state)"]),
+]
+
+# Galaxy owns these tables so we do not touch them, but the queries in queries.py rely on
+# an index leading with these columns. Missing ones are reported at startup.
+galaxy_indexes = [
+    ('job_export_history_archive', 'history_id'),
+    ('job_export_history_archive', 'job_id'),
+    ('job_import_history_archive', 'history_id'),
+    ('job_import_history_archive', 'job_id'),
+    ('history', 'user_id'),
+    ('galaxy_session', 'session_key'),
+    ('galaxy_user', 'email'),
+    ('job', 'user_id'),
+    ('job', 'update_time'),
+    ('api_keys', 'user_id'),
+]
+
+# serialises migrations when several processes start at the same time
+lock_id = 4242001
@@ -0,0 +1,354 @@
+import re
+import threading
+import time
+
+import psycopg2.extras
+
+# Catalog of the read queries used by db.py. Each statement is prepared once per connection
+# (PREPARE/EXECUTE) and run with bound parameters, so postgres only parses and plans it once.
+# Call counts and timings are kept per statement and can be fetched with stats()
+
+
+class Query(object):
+
+    def __init__(self, name: str, sql: str, types: [] = None):
+        self.name = name
+        self.sql = sql
+        self.types = types or []
+
+    def prepare_sql(self) -> str:
+        if self.types:
+            return f"PREPARE {self.name} ({', '.join(self.types)}) AS {self.sql}"
+
+        return f"PREPARE {self.name} AS {self.sql}"
+
+    def execute_sql(self) -> str:
+        if self.types:
+            return f"EXECUTE {self.name} ({', '.join(['%s'] * len(self.types))})"
+
+        return f"EXECUTE {self.name}"
+
+    def cursor_sql(self, params: []) -> (str, []):
+        # the statement with the $n placeholders swapped for typed psycopg2 ones, for use in
+        # server side cursors where EXECUTE is not allowed
+        values = []
+
+        def placeholder(match):
+            index = int(match.group(1)) - 1
+            values.append(params[index])
+            return f"%s::{self.types[index]}"
+
+        sql = re.sub(r'\$(\d+)', placeholder, self.sql.replace('%', '%%'))
+        return sql, values
+
+
+catalog = {}
+
+
+def add(name: str, sql: str, types: [] = None) -> None:
+    catalog[name] = Query(name, sql, types)
+
+
+add('table_exist', "SELECT to_regclass($1)", ['text'])
+
+add('leading_index_columns',
+    '''select t.relname as table_name, a.attname as column_name
+       from pg_index as i, pg_class as t, pg_attribute as a
+       where t.oid = i.indrelid and
+             a.attrelid = t.oid and
+             a.attnum = i.indkey[0] and
+             pg_table_is_visible(t.oid) and
+             t.relname = any($1)''',
+    ['text[]'])
+
+# galaxy logs a session out by setting is_valid to false, checked for the sessions cached by the api
+add('session_valid',
+    '''select is_valid from galaxy_session where session_key = $1''',
+    ['text'])
+
+# a bulk export, and how far its trackings have got. A history that was requeued counts with its
+# latest tracking only
+add('export_bulk',
+    '''select * from nels_export_bulk where id = $1''',
+    ['int'])
+
+add('export_bulk_progress',
+    '''select state, count(*) as count from
+         (select distinct on (history_id) state from nels_export_tracking
+          where bulk_id = $1
+          order by history_id, id desc) as latest
+       group by state''',
+    ['int'])
+
+# keyset paginated: the page after tracking id $6, of at most $7 (null is all) trackings,
+# created in the [$4, $5) window
+add('export_trackings',
+    '''select * from nels_export_tracking
+       where ($1 is null or state = $1) and
+             ($2 is null or instance = $2) and
+             ($3 is null or user_email = $3) and
+             ($4 is null or create_time >= $4) and
+             ($5 is null or create_time < $5) and
+             id > $6
+       order by id
+       limit $7''',
+    ['varchar', 'varchar', 'varchar', 'timestamp', 'timestamp', 'int', 'int'])
+
+# as export_trackings, with the email of the user joined in
+add('import_trackings',
+    '''select it.*, ga.email as user_email
+       from nels_import_tracking as it left join galaxy_user as ga on ga.id = it.user_id
+       where ($1 is null or it.state = $1) and
+             ($2 is null or ga.email = $2) and
+             ($3 is null or it.create_time >= $3) and
+             ($4 is null or it.create_time < $4) and
+             it.id > $5
+       order by it.id
+       limit $6''',
+    ['varchar', 'varchar', 'timestamp', 'timestamp', 'int', 'int'])
+
+add('user_histories',
+    "select id, update_time, name, hid_counter from history where user_id = $1",
+    ['int'])
+
+add('all_histories',
+    "select id, update_time, user_id, name from history as h order by id")
+
+add('users_histories',
+    '''select ga.email, h.id, h.update_time, h.name, h.hid_counter
+       from galaxy_user as ga, history as h
+       where ga.id = h.user_id
+       order by ga.email, h.id''')
+
+add('users_exports',
+    '''select * from (
+           select distinct on (ha.history_id) ga.email, ha.id as export_id, ha.dataset_id, ha.history_id, h.name, job.create_time, job.state, job.id as job_id
+           from galaxy_user as ga, history as h, job_export_history_archive as ha, job
+           where ga.id = h.user_id and
+                 h.id = ha.history_id and
+                 job.id = ha.job_id
+           order by ha.history_id, job.create_time desc, ha.id
+       ) as latest
+       order by email, history_id''')
+
+add('users',
+    "select id, email, active, deleted, update_time from galaxy_user")
+
+add('user_history_exports',
+    '''select ha.id as export_id, ha.dataset_id, ha.history_id, h.name, job.create_time, job.state, job.id as job_id
+       from galaxy_user as ga, history as h, job_export_history_archive as ha, job
+       where ga.id = $1 and
+             ga.id = h.user_id and
+             h.id = ha.history_id
+             and job.id = ha.job_id''',
+    ['int'])
+
+add('export',
+    '''select ha.id as export_id, ha.dataset_id, ha.history_id, h.name, job.create_time, job.state, job.id as job_id
+       from history as h, job_export_history_archive as ha, job
+       where ha.id = $1 and
+             h.id = ha.history_id
+             and job.id = ha.job_id''',
+    ['int'])
+
+add('exports_by_id',
+    '''select ha.id as export_id, ha.dataset_id, ha.history_id, h.name, job.create_time, job.state, job.id as job_id
+       from history as h, job_export_history_archive as ha, job
+       where ha.id = ANY($1) and
+             h.id = ha.history_id
+             and job.id = ha.job_id''',
+    ['int[]'])
+
+add('latest_exports_for_histories',
+    '''select distinct on (ha.history_id)
+              ha.id as export_id, ha.dataset_id, ha.history_id, h.name, job.create_time, job.state, job.id as job_id
+       from history as h, job_export_history_archive as ha, job
+       where ha.history_id = ANY($1) and
+             h.id = ha.history_id
+             and job.id = ha.job_id
+       order by ha.history_id, ha.id desc''',
+    ['int[]'])
+
+add('latest_export_for_history',
+    '''select ha.id as export_id, ha.dataset_id, ha.history_id, h.name, job.create_time, job.state, job.id as job_id
+       from history as h, job_export_history_archive as ha, job
+       where ha.history_id = $1 and
+             h.id = ha.history_id
+             and job.id = ha.job_id
+       ORDER BY ha.id DESC LIMIT 1''',
+    ['int'])
+
+add('all_exports',
+    '''select ha.id as export_id, dataset_id, ha.history_id, h.name as history_name, ga.id as user_id, ga.email, job.create_time, job.state
+       from job_export_history_archive as ha, galaxy_user as ga, history as h, job
+       where ga.id = h.user_id and
+             h.id = ha.history_id and
+             job.id = ha.job_id and
+             ($1 = '' or job.state = $1)
+       order by ha.id''',
+    ['varchar'])
+
+add('all_imports',
+    '''select ha.id as import_id, ha.history_id, h.name as history_name, ga.id as user_id, ga.email, job.create_time, job.state
+       from job_import_history_archive as ha, galaxy_user as ga, history as h, job
+       where ga.id = h.user_id and
+             h.id = ha.history_id and
+             job.id = ha.job_id and
+             ($1 = '' or job.state = $1)
+       order by ha.id''',
+    ['varchar'])
+
+# The latest_* queries keep the newest archive per history (ties go to the lowest archive id),
+# with an optional state filter on that newest archive and keyset pagination on history_id.
+
+add('latest_exports',
+    '''select * from (
+           select distinct on (ha.history_id) ha.id as export_id, dataset_id, ha.history_id, h.name as history_name, ga.id as user_id, ga.email, job.create_time, job.state
+           from job_export_history_archive as ha, galaxy_user as ga, history as h, job
+           where ga.id = h.user_id and
+                 h.id = ha.history_id and
+                 job.id = ha.job_id and
+                 ha.history_id > $2
+           order by ha.history_id, job.create_time desc, ha.id
+       ) as latest
+       where ($1 = '' or state = $1)
+       order by history_id
+       limit $3''',
+    ['varchar', 'int', 'int'])
+
+add('latest_imports',
+    '''select * from (
+           select distinct on (ha.history_id) ha.id as import_id, ha.history_id, h.name as history_name, ga.id as user_id, ga.email, job.create_time, job.state
+           from job_import_history_archive as ha, galaxy_user as ga, history as h, job
+           where ga.id = h.user_id and
+                 h.id = ha.history_id and
+                 job.id = ha.job_id and
+                 ha.history_id > $2
+           order by ha.history_id, job.create_time desc, ha.id
+       ) as latest
+       where ($1 = '' or state = $1)
+       order by history_id
+       limit $3''',
+    ['varchar', 'int', 'int'])
+
+add('latest_user_history_exports',
+    '''select distinct on (ha.history_id) ha.id as export_id, ha.dataset_id, ha.history_id, h.name, job.create_time, job.state, job.id as job_id
+       from history as h, job_export_history_archive as ha, job
+       where h.user_id = $1 and
+             h.id = ha.history_id
+             and job.id = ha.job_id
+       order by ha.history_id, job.create_time desc, ha.id''',
+    ['int'])
+
+add('latest_user_history_imports',
+    '''select distinct on (ha.history_id) ha.id as import_id, ha.history_id, h.name, job.create_time, job.state, job.id as job_id
+       from history as h, job_import_history_archive as ha, job
+       where h.user_id = $1 and
+             h.id = ha.history_id
+             and job.id = ha.job_id
+       order by ha.history_id, job.create_time desc, ha.id''',
+    ['int'])
+
+add('user_history_imports',
+    '''select ha.id as import_id, ha.history_id, h.name, job.create_time, job.state, job.id as job_id
+       from galaxy_user as ga, history as h, job_import_history_archive as ha, job
+       where ga.id = $1 and
+             ga.id = h.user_id and
+             h.id = ha.history_id
+             and job.id = ha.job_id''',
+    ['int'])
+
+add('import',
+    '''select ha.id as import_id, ha.history_id, h.name, job.create_time, job.state, job.id as job_id
+       from history as h, job_import_history_archive as ha, job
+       where ha.id = $1 and
+             h.id = ha.history_id
+             and job.id = ha.job_id''',
+    ['int'])
+
+add('jobs',
+    '''select j.update_time, tool_id, j.user_id, email, state, job_runner_name, destination_id
+       from job j, galaxy_user gu
+       where gu.id = j.user_id and
+             ($1 is null or j.update_time > now() - make_interval(secs => $1)) and
+             ($2 is null or j.user_id = $2)
+       order by j.id''',
+    ['int', 'int'])
+
+
+_stats_lock = threading.Lock()
+_stats = {}
+
+
+def _record(name: str, elapsed: float) -> None:
+    with _stats_lock:
+        entry = _stats.setdefault(name, {'calls': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+        entry['calls'] += 1
+        entry['total_ms'] += elapsed * 1000
+        entry['max_ms'] = max(entry['max_ms'], elapsed * 1000)
+
+
+def stats() -> {}:
+    with _stats_lock:
+        res = {}
+        for name, entry in _stats.items():
+            res[name] = dict(entry)
+            res[name]['mean_ms'] = entry['total_ms'] / entry['calls']
+
+    return res
+
+
+def reset_stats() -> None:
+    with _stats_lock:
+        _stats.clear()
+
+
+def execute(conn, prepared: set, name: str, params: [] = None) -> []:
+    # runs the named query on conn, preparing it first if this connection has not seen it yet.
+    # prepared is the set of statement names already prepared on conn
+    query = catalog[name]
+    params = params or []
+
+    if len(params) != len(query.types):
+        raise RuntimeError(f"query {name} takes {len(query.types)} parameters, got {len(params)}")
+
+    start = time.time()
+    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+        if name not in prepared:
+            cursor.execute(query.prepare_sql())
+            prepared.add(name)
+
+        cursor.execute(query.execute_sql(), params)
+        rows = cursor.fetchall()
+
+    _record(name, time.time() - start)
+    return rows
+
+
+def stream(conn, name: str, params: [] = None, chunk_size: int = 1000):
+    # runs the named query through a server side cursor, yielding lists of at most chunk_size rows.
+    # Needs a transaction, so conn is taken out of autocommit mode until the rows are read.
+    query = catalog[name]
+    params = params or []
+
+    if len(params) != len(query.types):
+        raise RuntimeError(f"query {name} takes {len(query.types)} parameters, got {len(params)}")
+
+    sql, values = query.cursor_sql(params)
+
+    start = time.time()
+    conn.autocommit = False
+    try:
+        with conn.cursor(name=f"nga_stream_{name}", cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+            cursor.itersize = chunk_size
+            cursor.execute(sql, values)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+    finally:
+        if not conn.closed:
+            conn.rollback()
+            conn.autocommit = True
+        _record(f"{name} (stream)", time.time() - start)
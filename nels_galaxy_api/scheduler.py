@@ -0,0 +1,167 @@
+import datetime
+import threading
+import time
+
+import kbr.log_utils as logger
+
+# Keeps track of the history exports Galaxy is building, so no worker has to sit and wait for one.
+# All pending exports are polled from a single thread, grouped pr instance. An export that does
+# not change state is polled less and less often (up to max_interval), and the changed callback
+# is only called when the state actually changes. An export galaxy will never finish (paused,
+# deleted, or no longer known) or that is still not done max_age seconds after the tracker was
+# created is given up on.
+
+
+class ExportScheduler(object):
+
+    def __init__(self, poll, changed, min_interval: float = 5, max_interval: float = 300, backoff: float = 2,
+                 done_states: [] = None, failed=None, failed_states: [] = None, max_age: float = 86400):
+        # poll(instance, export_ids) -> {export_id: state}, an export left out is no longer known by
+        # galaxy and one with state None could not be polled this time. changed(tracker, state) is
+        # called on a state change. Exports are dropped once in one of the done_states.
+        # failed(tracker, log) is called for the ones given up on, before they are dropped.
+        self._poll = poll
+        self._changed = changed
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._backoff = backoff
+        self._done_states = done_states or ['ok', 'error']
+        self._failed = failed
+        self._failed_states = failed_states or ['paused', 'deleted', 'deleted_new']
+        self._max_age = max_age
+
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.polls = 0
+        self.updates = 0
+        self.failures = 0
+
+    def add(self, tracker: {}) -> None:
+        with self._lock:
+            self._pending[tracker['id']] = {'tracker': tracker,
+                                            'state': tracker.get('state', None),
+                                            'interval': self._min_interval,
+                                            'created': self._created(tracker),
+                                            'next': time.monotonic() + self._min_interval}
+        self._wakeup.set()
+
+    def remove(self, tracker_id: str) -> None:
+        with self._lock:
+            self._pending.pop(tracker_id, None)
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    @staticmethod
+    def _created(tracker: {}) -> float:
+        # the tracker's create_time as epoch secs, so the age survives a restart. Now if it has none
+        create_time = tracker.get('create_time', None)
+        if isinstance(create_time, str):
+            try:
+                create_time = datetime.datetime.fromisoformat(create_time)
+            except ValueError:
+                create_time = None
+
+        if isinstance(create_time, datetime.datetime):
+            return create_time.timestamp()
+
+        return time.time()
+
+    def poll(self) -> float:
+        # polls the exports that are due, returns the number of seconds until the next one is
+        now = time.monotonic()
+        instances = {}
+        with self._lock:
+            for entry in self._pending.values():
+                if entry['next'] <= now:
+                    instances.setdefault(entry['tracker']['instance'], []).append(entry)
+
+        for instance, entries in instances.items():
+            try:
+                states = self._poll(instance, [entry['tracker']['export_id'] for entry in entries])
+                self.polls += 1
+            except Exception as e:
+                logger.error(f"polling exports on {instance} failed: {e}")
+                states = None
+
+            for entry in entries:
+                tracker = entry['tracker']
+                found = states is None or tracker['export_id'] in states
+                state = None if states is None else states.get(tracker['export_id'], None)
+
+                log = None
+                if not found or state in self._failed_states:
+                    log = f"export {state or 'not found'} in galaxy"
+                elif time.time() - entry['created'] > self._max_age:
+                    log = f"export not done after {int(self._max_age)}s"
+
+                if log is not None:
+                    self._give_up(entry, log)
+                elif state is None or state == entry['state']:
+                    entry['interval'] = min(entry['interval'] * self._backoff, self._max_interval)
+                else:
+                    try:
+                        self._changed(tracker, state)
+                        self.updates += 1
+                        entry['state'] = state
+                        entry['interval'] = self._min_interval
+                    except Exception as e:
+                        # the state is left as it was, so the change is tried again next time
+                        logger.error(f"{tracker['id']}: updating export state to {state} failed: {e}")
+
+                    if entry['state'] in self._done_states:
+                        self.remove(tracker['id'])
+
+                entry['next'] = time.monotonic() + entry['interval']
+
+        with self._lock:
+            if not self._pending:
+                return self._max_interval
+
+            return max(min(entry['next'] for entry in self._pending.values()) - time.monotonic(), 0)
+
+    def _give_up(self, entry: {}, log: str) -> None:
+        tracker = entry['tracker']
+        logger.error(f"{tracker['id']}: {log}, giving up on it")
+        try:
+            if self._failed is not None:
+                self._failed(tracker, log)
+            self.failures += 1
+            self.remove(tracker['id'])
+        except Exception as e:
+            # kept, so it is tried again next time
+            logger.error(f"{tracker['id']}: updating the failed export failed: {e}")
+            entry['interval'] = min(entry['interval'] * self._backoff, self._max_interval)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._wakeup.clear()
+            try:
+                wait = self.poll()
+            except Exception as e:
+                logger.error(f"export scheduler: {e}")
+                wait = self._min_interval
+
+            self._wakeup.wait(wait)
+
+    def start(self) -> None:
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='nga-export-scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self) -> {}:
+        return {'pending': len(self._pending),
+                'polls': self.polls,
+                'updates': self.updates,
+                'failures': self.failures}
@@ -0,0 +1,324 @@
+import contextlib
+import hashlib
+import io
+import os
+import queue
+import shlex
+import threading
+import time
+
+import paramiko
+
+import kbr.log_utils as logger
+
+import nels_galaxy_api.transfer as transfer
+
+# Streams data onto a NeLS (sftp) host without a local copy. The chunks are read by a thread into
+# a bounded buffer and written from there through a pipelined sftp file, so at most buffer_size
+# chunks are held in memory and a slow side holds the other one up. The sha256 of what was sent
+# is checked against the file written before it is moved in place. put and get are the
+# resumable, file to file versions, see transfer.py. ConnectionPool keeps the connections open
+# between transfers.
+
+chunk_size = 1024 * 1024
+buffer_size = 16
+
+
+def connect(hostname: str, username: str, key: str, port: int = 22, timeout: float = 30) -> paramiko.SSHClient:
+    # key is the private rsa key itself, it is not written to disk
+    pkey = paramiko.RSAKey.from_private_key(io.StringIO(key))
+
+    client = paramiko.SSHClient()
+    # same as the StrictHostKeyChecking=no of the scp transfers
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    client.connect(hostname, port=port, username=username, pkey=pkey, timeout=timeout,
+                   allow_agent=False, look_for_keys=False)
+    return client
+
+
+class ConnectionPool(object):
+    # Keeps the ssh connections to the NeLS hosts open between transfers, pr user and host. A
+    # connection is shared by up to max_channels transfers at a time, each on its own sftp channel,
+    # more at the same time for one user get another connection. The keys are only held in memory.
+    # A connection not used for idle_timeout seconds is closed.
+
+    def __init__(self, idle_timeout: float = 300, max_channels: int = 8, port: int = 22):
+        self._idle_timeout = idle_timeout
+        self._max_channels = max_channels
+        self._port = port
+        self._connections = {}
+        self._lock = threading.Lock()
+
+        self.connects = 0
+        self.reuses = 0
+
+    def _usable(self, entry: {}, key: str) -> bool:
+        transport = entry['client'].get_transport()
+        return entry['key'] == key and transport is not None and transport.is_active()
+
+    def _acquire(self, hostname: str, username: str, key: str) -> {}:
+        pool_key = (username, hostname)
+        with self._lock:
+            for entry in self._connections.get(pool_key, []):
+                if entry['users'] < self._max_channels and self._usable(entry, key):
+                    entry['users'] += 1
+                    self.reuses += 1
+                    return entry
+
+        # outside the lock, as the handshake takes a while
+        client = connect(hostname, username, key, port=self._port)
+        entry = {'client': client, 'key': key, 'users': 1, 'last_used': time.monotonic()}
+        with self._lock:
+            self._connections.setdefault(pool_key, []).append(entry)
+            self.connects += 1
+
+        return entry
+
+    def _release(self, entry: {}) -> None:
+        with self._lock:
+            entry['users'] -= 1
+            entry['last_used'] = time.monotonic()
+            idle = entry['users'] == 0
+
+        self.sweep()
+        if idle:
+            timer = threading.Timer(self._idle_timeout + 0.1, self.sweep)
+            timer.daemon = True
+            timer.start()
+
+    @contextlib.contextmanager
+    def connection(self, hostname: str, username: str, key: str) -> paramiko.SSHClient:
+        entry = self._acquire(hostname, username, key)
+        try:
+            yield entry['client']
+        finally:
+            self._release(entry)
+
+    def sweep(self) -> None:
+        # closes the connections that are idle, dropped or use an old key
+        expired = time.monotonic() - self._idle_timeout
+        closing = []
+        with self._lock:
+            for pool_key, entries in list(self._connections.items()):
+                keep = []
+                for entry in entries:
+                    if entry['users'] == 0 and (entry['last_used'] < expired or
+                                                not self._usable(entry, entries[-1]['key'])):
+                        closing.append(entry['client'])
+                    else:
+                        keep.append(entry)
+
+                if keep:
+                    self._connections[pool_key] = keep
+                else:
+                    del self._connections[pool_key]
+
+        for client in closing:
+            client.close()
+
+    def close(self) -> None:
+        with self._lock:
+            entries = [entry for entries in self._connections.values() for entry in entries]
+            self._connections.clear()
+
+        for entry in entries:
+            entry['client'].close()
+
+    def stats(self) -> {}:
+        with self._lock:
+            return {'connections': sum(len(entries) for entries in self._connections.values()),
+                    'in_use': sum(entry['users'] for entries in self._connections.values() for entry in entries),
+                    'connects': self.connects,
+                    'reuses': self.reuses}
+
+
+def _put(buffer: queue.Queue, item: any, stop: threading.Event) -> bool:
+    while not stop.is_set():
+        try:
+            buffer.put(item, timeout=1)
+            return True
+        except queue.Full:
+            continue
+
+    return False
+
+
+def _fill(chunks, buffer: queue.Queue, stop: threading.Event) -> None:
+    # the last thing put in the buffer is None at the end, or the exception reading failed with
+    try:
+        for chunk in chunks:
+            if not _put(buffer, chunk, stop):
+                return
+
+        _put(buffer, None, stop)
+    except Exception as e:
+        _put(buffer, e, stop)
+    finally:
+        # eg releases the http connection the chunks come from
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def copy(chunks, outfile, buffer_size: int = buffer_size) -> ():
+    # writes the chunks to the file object outfile, reading at most buffer_size chunks ahead.
+    # Returns the number of bytes written and their sha256
+    buffer = queue.Queue(maxsize=buffer_size)
+    stop = threading.Event()
+    reader = threading.Thread(target=_fill, args=(chunks, buffer, stop), name='nga-stream-reader', daemon=True)
+    reader.start()
+
+    sha256 = hashlib.sha256()
+    size = 0
+    try:
+        while True:
+            chunk = buffer.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+
+            outfile.write(chunk)
+            sha256.update(chunk)
+            size += len(chunk)
+    finally:
+        stop.set()
+        reader.join()
+
+    return size, sha256.hexdigest()
+
+
+def remote_sha256(client: paramiko.SSHClient, path: str) -> str:
+    # sha256 of a file on the host, None if it cannot be worked out there
+    try:
+        stdin, stdout, stderr = client.exec_command(f"sha256sum {shlex.quote(path)}")
+        output = stdout.read().decode()
+        if stdout.channel.recv_exit_status() != 0:
+            return None
+
+        return output.split()[0]
+    except (paramiko.SSHException, IndexError):
+        return None
+
+
+def _verify(client: paramiko.SSHClient, sftp: paramiko.SFTPClient, path: str, size: int, sha256: str) -> None:
+    # the file on the host against what was transferred
+    remote_size = sftp.stat(path).st_size
+    if remote_size != size:
+        raise RuntimeError(f"{path}: {remote_size} bytes on the host, {size} transferred")
+
+    remote = remote_sha256(client, path)
+    if remote is None:
+        logger.debug(f"{path}: no sha256sum on the host, only the size is checked")
+    elif remote != sha256:
+        raise RuntimeError(f"{path}: sha256 {remote} on the host, {sha256} transferred")
+
+
+def upload(client: paramiko.SSHClient, chunks, dest_file: str, buffer_size: int = buffer_size,
+           verify: bool = True) -> {}:
+    # streams the chunks into dest_file on the host. They go into a .part file that is only
+    # renamed once complete and checked, and is removed if anything fails.
+    part_file = f"{dest_file}.part"
+
+    sftp = client.open_sftp()
+    try:
+        with sftp.open(part_file, 'wb') as f:
+            f.set_pipelined(True)
+            size, sha256 = copy(chunks, f, buffer_size)
+
+        if verify:
+            _verify(client, sftp, part_file, size, sha256)
+
+        sftp.posix_rename(part_file, dest_file)
+
+    except Exception:
+        try:
+            sftp.remove(part_file)
+        except IOError:
+            pass
+        raise
+
+    finally:
+        sftp.close()
+
+    return {'size': size, 'sha256': sha256}
+
+
+def put(client: paramiko.SSHClient, local_file: str, dest_file: str,
+        chunk_size: int = None) -> {}:
+    # copies local_file to dest_file on the host, carrying on from where an earlier attempt got
+    # to. Goes through a .part file that is renamed once it is complete and checked.
+    part_file = f"{dest_file}.part"
+    progress = transfer.Transfer(local_file, chunk_size)
+    chunk_size = progress.chunk_size
+
+    sftp = client.open_sftp()
+    try:
+        try:
+            remote_size = sftp.stat(part_file).st_size
+        except IOError:
+            remote_size = 0
+
+        offset = progress.resume(limit=remote_size)
+        if offset:
+            logger.debug(f"{dest_file}: resuming at {offset}")
+
+        with sftp.open(part_file, 'r+b' if offset else 'wb') as f, open(local_file, 'rb') as src:
+            f.truncate(offset)
+            f.seek(offset)
+            f.set_pipelined(True)
+            src.seek(offset)
+            for data in iter(lambda: src.read(chunk_size), b''):
+                f.write(data)
+                progress.add(data, f)
+
+        try:
+            _verify(client, sftp, part_file, progress.offset, progress.sha256)
+        except RuntimeError:
+            progress.reset()
+            sftp.remove(part_file)
+            raise
+
+        sftp.posix_rename(part_file, dest_file)
+        progress.done()
+
+    finally:
+        sftp.close()
+
+    return {'size': progress.offset, 'sha256': progress.sha256}
+
+
+def get(client: paramiko.SSHClient, remote_file: str, local_file: str,
+        chunk_size: int = None) -> {}:
+    # copies remote_file from the host into local_file, carrying on from where an earlier
+    # attempt got to
+    progress = transfer.Transfer(local_file, chunk_size)
+    chunk_size = progress.chunk_size
+    offset = progress.resume()
+    if offset:
+        logger.debug(f"{remote_file}: resuming at {offset}")
+
+    sftp = client.open_sftp()
+    try:
+        with sftp.open(remote_file, 'rb') as src, open(local_file, 'r+b' if offset else 'wb') as f:
+            f.truncate(offset)
+            f.seek(offset)
+            src.seek(offset)
+            # reads ahead, with a bounded number of requests in flight
+            src.prefetch(max_concurrent_requests=64)
+            for data in iter(lambda: src.read(chunk_size), b''):
+                f.write(data)
+                progress.add(data, f)
+
+        try:
+            _verify(client, sftp, remote_file, progress.offset, progress.sha256)
+        except RuntimeError:
+            progress.reset()
+            os.remove(local_file)
+            raise
+
+        progress.done()
+
+    finally:
+        sftp.close()
+
+    return {'size': progress.offset, 'sha256': progress.sha256}
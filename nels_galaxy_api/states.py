@@ -1,26 +1,130 @@
+import collections
+import json
+import os
+import sqlite3
+import threading
+import time
+
 import kbr.crypt_utils as crypt_utils
 
-# Keeps states structured using "states" dictionary, using a randomly generated id as key.
+# Keeps states structured using "states" store, using a randomly generated id as key.
+# States expire ttl seconds after they were set. The default store is in memory, the sqlite one
+# is kept in a file and can be shared by several processes. Choose one with init().
 
-states = {}
+default_ttl = 3600
 
 
-def set(data: any) -> int:
-    global states
-    uuid = crypt_utils.create_uuid(5)
-    states[uuid] = data
-    return uuid
+class MemoryStore(object):
+    # All states live for the same ttl, so insertion order is also expiry order, and the expired
+    # ones are always at the front.
 
+    def __init__(self, ttl: float = default_ttl):
+        self._ttl = ttl
+        self._states = collections.OrderedDict()
+        self._lock = threading.Lock()
 
-def get(uuid: str, purge: bool = False):
-    global states
+    def _sweep(self, now: float) -> None:
+        while self._states:
+            uuid, (expires, data) = next(iter(self._states.items()))
+            if expires > now:
+                break
+            self._states.popitem(last=False)
+
+    def set(self, uuid: str, data: any) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self._sweep(now)
+            self._states[uuid] = (now + self._ttl, data)
+
+    def get(self, uuid: str, purge: bool = False) -> any:
+        with self._lock:
+            self._sweep(time.monotonic())
+            if uuid not in self._states:
+                return None
+
+            if purge:
+                return self._states.pop(uuid)[1]
+
+            return self._states[uuid][1]
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+
+class SQLiteStore(object):
+    # States as json in a sqlite file. Each process (and thread) opens its own connection, so
+    # it is safe to use after a fork.
+
+    def __init__(self, path: str, ttl: float = default_ttl, sweep_interval: float = 60):
+        self._path = path
+        self._ttl = ttl
+        self._sweep_interval = sweep_interval
+        self._last_sweep = 0
+        self._local = threading.local()
+
+        with self._connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS states (id TEXT PRIMARY KEY, data TEXT, expires REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS states_expires_idx ON states (expires)")
+
+    def _connection(self) -> sqlite3.Connection:
+        if getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self._path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+
+        return self._local.conn
 
-    if uuid not in states:
-        return None
+    def _sweep(self, conn: sqlite3.Connection, now: float) -> None:
+        # wall clock time, as the expiry times are shared between processes
+        if now - self._last_sweep < self._sweep_interval:
+            return
 
-    data = states[uuid]
-    if purge:
-        del states[uuid]
+        self._last_sweep = now
+        conn.execute("DELETE FROM states WHERE expires < ?", [now])
 
-    return data
+    def set(self, uuid: str, data: any) -> None:
+        now = time.time()
+        with self._connection() as conn:
+            self._sweep(conn, now)
+            conn.execute("INSERT OR REPLACE INTO states (id, data, expires) VALUES (?, ?, ?)",
+                         [uuid, json.dumps(data), now + self._ttl])
 
+    def get(self, uuid: str, purge: bool = False) -> any:
+        with self._connection() as conn:
+            row = conn.execute("SELECT data FROM states WHERE id = ? AND expires >= ?", [uuid, time.time()]).fetchone()
+            if row is not None and purge:
+                conn.execute("DELETE FROM states WHERE id = ?", [uuid])
+
+        if row is None:
+            return None
+
+        return json.loads(row[0])
+
+    def __len__(self) -> int:
+        return self._connection().execute("SELECT count(*) FROM states WHERE expires >= ?", [time.time()]).fetchone()[0]
+
+
+store = MemoryStore()
+
+
+def init(backend: str = 'memory', ttl: float = default_ttl, path: str = None) -> None:
+    global store
+    if backend == 'memory':
+        store = MemoryStore(ttl)
+    elif backend == 'sqlite':
+        if path is None:
+            raise RuntimeError('the sqlite states store needs a path')
+        store = SQLiteStore(path, ttl)
+    else:
+        raise RuntimeError(f"Unknown states backend '{backend}'")
+
+
+def set(data: any) -> str:
+    uuid = crypt_utils.create_uuid(5)
+    store.set(uuid, data)
+    return uuid
+
+
+def get(uuid: str, purge: bool = False):
+    return store.get(uuid, purge)
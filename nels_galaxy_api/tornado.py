@@ -1,7 +1,19 @@
 import json
+import os
+import random
+import re
+import signal
+import sys
+import time
 import tornado
 
+from tornado import gen
+from tornado import iostream
+
+from tornado.httpserver import HTTPServer
 from tornado.ioloop import IOLoop
+from tornado.netutil import bind_sockets
+from tornado.process import cpu_count
 from tornado.web import Application
 
 from tornado.web import RequestHandler, HTTPError
@@ -16,6 +28,16 @@ import pprint as pp
 
 token = None
 
+# the requests being handled, so a stopping server can let them finish
+active_requests = set()
+
+# a worker that exits with this is restarted by the parent process
+reload_exit_code = 3
+
+# pid -> task id of the workers, in the parent. In a worker, its own task id
+_workers = {}
+_task_id = None
+
 # Basic tornado functionality in order to be reused/extended (in this case, by nels-galaxy-api.py)
 
 # bespoke decoder to handle UUID and timestamps
@@ -70,12 +92,20 @@ class BaseHandler( RequestHandler ):
     def prepare(self):
         ''' change the strings from bytestring to utf8 '''
 
+        active_requests.add(self)
         self.form_data = {
             key: [val.decode('utf8') for val in val_list]
             for key, val_list in self.request.arguments.items()
         }
 
 
+    def on_finish(self):
+        active_requests.discard(self)
+
+    def on_connection_close(self):
+        active_requests.discard(self)
+
+
     def arguments(self):
 
         values = {}
@@ -154,15 +184,46 @@ class BaseHandler( RequestHandler ):
 
 
         self.set_status(status)
-        # check if the data is already in valid json format, otherwise make it
-        try:
-            json_object = json.loads( data )
-        except TypeError as e:
+        # strings and bytes are taken to be json already, everything else is serialised
+        if not isinstance(data, (str, bytes)):
             data = json.dumps(data, cls=UUIDEncoder)
 
         self.finish( data  )
 
 
+    async def send_response_stream(self, chunks, transform=None, status=200):
+        """Send a JSON array built from an async iterator of row lists, one chunk at a time."""
+
+        if token is not None:
+            self.set_auth_token( token)
+
+        self.set_status(status)
+        self.set_json_header()
+
+        # only one chunk of rows and its json is held at a time, flush hands it over to the
+        # connection before the next one is read
+        try:
+            first = True
+            self.write("[")
+            async for chunk in chunks:
+                if transform is not None:
+                    chunk = transform(chunk)
+
+                if not chunk:
+                    continue
+
+                rows = ",".join(json.dumps(row, cls=UUIDEncoder) for row in chunk)
+                self.write(rows if first else "," + rows)
+                first = False
+                await self.flush()
+
+            self.write("]")
+        finally:
+            await chunks.aclose()
+
+        self.finish()
+
+
     def send_status_code(self, status:int):
         """Construct and send an empty response with appropriate status code."""
 
@@ -184,6 +245,68 @@ class BaseHandler( RequestHandler ):
         handler.finish()
 
 
+    async def send_file_range(self, file_path: str, chunk_size: int = 1024 * 1024) -> None:
+        """Send a file, or the byte range of it asked for, without blocking the IOLoop."""
+
+        loop = IOLoop.current()
+        stat = await loop.run_in_executor(None, os.stat, file_path)
+        size = stat.st_size
+        etag = '"{:x}-{:x}"'.format(stat.st_mtime_ns, size)
+
+        self.set_header('Content-Type', 'application/octet-stream')
+        self.set_header('Accept-Ranges', 'bytes')
+        self.set_header('Etag', etag)
+
+        if self.check_etag_header():
+            self.set_status(304)
+            return self.finish()
+
+        start, end = 0, size
+        range_header = self.request.headers.get('Range')
+        if_range = self.request.headers.get('If-Range')
+        # a range is only honoured if the file is still the one the client started on
+        if range_header is not None and (if_range is None or if_range == etag):
+            byte_range = parse_range(range_header, size)
+            if byte_range is None:
+                self.set_status(416)
+                self.set_header('Content-Range', 'bytes */{}'.format(size))
+                return self.finish()
+
+            if byte_range != (0, size):
+                start, end = byte_range
+                self.set_status(206)
+                self.set_header('Content-Range', 'bytes {}-{}/{}'.format(start, end - 1, size))
+
+        self.set_header('Content-Length', end - start)
+
+        fd = await loop.run_in_executor(None, os.open, file_path, os.O_RDONLY)
+        try:
+            offset = start
+            while offset < end:
+                chunk = await loop.run_in_executor(None, os.pread, fd, min(chunk_size, end - offset), offset)
+                if not chunk:
+                    break
+                offset += len(chunk)
+                self.write(chunk)
+                try:
+                    await self.flush()
+                except iostream.StreamClosedError:
+                    # the client went away, it can resume with a range request
+                    logger.debug(f"download of {file_path} stopped at {offset}/{size}")
+                    return
+        finally:
+            os.close(fd)
+
+        if offset < end:
+            # the file shrunk while being sent. Less than Content-Length has gone out, so the
+            # connection is closed for the client to see the download as broken, not finished
+            logger.error(f"{file_path} truncated while being sent, stopped at {offset}/{end}")
+            self.request.connection.close()
+            return
+
+        self.finish()
+
+
     # Success
     def send_response_200(self):
         return self.send_response( data=None, status=200)
@@ -287,6 +410,29 @@ class BaseHandler( RequestHandler ):
 
 
 
+def parse_range(header: str, size: int) -> ():
+    """(start, end) of a single 'bytes=' range, end exclusive. (0, size) if the header is not
+    one we handle, None if the range cannot be satisfied."""
+
+    match = re.fullmatch(r'\s*bytes=(\d*)-(\d*)\s*', header)
+    if match is None or match.group(1) == match.group(2) == '':
+        # multiple ranges or junk, send the whole file
+        return 0, size
+
+    first, last = match.groups()
+    if first == '':
+        # suffix range, the last n bytes
+        start, end = max(size - int(last), 0), size
+    else:
+        start = int(first)
+        end = size if last == '' else min(int(last) + 1, size)
+
+    if start >= size or start >= end:
+        return None
+
+    return start, end
+
+
 def json_decode(value):
 
     return tornado.escape.json_decode( value )
@@ -302,11 +448,135 @@ def set_token(new_token:str):
     token = new_token
 
 
-def run_app(urls, port=8888, **kwargs):
+def task_id() -> int:
+    # the number of this worker, None if not forked by run_app
+    return _task_id
+
+
+def _forward_signal(signum, frame) -> None:
+    # the parent passes the signal on to its workers, and only to them
+    for pid in list(_workers):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+
+def _start_worker(task_id: int) -> int:
+    # forks a worker, returns its task id in the worker and None in the parent
+    pid = os.fork()
+    if pid == 0:
+        global _task_id
+        _task_id = task_id
+        _workers.clear()
+        random.seed()
+        # the worker sets up its own handlers once it is running
+        for signum in (signal.SIGTERM, signal.SIGHUP):
+            signal.signal(signum, signal.SIG_DFL)
+        return task_id
+
+    _workers[pid] = task_id
+    return None
+
+
+def _fork_workers(processes: int, max_restarts: int = 100) -> int:
+    # as tornado's fork_processes, but keeping the pids of the workers so the parent can signal them.
+    # Returns the task id in the workers, the parent exits once they all have stopped normally.
+    if processes <= 0:
+        processes = cpu_count()
+
+    for i in range(processes):
+        if _start_worker(i) is not None:
+            return i
+
+    restarts = 0
+    while _workers:
+        pid, status = os.wait()
+        if pid not in _workers:
+            continue
+
+        task_id = _workers.pop(pid)
+        if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+            logger.info(f"worker {task_id} (pid {pid}) stopped")
+            continue
+
+        if os.WIFEXITED(status) and os.WEXITSTATUS(status) == reload_exit_code:
+            logger.info(f"worker {task_id} (pid {pid}) reloading")
+        else:
+            logger.warn(f"worker {task_id} (pid {pid}) died with status {status}, restarting")
+
+        restarts += 1
+        if restarts > max_restarts:
+            raise RuntimeError("Too many worker restarts, giving up")
+
+        if _start_worker(task_id) is not None:
+            return task_id
+
+    sys.exit(0)
+
+
+async def _stop_server(server: HTTPServer, timeout: float) -> None:
+    # stops accepting connections and gives the running requests timeout seconds to finish
+    server.stop()
+
+    deadline = time.monotonic() + timeout
+    while active_requests and time.monotonic() < deadline:
+        await gen.sleep(0.1)
+
+    if active_requests:
+        logger.warn(f"stopping with {len(active_requests)} requests still running")
+
+    IOLoop.current().stop()
+
+
+def run_app(urls, port=8888, processes: int = 1, worker_init=None, on_start=None, on_stop=None,
+            shutdown_timeout: float = 10, **kwargs):
+    # processes > 1 (0 is one pr cpu) forks workers sharing the listening socket. Connections
+    # (db, mq, http sessions) do not survive a fork, worker_init is called in each worker to set
+    # them up. SIGTERM/SIGINT stop the server when the running requests are done, SIGHUP reloads
+    # it: workers are restarted by the parent, a single process restarts itself. The parent is not
+    # reloaded, the workers read the config again in worker_init, but a changed port, processes or
+    # shutdown_timeout needs a full restart. on_start is called in each process before it starts
+    # serving (timers etc), on_stop once it has stopped serving.
+
+    sockets = bind_sockets(port)
+
+    if processes != 1:
+        for signum in (signal.SIGTERM, signal.SIGHUP):
+            signal.signal(signum, _forward_signal)
+
+        _fork_workers(processes, max_restarts=10000)
+        logger.info(f"worker {_task_id} started, pid {os.getpid()}")
+
+    if worker_init is not None:
+        worker_init()
 
     app = Application(urls, **kwargs)
-    app.listen(port)
-    IOLoop.current().start()
+    server = HTTPServer(app)
+    server.add_sockets(sockets)
+
+    io_loop = IOLoop.current()
+    reload = False
+
+    if on_start is not None:
+        on_start()
+
+    def shutdown(signum):
+        nonlocal reload
+        reload = signum == signal.SIGHUP
+        io_loop.add_callback(_stop_server, server, shutdown_timeout)
+
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        io_loop.asyncio_loop.add_signal_handler(signum, shutdown, signum)
+
+    io_loop.start()
 
+    if on_stop is not None:
+        on_stop()
 
+    if reload:
+        if processes != 1:
+            sys.exit(reload_exit_code)
 
+        logger.info("reloading")
+        os.execv(sys.executable, [sys.executable] + sys.argv)
@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+
+# Resumable transfers of a local file (the one written, or the one sent). Progress is kept in a
+# sidecar file next to it, <file>.progress, as the sha256 of each chunk done: a header line with
+# the chunk size and a line appended pr chunk. A retry reads the chunks back, checks them, and
+# carries on after the last good one, so it only costs the bytes still missing. As every chunk is
+# checked against the file then, nothing has to be synced while transferring. The sha256 of the
+# whole file is there at the end to verify against.
+
+default_chunk_size = 8 * 1024 * 1024
+
+
+class Transfer(object):
+
+    def __init__(self, path: str, chunk_size: int = None):
+        self.path = path
+        self.progress_file = f"{path}.progress"
+        self.chunk_size = chunk_size or default_chunk_size
+        self.offset = 0
+
+        self._chunks = self._load()
+        self._sha256 = hashlib.sha256()
+        self._chunk = hashlib.sha256()
+        self._in_chunk = 0
+        self._log = None
+
+    def _load(self) -> []:
+        try:
+            with open(self.progress_file) as f:
+                header = json.loads(f.readline())
+                lines = [line.rstrip('\n') for line in f]
+        except (OSError, ValueError):
+            return []
+
+        # chunks of another size cannot be checked, start over
+        if not isinstance(header, dict) or header.get('chunk_size') != self.chunk_size:
+            return []
+
+        # a line cut short when the transfer was stopped ends the list
+        chunks = []
+        for line in lines:
+            if len(line) != 64:
+                break
+            chunks.append(line)
+
+        return chunks
+
+    def resume(self, limit: int = None) -> int:
+        # checks the chunks done against the local file, up to limit bytes (eg what the other end
+        # has got), and returns the offset to carry on from
+        verified = []
+        sha256 = hashlib.sha256()
+
+        if os.path.isfile(self.path):
+            with open(self.path, 'rb') as f:
+                for expected in self._chunks:
+                    if limit is not None and (len(verified) + 1) * self.chunk_size > limit:
+                        break
+
+                    data = f.read(self.chunk_size)
+                    if len(data) < self.chunk_size or hashlib.sha256(data).hexdigest() != expected:
+                        break
+
+                    sha256.update(data)
+                    verified.append(expected)
+
+        # the sidecar is written again, without the chunks dropped, when the next one is done
+        self._close()
+        self._chunks = verified
+        self._sha256 = sha256
+        self._chunk = hashlib.sha256()
+        self._in_chunk = 0
+        self.offset = len(verified) * self.chunk_size
+
+        return self.offset
+
+    def add(self, data: bytes, outfile=None) -> None:
+        # data has been transferred, records the chunks it completes. outfile, the file written
+        # to, is flushed before a chunk is recorded
+        data = memoryview(data)
+        while len(data):
+            size = min(len(data), self.chunk_size - self._in_chunk)
+            self._sha256.update(data[:size])
+            self._chunk.update(data[:size])
+            self._in_chunk += size
+            self.offset += size
+            data = data[size:]
+
+            if self._in_chunk == self.chunk_size:
+                self._chunks.append(self._chunk.hexdigest())
+                self._chunk = hashlib.sha256()
+                self._in_chunk = 0
+                self._record(outfile)
+
+    def _record(self, outfile=None) -> None:
+        # appends the last chunk done to the sidecar, writing it from scratch first if needed
+        if outfile is not None:
+            outfile.flush()
+
+        if self._log is None:
+            tmp_file = f"{self.progress_file}.tmp"
+            with open(tmp_file, 'w') as f:
+                f.write(json.dumps({'chunk_size': self.chunk_size}) + "\n")
+                f.writelines(f"{chunk}\n" for chunk in self._chunks[:-1])
+            os.replace(tmp_file, self.progress_file)
+            self._log = open(self.progress_file, 'a')
+
+        self._log.write(f"{self._chunks[-1]}\n")
+        self._log.flush()
+
+    def _close(self) -> None:
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+    @property
+    def sha256(self) -> str:
+        # of everything transferred so far
+        return self._sha256.hexdigest()
+
+    def done(self) -> None:
+        self._close()
+        if os.path.isfile(self.progress_file):
+            os.remove(self.progress_file)
+
+    def reset(self) -> None:
+        # the transfer turned out bad, the next one starts from scratch
+        self.done()
+        self._chunks = []
+        self.resume()
@@ -1,34 +1,160 @@
 import os
+import datetime
+import dbm
+import functools
+import hashlib
+import json
+import threading
 
 from Crypto.Cipher import Blowfish
 from Crypto.Random import get_random_bytes
 import codecs
 
-import kbr.file_utils as file_utils
 import re
-import sys
 import requests
 import time
 
+import kbr.log_utils as logger
+
+import nels_galaxy_api.cache as cache
+
 id_cipher = None
 
+# ids repeat a lot (users, histories), so keep the most recent ones around
+id_cache_size = 65536
+
 def init( id_secret:str) -> None:
     global id_cipher
     id_cipher = Blowfish.new(id_secret.encode('utf-8'), mode=Blowfish.MODE_ECB)
+    _decrypt.cache_clear()
+    _encrypt.cache_clear()
 
 
-def decrypt_value(value:str) -> str:
-    value = str(value)
+@functools.lru_cache(maxsize=id_cache_size)
+def _decrypt(value:str) -> str:
     value_hex = codecs.decode(value, 'hex')
-    decrypted_value = id_cipher.decrypt( value_hex ).decode("utf-8").lstrip("!")
-    return decrypted_value
+    return id_cipher.decrypt( value_hex ).decode("utf-8").lstrip("!")
 
-def encrypt_value(value:str) -> str:
-    value = str(value)
+@functools.lru_cache(maxsize=id_cache_size)
+def _encrypt(value:str) -> str:
+    return codecs.encode(id_cipher.encrypt(_pad(value)), 'hex').decode("utf-8")
+
+def _pad(value:str) -> bytes:
+    # galaxy pads with '!' in front up to the next 8 byte block (a full block if already aligned)
     value = value.encode('utf-8')
-    s = (b"!" * (8 - len(value) % 8)) + value
-    # Encrypt
-    return codecs.encode(id_cipher.encrypt(s), 'hex').decode("utf-8")
+    return (b"!" * (8 - len(value) % 8)) + value
+
+def decrypt_value(value:str) -> str:
+    return _decrypt(str(value))
+
+def encrypt_value(value:str) -> str:
+    return _encrypt(str(value))
+
+def encrypt_values(values:[]) -> []:
+    # Same as encrypt_value on each value, but the distinct values are padded, concatenated and
+    # run through the cipher in one go. ECB encrypts each block on its own, so this is safe.
+    values = [str(value) for value in values]
+    unique = list(dict.fromkeys(values))
+    padded = [_pad(value) for value in unique]
+
+    encrypted = id_cipher.encrypt(b"".join(padded)).hex()
+
+    lookup = {}
+    offset = 0
+    for value, pad in zip(unique, padded):
+        lookup[value] = encrypted[offset: offset + 2 * len(pad)]
+        offset += 2 * len(pad)
+
+    return [lookup[value] for value in values]
+
+# dataset id -> file path, kept in a dbm file if init_dataset_index was given one, in memory otherwise.
+# The dbm file is opened once pr process, and is not shared between processes.
+dataset_index_file = None
+dataset_scan_limit = 10000
+_dataset_index = {}
+_dataset_db = None
+_dataset_index_lock = threading.Lock()
+_dataset_scan = None
+_dataset_scan_lock = threading.Lock()
+_dataset_stats = {'hits': 0, 'misses': 0, 'scanned': 0, 'not_found': 0}
+_dataset_stats_lock = threading.Lock()
+_dataset_file = re.compile(r'dataset_(\d+)\.dat')
+
+def init_dataset_index(index_file:str=None, scan_limit:int=10000) -> None:
+    global dataset_index_file, dataset_scan_limit, _dataset_scan, _dataset_db
+    with _dataset_index_lock:
+        if _dataset_db is not None:
+            _dataset_db.close()
+            _dataset_db = None
+
+        dataset_index_file = index_file
+        dataset_scan_limit = scan_limit
+        _dataset_index.clear()
+        _dataset_scan = None
+
+        if index_file is not None:
+            try:
+                _dataset_db = dbm.open(index_file, 'c')
+            except dbm.error as e:
+                logger.warn(f"cannot open the dataset index {index_file}, keeping it in memory: {e}")
+
+def _count_dataset(stat:str, count:int=1) -> None:
+    with _dataset_stats_lock:
+        _dataset_stats[stat] += count
+
+def _index_get(obj_id:str) -> str:
+    with _dataset_index_lock:
+        if _dataset_db is None:
+            return _dataset_index.get(obj_id)
+        path = _dataset_db.get(obj_id)
+
+    return path.decode('utf-8') if path is not None else None
+
+def _index_set(paths:{}) -> None:
+    if not paths:
+        return
+
+    with _dataset_index_lock:
+        if _dataset_db is None:
+            _dataset_index.update(paths)
+            return
+        for obj_id, path in paths.items():
+            _dataset_db[obj_id] = path
+
+def _scan_datasets(file_dir:str) -> {}:
+    # Walks on through the file_dir tree from where the previous scan stopped, looking at no more
+    # than dataset_scan_limit files and directories. Starts over once the whole tree has been seen.
+    global _dataset_scan
+    paths = {}
+    seen = 0
+    with _dataset_scan_lock:
+        if _dataset_scan is None or _dataset_scan[0] != file_dir:
+            _dataset_scan = (file_dir, os.walk(file_dir))
+
+        while seen < dataset_scan_limit:
+            try:
+                root, dirs, files = next(_dataset_scan[1])
+            except StopIteration:
+                _dataset_scan = None
+                break
+
+            seen += 1 + len(files)
+            for name in files:
+                match = _dataset_file.fullmatch(name)
+                if match is not None:
+                    paths[match.group(1)] = os.path.join(root, name)
+
+    _count_dataset('scanned', seen)
+    _index_set(paths)
+    return paths
+
+def dataset_index_stats() -> {}:
+    with _dataset_stats_lock:
+        return dict(_dataset_stats, file=dataset_index_file, scan_limit=dataset_scan_limit)
+
+def id_cache_stats() -> {}:
+    return {'encrypt': _encrypt.cache_info()._asdict(),
+            'decrypt': _decrypt.cache_info()._asdict()}
 
 def directory_hash_id(id):
     s = str(id)
@@ -63,13 +189,21 @@ def construct_file_path(obj_id, file_dir=None):
     # extra_dir should never be constructed from provided data but just
     # make sure there are no shenannigans afoot
 
+    obj_id = str(obj_id)
+    path = _index_get(obj_id)
+    if path is not None and os.path.isfile(path):
+        _count_dataset('hits')
+        return path
+
+    _count_dataset('misses')
+
     # Construct hashed path
     rel_path = os.path.join(*directory_hash_id(obj_id))
     # Create a subdirectory for the object ID
     path = os.path.join(base, rel_path)
     path = os.path.join(path, "dataset_%s.dat" % obj_id)
-    print( f"Trying new style path  {path} ")
     if os.path.isfile(path):
+        _index_set({obj_id: path})
         return path
 
     #Try old style dir names:
@@ -77,14 +211,51 @@ def construct_file_path(obj_id, file_dir=None):
     path = base
     path = os.path.join(path, "dataset_%s.dat" % obj_id)
     if os.path.isfile( path ):
+        _index_set({obj_id: path})
         return path
 
-
-    path = file_utils.find_first("dataset_%s.dat" % obj_id, file_dir)
+    # somewhere else in the tree, look through the next part of it. Everything found on the way
+    # is indexed, so a later call for this (or another) dataset might find it there. The scan is
+    # bounded, so an unknown dataset costs at most dataset_scan_limit files.
+    path = _scan_datasets(file_dir).get(obj_id)
     if path is not None:
         return path
 
-    raise RuntimeError(f"Cannot find dataset: 'dataset_{obj_id}.dat'")
+    _count_dataset('not_found')
+    raise FileNotFoundError(f"Cannot find dataset: 'dataset_{obj_id}.dat'")
+
+
+def file_sha256(path:str) -> {}:
+    # sha256 and size of a file. Reading all of a large export takes a while, so the sha256 is
+    # kept for as long as the file is not changed, in memory and in <path>.sha256 if it can be
+    # written, so it survives a restart
+    stat = os.stat(path)
+    return {'sha256': _file_sha256(path, stat.st_mtime_ns, stat.st_size), 'size': stat.st_size}
+
+@functools.lru_cache(maxsize=256)
+def _file_sha256(path:str, mtime_ns:int, size:int) -> str:
+    sha256_file = f"{path}.sha256"
+    try:
+        with open(sha256_file) as f:
+            saved = json.load(f)
+        if saved.get('mtime_ns') == mtime_ns and saved.get('size') == size:
+            return saved['sha256']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+
+    try:
+        with open(sha256_file, 'w') as f:
+            json.dump({'sha256': sha256.hexdigest(), 'size': size, 'mtime_ns': mtime_ns}, f)
+    except OSError:
+        # a read only file store, only kept in memory then
+        pass
+
+    return sha256.hexdigest()
 
 
 def create_uuid(length=16):
@@ -101,12 +272,7 @@ def encrypt_ids(entry: any) -> []:
         return entry
 
     if isinstance(entry, dict):
-        for key in entry.keys():
-            if key == 'nels_id':
-                continue
-
-            if key == 'id' or key.find('_id') > -1 and isinstance(entry[key], int):
-                entry[f"{key}"] = encrypt_value(entry[key])
+        list_encrypt_ids([entry])
 
     else:
         raise RuntimeError(f"Cannot change ids in {entry}")
@@ -114,9 +280,39 @@ def encrypt_ids(entry: any) -> []:
     return entry
 
 
+@functools.lru_cache(maxsize=1024)
+def _id_key(key:str) -> int:
+    # 0: not an id, 1: always an id ('id'), 2: an id if the value is an int (*_id)
+    if key == 'nels_id':
+        return 0
+
+    if key == 'id':
+        return 1
+
+    return 2 if key.find('_id') > -1 else 0
+
+
 def list_encrypt_ids(entries: []) -> []:
+    # collects the ids from all the entries and encrypts them in one batch
+    positions = []
+    values = []
     for entry in entries:
-        entry = encrypt_ids(entry)
+        if isinstance(entry, list):
+            list_encrypt_ids(entry)
+            continue
+
+        if not isinstance(entry, dict):
+            raise RuntimeError(f"Cannot change ids in {entry}")
+
+        for key, value in entry.items():
+            kind = _id_key(key)
+            if kind == 1 or kind == 2 and isinstance(value, int):
+                positions.append((entry, key))
+                values.append(value)
+
+    if values:
+        for (entry, key), encrypted in zip(positions, encrypt_values(values)):
+            entry[key] = encrypted
 
     return entries
 
@@ -142,66 +338,54 @@ def timedelta_to_epoc(timerange) -> int:
     time_delta = ts - timedelta_to_sec( timerange)
     return time_delta
 
+# seconds in each of the timerange units, a month is 30 days and a year 365
+timerange_units = {'m': 60, 'h': 3600, 'd': 24*3600, 'w': 7*24*3600, 'M': 30*24*3600, 'Y': 365*24*3600}
+
 def timedelta_to_sec(timerange) -> int:
-    ''' 1m, 3h, 2d, 1w --> now - delta as epoc secs '''
+    ''' 1m, 3h, 2d, 1w, 1M, 1Y --> the delta in secs, ValueError if it is not one of these '''
 
     if timerange == '' or timerange is None:
         return 0
 
-    time_delta = 0
-    try:
-        g = re.match(r'(\d+)([mhdwMY])', timerange)
-        num, range = g.groups(0)
-        if range == 'm':
-            time_delta = 60*int(num)
-        if range == 'h':
-            time_delta = 3600*int(num)
-        elif range == 'd':
-            time_delta = 24*3600*int(num)
-        elif range == 'w':
-            time_delta = 24*3600*7*int(num)
-        elif range == 'M':
-            time_delta = 30*24*3600*7*int(num)
-        elif range == '1Y':
-            time_delta = 365*24*3600*7*int(num)
-    except Exception as e:
-        print( f"timerange {timerange} is invalid valid examples: 5m, 1d, 2h, 1w, 1M, 1Y")
-        sys.exit(1)
+    g = re.fullmatch(r'(\d+)([mhdwMY])', timerange)
+    if g is None:
+        raise ValueError(f"timerange {timerange} is invalid valid examples: 5m, 1d, 2h, 1w, 1M, 1Y")
 
-    return time_delta
+    num, unit = g.groups()
+    return int(num) * timerange_units[unit]
 
 
+def time_arg(value: str) -> datetime.datetime:
+    ''' 2021-03-01T12:00:00 or 3h, 2d, 1w (that long ago) --> datetime, ValueError if neither '''
 
-def get_ssh_credential(config, nels_id: int, tmpfile=True):
+    if re.fullmatch(r'\d+[mhdwMY]', value):
+        return datetime.datetime.now() - datetime.timedelta(seconds=timedelta_to_sec(value))
 
-    nels_storage_client_key = config['nels_storage_client_key']
-    nels_storage_client_secret = config['nels_storage_client_secret']
-    nels_storage_url = config['nels_storage_url'].rstrip("/")
+    return datetime.datetime.fromisoformat(value)
 
-    # make sure the id is a string
-#    nels_id = str(nels_id)
-    #    api_url = 'https://nels.bioinfo.no/'
-    #    api_url = 'https://test-fe.cbu.uib.no/nels-'
 
-    api_url = f"{nels_storage_url}/users/{nels_id}"
-    #    logger.debug(f"API URL: {api_url}")
-    response = requests.get(api_url, auth=(nels_storage_client_key, nels_storage_client_secret))
-    if (response.status_code == requests.codes.ok):
-        json_response = response.json()
 
-        if tmpfile:
-            tmp = tempfile.NamedTemporaryFile(mode='w+t', suffix=".txt", dir=tmp_dir, delete=False)
-            tmp.write(json_response['key-rsa'])
-            tmp.close()
-            json_response['key_file'] = tmp.name
-        else:
-            outfile = f"{nels_id}.rsa"
-            file_utils.write(outfile, json_response['key-rsa'])
-            os.chmod(outfile, 0o600)
-            json_response['key_file'] = outfile
+# NeLS storage credentials pr nels_id, a bulk export asks for the same one over and over. Only
+# kept in memory, ask again with refresh=True if the key is turned down.
+ssh_credentials = cache.TTLCache(size=1000, ttl=300)
 
-        return json_response
-    else:
+def nels_ssh_credential(nels_storage_url:str, client_key:str, client_secret:str, nels_id: int,
+                        refresh:bool=False) -> {}:
+    nels_id = str(nels_id)
+    if refresh:
+        ssh_credentials.delete(nels_id)
+
+    credential = ssh_credentials.get(nels_id)
+    if credential is not None:
+        return credential
+
+    api_url = f"{nels_storage_url.rstrip('/')}/users/{nels_id}"
+    response = requests.get(api_url, auth=(client_key, client_secret), timeout=60)
+    if response.status_code != requests.codes.ok:
         raise Exception("HTTP response code=%s" % str(response.status_code))
 
+    credential = response.json()
+    ssh_credentials.set(nels_id, credential)
+    return credential
+
 
@@ -0,0 +1,83 @@
+import collections
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+import kbr.log_utils as logger
+
+# Thread pool for the runner. Jobs are submitted with a list of keys (eg the instance and the
+# stage they work on), and a key can be given a limit on how many of its jobs run at once. A job
+# over a limit waits, without holding a thread, until a job with the same key finishes.
+
+
+class WorkerPool(object):
+
+    def __init__(self, workers: int = 4, limits: {} = None):
+        self._workers = workers
+        self._limits = limits or {}
+        self._executor = ThreadPoolExecutor(workers, 'nga-worker')
+        self._lock = threading.Lock()
+        self._running = collections.Counter()
+        self._waiting = collections.deque()
+        self._closed = False
+
+    def set_limit(self, key: str, limit: int) -> None:
+        with self._lock:
+            self._limits[key] = limit
+
+    def _can_run(self, keys: []) -> bool:
+        for key in keys:
+            if key in self._limits and self._running[key] >= self._limits[key]:
+                return False
+        return True
+
+    def submit(self, keys: [], func, *args) -> bool:
+        # returns False if the job has to wait for a free slot
+        with self._lock:
+            if self._closed:
+                return False
+
+            if not self._can_run(keys):
+                self._waiting.append((keys, func, args))
+                return False
+
+            self._start(keys, func, args)
+            return True
+
+    def _start(self, keys: [], func, args: ()) -> None:
+        # called with the lock held
+        for key in keys:
+            self._running[key] += 1
+        self._executor.submit(self._run, keys, func, args)
+
+    def _run(self, keys: [], func, args: ()) -> None:
+        try:
+            func(*args)
+        except Exception as e:
+            logger.error(f"worker {func.__name__} failed: {e}")
+        finally:
+            with self._lock:
+                for key in keys:
+                    self._running[key] -= 1
+
+                # start what is now within the limits, in the order it was submitted
+                waiting = self._waiting
+                self._waiting = collections.deque()
+                for job in waiting:
+                    if not self._closed and self._can_run(job[0]):
+                        self._start(*job)
+                    else:
+                        self._waiting.append(job)
+
+    def shutdown(self, wait: bool = True) -> None:
+        # waiting jobs are dropped, the running ones finish if wait is set
+        with self._lock:
+            self._closed = True
+            self._waiting.clear()
+        self._executor.shutdown(wait=wait)
+
+    def stats(self) -> {}:
+        with self._lock:
+            return {'workers': self._workers,
+                    'running': {key: count for key, count in self._running.items() if count},
+                    'waiting': len(self._waiting)}
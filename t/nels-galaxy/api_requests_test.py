@@ -0,0 +1,217 @@
+import asyncio
+import hashlib
+import http.server
+import json
+import os
+import socket
+import threading
+import urllib.parse
+
+import pytest
+
+import nels_galaxy_api.api_requests as api_requests
+
+# Runs the client against a small local http server
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    fails = 0
+    pages = []
+    archive = bytes(range(256)) * 1000
+    drops = 0
+    ranges = []
+
+    def do_GET(self):
+        if self.path.startswith('/exports/'):
+            return self.send_page()
+
+        if self.path.startswith('/history/download/'):
+            return self.send_archive()
+
+        if self.path.startswith('/flaky') and Handler.fails > 0:
+            Handler.fails -= 1
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        body = json.dumps({'path': self.path, 'auth': self.headers.get('Authorization')}).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_page(self):
+        # keyset pages of 7 trackings, the filter comes in the body
+        length = int(self.headers.get('Content-Length', 0))
+        filter = dict(urllib.parse.parse_qsl(self.rfile.read(length).decode()))
+        Handler.pages.append(filter)
+
+        after_id = int(filter.get('after_id', 0))
+        page = [{'id': i, 'path': self.path} for i in range(after_id + 1, 8)][:int(filter['limit'])]
+
+        body = json.dumps(page).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_archive(self):
+        # supports Range, and drops the connection half way through while drops > 0
+        start = 0
+        if 'Range' in self.headers:
+            start = int(self.headers['Range'][len('bytes='):-1])
+            Handler.ranges.append(start)
+
+        body = Handler.archive[start:]
+        self.send_response(206 if start else 200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Etag', '"archive"')
+        self.end_headers()
+
+        if Handler.drops > 0:
+            Handler.drops -= 1
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            self.connection.shutdown(socket.SHUT_RDWR)
+            return
+
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope='module')
+def base_url():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+
+
+def test_request(base_url):
+    api = api_requests.ApiRequests(base_url, 'secret')
+    res = api.get_info()
+    assert res == {'path': '/info/', 'auth': 'bearer secret'}
+
+
+def test_connection_reused(base_url):
+    api_requests.configure()
+    api = api_requests.ApiRequests(base_url)
+    other = api_requests.ApiRequests(base_url)
+    for _ in range(5):
+        api.get_info()
+        other.get_base()
+
+    hosts = api_requests.stats()['hosts']
+    assert hosts[base_url]['requests'] == 10
+    assert hosts[base_url]['connections'] == 1
+    assert hosts[base_url]['reused'] == 9
+
+
+def test_endpoint_stats(base_url):
+    api_requests.reset_stats()
+    api = api_requests.ApiRequests(base_url)
+    api.get_user('user@example.org')
+    api.get_user('other@example.org')
+    api.get_export('bc729496af0697be')
+    api.get_state('42')
+
+    endpoints = api_requests.stats()['endpoints']
+    assert endpoints['GET /user/{email}/']['calls'] == 2
+    assert endpoints['GET /export/{id}/']['calls'] == 1
+    assert endpoints['GET /state/{id}/']['calls'] == 1
+
+
+def test_retry(base_url):
+    api_requests.configure(max_retries=3, backoff_factor=0)
+    api = api_requests.ApiRequests(base_url)
+
+    Handler.fails = 2
+    assert api._request_get(f"{base_url}/flaky")['path'] == '/flaky'
+
+    Handler.fails = 5
+    with pytest.raises(api_requests.requests.HTTPError):
+        api._request_get(f"{base_url}/flaky")
+
+    Handler.fails = 0
+    api_requests.configure(max_retries=3, backoff_factor=0.5)
+
+
+def test_iter_exports(base_url):
+    api = api_requests.ApiRequests(base_url)
+    Handler.pages = []
+
+    exports = api.iter_exports({'state': 'ok'}, instance='main', page_size=3)
+    assert Handler.pages == []
+
+    exports = list(exports)
+    assert [export['id'] for export in exports] == list(range(1, 8))
+    assert exports[0]['path'] == '/exports/all/main/'
+    assert Handler.pages == [{'state': 'ok', 'limit': '3'},
+                             {'state': 'ok', 'limit': '3', 'after_id': '3'},
+                             {'state': 'ok', 'limit': '3', 'after_id': '6'}]
+
+
+def test_iter_exports_stops_early(base_url):
+    api = api_requests.ApiRequests(base_url)
+    Handler.pages = []
+
+    exports = api.iter_exports(user='a@b.no', page_size=7)
+    assert [export['id'] for export in exports] == list(range(1, 8))
+    # a full last page needs one more, empty, page to know it was the last
+    assert len(Handler.pages) == 2
+
+
+def test_async_iter_exports(base_url):
+    api = api_requests.AsyncApiRequests(base_url)
+    Handler.pages = []
+
+    async def exports():
+        return [export async for export in api.iter_exports({'state': 'ok'}, instance='main', page_size=3)]
+
+    assert [export['id'] for export in asyncio.run(exports())] == list(range(1, 8))
+    assert len(Handler.pages) == 3
+
+
+def test_iter_history_export(base_url, monkeypatch):
+    monkeypatch.setattr(api_requests.time, 'sleep', lambda seconds: None)
+    api = api_requests.ApiRequests(base_url)
+    Handler.drops = 2
+    Handler.ranges = []
+
+    data = b''.join(api.iter_history_export('abc', chunk_size=1000))
+
+    assert data == Handler.archive
+    # each retry carries on where the last one broke off
+    assert len(Handler.ranges) == 2
+    assert 0 < Handler.ranges[0] < Handler.ranges[1] < len(Handler.archive)
+
+
+def test_download_history_export(base_url, tmp_path, monkeypatch):
+    monkeypatch.setattr(api_requests.transfer, 'default_chunk_size', 1000)
+    api = api_requests.ApiRequests(base_url)
+    outfile = str(tmp_path / 'export.tgz')
+    sha256 = hashlib.sha256(Handler.archive).hexdigest()
+
+    # what an earlier attempt got, the last chunk of it bad
+    progress = api_requests.transfer.Transfer(outfile)
+    progress.add(Handler.archive[:3000])
+    with open(outfile, 'wb') as f:
+        f.write(Handler.archive[:2500] + b'x' * 500)
+
+    Handler.ranges = []
+    assert api.download_history_export('abc', outfile, sha256=sha256) == {'size': len(Handler.archive),
+                                                                           'sha256': sha256}
+    assert Handler.ranges == [2000]
+    with open(outfile, 'rb') as f:
+        assert f.read() == Handler.archive
+    assert not os.path.exists(f"{outfile}.progress")
+
+    with pytest.raises(RuntimeError, match='sha256'):
+        api.download_history_export('abc', str(tmp_path / 'other.tgz'), sha256='0' * 64)
+    assert os.listdir(tmp_path) == ['export.tgz']
@@ -0,0 +1,48 @@
+import time
+
+import nels_galaxy_api.cache as cache
+
+
+def test_set_get():
+    c = cache.TTLCache(size=10, ttl=60)
+    c.set('key', 'value')
+    assert c.get('key') == 'value'
+    assert c.get('missing') is None
+    assert c.get('missing', {}) == {}
+    assert c.hits == 1
+    assert c.misses == 2
+
+
+def test_expire():
+    c = cache.TTLCache(size=10, ttl=0.01)
+    c.set('key', 'value')
+    time.sleep(0.02)
+    assert c.get('key') is None
+    assert len(c) == 0
+
+
+def test_lru():
+    c = cache.TTLCache(size=2, ttl=60)
+    c.set('a', 1)
+    c.set('b', 2)
+    c.get('a')
+    c.set('c', 3)
+    assert c.get('a') == 1
+    assert c.get('b') is None
+    assert c.get('c') == 3
+
+
+def test_delete():
+    c = cache.TTLCache(size=10, ttl=60)
+    c.set('key', 'value')
+    c.delete('key')
+    c.delete('not-there')
+    assert c.get('key') is None
+
+
+def test_configure_clears():
+    c = cache.TTLCache(size=10, ttl=60)
+    c.set('key', 'value')
+    c.configure(size=5, ttl=10)
+    assert c.get('key') is None
+    assert c.stats()['max_size'] == 5
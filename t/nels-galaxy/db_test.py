@@ -0,0 +1,414 @@
+import datetime
+import os
+import time
+import urllib.parse
+
+import psycopg2
+import pytest
+from tornado.ioloop import IOLoop
+
+import nels_galaxy_api.db as nels_galaxy_db
+
+# Checks the tracking lookups can use the indexes added by the migrations. Needs a postgres
+# database to create a scratch schema in, given as a url in NGA_TEST_DB
+
+db_url = os.environ.get('NGA_TEST_DB')
+schema = 'nga_test'
+
+if db_url is None:
+    pytest.skip("NGA_TEST_DB not set", allow_module_level=True)
+
+
+def raw_connection():
+    conn = psycopg2.connect(nels_galaxy_db.libpq_url(db_url))
+    conn.autocommit = True
+    return conn
+
+
+@pytest.fixture(scope='module')
+def db():
+    conn = raw_connection()
+    conn.cursor().execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE; CREATE SCHEMA {schema}")
+
+    url = db_url + ('&' if '?' in db_url else '?')
+    url += "options=" + urllib.parse.quote(f"-c search_path={schema}")
+
+    db = nels_galaxy_db.DB()
+    db.connect(url)
+    db.create_export_tracking_table()
+    db.create_export_tracking_logs_table()
+    db.create_import_tracking_table()
+    db.create_import_tracking_logs_table()
+
+    yield db
+
+    db.disconnect()
+    conn.cursor().execute(f"DROP SCHEMA {schema} CASCADE")
+    conn.close()
+
+
+def explain(db, q: str, params: []) -> str:
+    with db._transaction() as cursor:
+        # the tables are tiny, make the planner use an index if there is one
+        cursor.execute("SET LOCAL enable_seqscan = off")
+        cursor.execute("EXPLAIN " + q, params)
+        return "\n".join(row[0] for row in cursor.fetchall())
+
+
+def test_migrate(db):
+    assert db.migrate() == [1, 2, 4]
+    assert sorted(db.get_schema_versions()) == [1, 2, 4]
+
+
+def test_migrate_idempotent(db):
+    db.migrate()
+    assert db.migrate() == []
+    assert sorted(db.get_schema_versions()) == [1, 2, 4]
+
+
+def test_export_tracking_user_instance(db):
+    db.migrate()
+    plan = explain(db, "SELECT * FROM nels_export_tracking WHERE user_email = %s AND instance = %s",
+                   ['user@example.org', 'usegalaxy'])
+    assert 'nels_export_tracking_user_instance_idx' in plan
+
+
+def test_export_tracking_state(db):
+    db.migrate()
+    plan = explain(db, "SELECT * FROM nels_export_tracking WHERE state = %s ORDER BY update_time", ['new'])
+    assert 'nels_export_tracking_state_update_idx' in plan
+
+
+def test_export_tracking_log(db):
+    db.migrate()
+    plan = explain(db, "SELECT * FROM nels_export_tracking_log WHERE tracking_id = %s ORDER BY create_time", [1])
+    assert 'nels_export_tracking_log_tracking_idx' in plan
+
+
+def test_import_tracking_user(db):
+    db.migrate()
+    plan = explain(db, "SELECT * FROM nels_import_tracking WHERE user_id = %s", [1])
+    assert 'nels_import_tracking_user_idx' in plan
+
+
+def test_import_tracking_log(db):
+    db.migrate()
+    plan = explain(db, "SELECT * FROM nels_import_tracking_log WHERE tracking_id = %s ORDER BY create_time", [1])
+    assert 'nels_import_tracking_log_tracking_idx' in plan
+
+
+def test_missing_galaxy_indexes(db):
+    # none of the galaxy tables exists in the scratch schema, so nothing to report
+    assert db.missing_galaxy_indexes() == []
+
+
+def test_stream(db):
+    with db._transaction() as cursor:
+        for i in range(25):
+            cursor.execute("INSERT INTO nels_export_tracking (instance, user_email, state) VALUES (%s, %s, %s)",
+                           ['usegalaxy', f"user{i % 2}@example.org", 'ok' if i % 5 else 'new'])
+
+    chunks = list(db.stream('export_trackings', None, None, None, None, None, 0, None, chunk_size=10))
+    assert [len(chunk) for chunk in chunks] == [10, 10, 5]
+    ids = [row['id'] for chunk in chunks for row in chunk]
+    assert ids == sorted(ids)
+
+    rows = [row for chunk in db.stream('export_trackings', 'new', 'usegalaxy', 'user0@example.org', None, None, 0, None) for row in chunk]
+    assert len(rows) == 3
+    assert all(row['state'] == 'new' and row['user_email'] == 'user0@example.org' for row in rows)
+
+    # the connection is back in autocommit mode and usable for prepared queries
+    assert db._connection().autocommit
+    assert db.table_exist('nels_export_tracking')
+
+
+def test_async_stream_pool(db):
+    url = db_url + ('&' if '?' in db_url else '?')
+    url += "options=" + urllib.parse.quote(f"-c search_path={schema}")
+
+    async_db = nels_galaxy_db.AsyncDB()
+    async_db.connect(url, pool_size=1, stream_pool_size=1)
+
+    async def run():
+        # a stream left half read holds its stream connection, the queries still get theirs
+        rows = async_db.stream('export_trackings', None, None, None, None, None, 0, None, chunk_size=10)
+        assert len(await rows.__anext__()) == 10
+        assert await async_db.get_export_trackings(state='new')
+        stats = async_db.stats()
+        await rows.aclose()
+        return stats
+
+    try:
+        stats = IOLoop.current().run_sync(run)
+    finally:
+        async_db.disconnect()
+
+    assert stats['connections'] == 1 and stats['idle'] == 1
+    assert stats['stream_connections'] == 1 and stats['stream_idle'] == 0
+
+
+def galaxy_tables(db) -> None:
+    # the bits of the galaxy tables the export queries use, emptied
+    with db._transaction() as cursor:
+        cursor.execute("CREATE TABLE IF NOT EXISTS galaxy_user (id SERIAL PRIMARY KEY, email VARCHAR(255))")
+        cursor.execute("CREATE TABLE IF NOT EXISTS history (id SERIAL PRIMARY KEY, user_id INT, name TEXT, update_time TIMESTAMP, hid_counter INT)")
+        cursor.execute("CREATE TABLE IF NOT EXISTS job (id SERIAL PRIMARY KEY, create_time TIMESTAMP, state VARCHAR(64))")
+        cursor.execute("CREATE TABLE IF NOT EXISTS job_export_history_archive (id SERIAL PRIMARY KEY, job_id INT, history_id INT, dataset_id INT)")
+        cursor.execute("TRUNCATE galaxy_user, history, job, job_export_history_archive RESTART IDENTITY")
+
+
+def test_deactivated_session(db):
+    galaxy_tables(db)
+    with db._transaction() as cursor:
+        cursor.execute("CREATE TABLE IF NOT EXISTS galaxy_session (id SERIAL PRIMARY KEY, user_id INT, session_key VARCHAR(255), is_valid BOOLEAN, current_history_id INT)")
+        cursor.execute("TRUNCATE galaxy_session")
+        cursor.execute("INSERT INTO galaxy_user (email) VALUES ('a@b.no') RETURNING id")
+        user_id = cursor.fetchone()[0]
+        cursor.execute("INSERT INTO galaxy_session (user_id, session_key, is_valid, current_history_id) VALUES (%s, 'key', true, 3)",
+                       [user_id])
+
+    assert db.get_session_valid('key')
+    assert db.get_user_from_session('key')['email'] == 'a@b.no'
+
+    # logged out in galaxy
+    db._execute("UPDATE galaxy_session SET is_valid = false WHERE session_key = 'key'", [])
+    assert not db.get_session_valid('key')
+    assert db.get_user_from_session('key') is None
+    assert db.get_user_tos('key') is None
+
+    assert not db.get_session_valid('unknown')
+    assert db.get_user_from_session('unknown') is None
+
+
+def test_exports_by_id(db):
+    galaxy_tables(db)
+    with db._transaction() as cursor:
+        cursor.execute("INSERT INTO history (user_id, name) VALUES (1, 'a'), (1, 'b')")
+        cursor.execute("INSERT INTO job (create_time, state) VALUES (now(), 'ok'), (now(), 'running'), (now(), 'new')")
+        cursor.execute("INSERT INTO job_export_history_archive (job_id, history_id, dataset_id) VALUES (1, 1, 1), (2, 1, 2), (3, 2, 3)")
+
+    exports = db.get_exports_by_id([1, 3, 42])
+    assert sorted((e['export_id'], e['state']) for e in exports) == [(1, 'ok'), (3, 'new')]
+    assert db.get_exports_by_id([]) == []
+
+    latest = db.get_latest_exports_for_histories([1, 2])
+    assert sorted((e['history_id'], e['export_id'], e['state']) for e in latest) == [(1, 2, 'running'), (2, 3, 'new')]
+
+
+def test_users_histories_and_exports(db):
+    galaxy_tables(db)
+    with db._transaction() as cursor:
+        cursor.execute("INSERT INTO galaxy_user (email) VALUES ('b@example.org'), ('a@example.org')")
+        cursor.execute("INSERT INTO history (user_id, name, hid_counter) VALUES (1, 'x', 1), (2, 'y', 1), (2, 'z', 1)")
+        cursor.execute("INSERT INTO job (create_time, state) VALUES (now() - interval '1 hour', 'ok'), (now(), 'running'), (now(), 'ok')")
+        cursor.execute("INSERT INTO job_export_history_archive (job_id, history_id, dataset_id) VALUES (1, 1, 1), (2, 1, 2), (3, 3, 3)")
+
+    rows = [row for chunk in db.stream('users_histories') for row in chunk]
+    assert [(row['email'], row['id']) for row in rows] == [('a@example.org', 2), ('a@example.org', 3), ('b@example.org', 1)]
+
+    # the same as asking pr user
+    rows = [row for chunk in db.stream('users_exports') for row in chunk]
+    for user_id, email in [(1, 'b@example.org'), (2, 'a@example.org')]:
+        user_rows = [dict(row) for row in rows if row['email'] == email]
+        for row in user_rows:
+            del row['email']
+        assert user_rows == db.get_user_history_exports(user_id)
+
+
+def tracking_logs(db, table: str, tracking_id: int) -> []:
+    return [row[0] for row in db._execute(f"SELECT log FROM {table} WHERE tracking_id = %s ORDER BY id",
+                                          [tracking_id])]
+
+
+def test_add_tracking_returns_id(db):
+    # identical requests get their own rows
+    values = {'instance': 'main', 'user_email': 'a@b.no', 'history_id': '1', 'state': 'pre-queueing'}
+    first = db.add_export_tracking(dict(values))
+    second = db.add_export_tracking(dict(values))
+    assert first != second
+
+    rows = db._execute("SELECT id, state FROM nels_export_tracking WHERE id = ANY(%s) ORDER BY id", [[first, second]])
+    assert rows == [(first, 'pre-queueing'), (second, 'pre-queueing')]
+
+
+def test_update_tracking_logs_state(db):
+    tracking_id = db.add_import_tracking({'user_id': 1, 'state': 'pre-queueing', 'log': 'from the cli'})
+    assert tracking_logs(db, 'nels_import_tracking_log', tracking_id) == ['from the cli']
+
+    db.update_import_tracking(tracking_id, {'tmpfile': '/tmp/x'})
+    db.update_import_tracking(tracking_id, {'state': 'queued'})
+    # unchanged, not logged again
+    db.update_import_tracking(tracking_id, {'state': 'queued'})
+    db.update_import_tracking(tracking_id, {'state': 'error', 'log': 'x' * 200})
+
+    assert db._execute("SELECT state, tmpfile FROM nels_import_tracking WHERE id = %s",
+                       [tracking_id]) == [('error', '/tmp/x')]
+    assert tracking_logs(db, 'nels_import_tracking_log', tracking_id) == ['from the cli', 'Changed state to queued',
+                                                                         'x' * nels_galaxy_db.log_size]
+
+
+def test_update_tracking_atomic(db):
+    tracking_id = db.add_export_tracking({'state': 'new'})
+
+    # the log insert fails, so the state change is not kept either
+    db._do("ALTER TABLE nels_export_tracking_log RENAME TO nels_export_tracking_log_away")
+    try:
+        with pytest.raises(psycopg2.Error):
+            db.update_export_tracking(tracking_id, {'state': 'queued'})
+    finally:
+        db._do("ALTER TABLE nels_export_tracking_log_away RENAME TO nels_export_tracking_log")
+
+    assert db.get_export_tracking(tracking_id)['state'] == 'new'
+
+
+def test_update_missing_tracking(db):
+    db.update_export_tracking(-1, {'state': 'queued'})
+    assert tracking_logs(db, 'nels_export_tracking_log', -1) == []
+
+
+def test_log_writer(db):
+    writer = nels_galaxy_db.TrackingLogWriter(db_url.replace('?', f"?options=-csearch_path%3D{schema}&", 1),
+                                              batch_size=1000, flush_interval=60)
+    first = db.add_export_tracking({'state': 'new'})
+    second = db.add_export_tracking({'state': 'new'})
+
+    db.log_writer = writer
+    try:
+        for state in ['queued', 'running', 'ok']:
+            db.update_export_tracking(first, {'state': state})
+            db.update_export_tracking(second, {'state': state})
+            db.update_export_tracking(second, {'state': state})
+
+        # nothing is written until the writer is flushed
+        assert len(writer) == 6
+        assert tracking_logs(db, 'nels_export_tracking_log', first) == []
+    finally:
+        db.log_writer = None
+        writer.close()
+
+    expected = ['Changed state to queued', 'Changed state to running', 'Changed state to ok']
+    assert tracking_logs(db, 'nels_export_tracking_log', first) == expected
+    assert tracking_logs(db, 'nels_export_tracking_log', second) == expected
+    assert writer.stats() == {'pending': 0, 'written': 6, 'batches': 1, 'failures': 0, 'dropped': 0}
+
+
+def test_log_writer_drops(db):
+    writer = nels_galaxy_db.TrackingLogWriter(db_url.replace('?', f"?options=-csearch_path%3D{schema}&", 1),
+                                              batch_size=1000, flush_interval=60, max_retries=2, max_pending=2)
+    try:
+        writer.add('no_such_log', -3, datetime.datetime.now(), 'first')
+        writer.add('no_such_log', -3, datetime.datetime.now(), 'second')
+        # the queue is full
+        writer.add('no_such_log', -3, datetime.datetime.now(), 'third')
+        assert len(writer) == 2 and writer.dropped == 1
+
+        # requeued after the first failure, dropped after the second
+        with pytest.raises(psycopg2.Error):
+            writer.flush()
+        assert len(writer) == 2
+        with pytest.raises(psycopg2.Error):
+            writer.flush()
+        assert len(writer) == 0
+    finally:
+        writer.close()
+
+    assert writer.stats() == {'pending': 0, 'written': 0, 'batches': 0, 'failures': 2, 'dropped': 3}
+
+
+def test_log_writer_batch_size(db):
+    writer = nels_galaxy_db.TrackingLogWriter(db_url.replace('?', f"?options=-csearch_path%3D{schema}&", 1),
+                                              batch_size=2, flush_interval=60)
+    try:
+        writer.add('nels_import_tracking_log', -2, datetime.datetime.now(), 'first')
+        writer.add('nels_import_tracking_log', -2, datetime.datetime.now(), 'second')
+
+        for _ in range(50):
+            if not len(writer):
+                break
+            time.sleep(0.1)
+
+        assert tracking_logs(db, 'nels_import_tracking_log', -2) == ['first', 'second']
+    finally:
+        writer.close()
+
+
+def test_tracking_pages(db):
+    galaxy_tables(db)
+    now = datetime.datetime.now()
+    with db._transaction() as cursor:
+        cursor.execute("TRUNCATE nels_import_tracking RESTART IDENTITY")
+        cursor.execute("INSERT INTO galaxy_user (email) VALUES ('a@b.no'), ('c@d.no')")
+        for i in range(10):
+            cursor.execute("INSERT INTO nels_import_tracking (user_id, state, create_time) VALUES (%s, %s, %s)",
+                           [i % 2 + 1, 'ok', now - datetime.timedelta(days=i)])
+
+    def page(*params) -> []:
+        return [row for chunk in db.stream('import_trackings', *params) for row in chunk]
+
+    first = page(None, None, None, None, 0, 4)
+    assert [row['id'] for row in first] == [1, 2, 3, 4]
+    assert [row['user_email'] for row in first] == ['a@b.no', 'c@d.no', 'a@b.no', 'c@d.no']
+    assert [row['id'] for row in page(None, None, None, None, first[-1]['id'], 4)] == [5, 6, 7, 8]
+
+    assert [row['id'] for row in page(None, 'c@d.no', None, None, 0, None)] == [2, 4, 6, 8, 10]
+
+    since, until = now - datetime.timedelta(days=3.5), now - datetime.timedelta(days=0.5)
+    assert [row['id'] for row in page(None, None, since, until, 0, None)] == [2, 3, 4]
+
+
+def test_bulk_export(db):
+    db.migrate()
+    bulk = {'instance': 'main', 'user_email': 'a@b.no', 'nels_id': 42, 'destination': 'Personal'}
+
+    bulk_id, released = db.add_bulk_export_trackings(bulk, ['h1', 'h2', 'h3', 'h4', 'h5'], archive_jobs=2)
+    assert len(released) == 2
+
+    trackings = db._execute("SELECT id, history_id, state FROM nels_export_tracking WHERE bulk_id = %s ORDER BY id",
+                            [bulk_id])
+    assert [row[0] for row in trackings[:2]] == released
+    assert [row[2] for row in trackings] == ['pre-queueing'] * 2 + ['bulk-queued'] * 3
+    assert tracking_logs(db, 'nels_export_tracking_log', released[0]) == ['Changed state to pre-queueing']
+
+    # still building, nothing more to release
+    db.update_export_tracking(released[0], {'state': 'running'})
+    assert db.release_bulk_exports(released[0], 2) == []
+
+    db.update_export_tracking(released[0], {'state': 'ok'})
+    assert db.release_bulk_exports(released[0], 2) == [trackings[2][0]]
+    assert db.release_bulk_exports(released[0], 2) == []
+
+    db.update_export_tracking(released[1], {'state': 'finished'})
+    db.update_export_tracking(trackings[2][0], {'state': 'bioblend-error'})
+    assert db.release_bulk_exports(released[1], 2) == [row[0] for row in trackings[3:]]
+
+    progress = db.get_bulk_export(bulk_id)
+    assert progress['user_email'] == 'a@b.no'
+    assert progress['states'] == {'ok': 1, 'finished': 1, 'bioblend-error': 1, 'pre-queueing': 2}
+    assert (progress['total'], progress['queued'], progress['running'], progress['finished'],
+            progress['failed']) == (5, 0, 3, 1, 1)
+
+    # a requeued history counts with its latest tracking
+    db.add_export_tracking({'history_id': 'h3', 'state': 'finished', 'bulk_id': bulk_id})
+    assert db.get_bulk_export(bulk_id)['states'] == {'ok': 1, 'finished': 2, 'pre-queueing': 2}
+
+    # not in a bulk
+    tracking_id = db.add_export_tracking({'state': 'ok'})
+    assert db.release_bulk_exports(tracking_id, 2) == []
+    assert db.get_bulk_export(-1) is None
+
+
+def test_bulk_export_requeue(db):
+    db.migrate()
+    bulk = {'instance': 'main', 'user_email': 'c@d.no', 'nels_id': 43, 'destination': 'Personal'}
+
+    bulk_id, released = db.add_bulk_export_trackings(bulk, ['h1', 'h2', 'h3'], archive_jobs=2)
+
+    # the runner was never told about the second one, it goes back in the queue
+    db.update_export_tracking(released[0], {'state': 'new'})
+    assert db.requeue_bulk_exports(released) == [released[1]]
+    assert db.get_bulk_export(bulk_id)['states'] == {'new': 1, 'bulk-queued': 2}
+
+    # and is released again, with the room there is
+    assert db.release_queued_bulk_exports(2) == [released[1]]
+    assert db.release_queued_bulk_exports(2) == []
+    assert db.get_bulk_export(bulk_id)['states'] == {'new': 1, 'pre-queueing': 1, 'bulk-queued': 1}
@@ -0,0 +1,114 @@
+import asyncio
+import http.server
+import json
+import re
+import threading
+import time
+
+import pytest
+
+import nels_galaxy_api.api_requests as api_requests
+import nels_galaxy_api.front as front
+
+# The front functions against a small local server that looks like an instance with a few users
+
+
+users = [{'email': f"user{i}@example.org", 'active': 1, 'deleted': 0} for i in range(8)]
+delay = 0.05
+
+
+def histories(email: str) -> []:
+    return [{'id': f"{email}-{i}", 'name': 'h', 'update_time': '2020-01-01T00:00:00', 'hid_counter': 1} for i in range(2)]
+
+
+def exports(email: str) -> []:
+    # only every other user has exported anything
+    if int(email[4]) % 2:
+        return []
+    return [{'export_id': 'e', 'job_id': 'j', 'history_id': 'h', 'state': 'ok', 'create_time': '2020-01-01T00:00:00'}]
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    bulk = True
+    requests = 0
+
+    def do_GET(self):
+        Handler.requests += 1
+        time.sleep(delay)
+        match = re.fullmatch(r'/user/(.+)/(histories|exports)', self.path)
+        if self.path == '/users':
+            data = users
+        elif self.path == '/users/histories/' and Handler.bulk:
+            data = [dict(history, email=user['email']) for user in users for history in histories(user['email'])]
+        elif self.path == '/users/exports/' and Handler.bulk:
+            data = [dict(export, email=user['email']) for user in users for export in exports(user['email'])]
+        elif match and match.group(2) == 'histories':
+            data = histories(match.group(1))
+        elif match:
+            data = exports(match.group(1))
+        else:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope='module')
+def server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+
+
+@pytest.fixture(params=[True, False], ids=['bulk', 'pr-user'])
+def config(server, request):
+    Handler.bulk = request.param
+    instance = {'name': 'usegalaxy', 'api': api_requests.ApiRequests(server)}
+    return {'instances': {'id1': instance, 'usegalaxy': instance}}
+
+
+def test_users(config):
+    assert asyncio.run(front.get_users_async(config)) == front.get_users(config)
+
+
+def test_histories(config):
+    histories = asyncio.run(front.get_histories_async(config))
+    assert histories == front.get_histories(config)
+    assert len(histories) == 16
+
+
+def test_exports(config):
+    assert asyncio.run(front.get_exports_async(config, summary=True)) == front.get_exports(config, summary=True)
+    assert asyncio.run(front.get_exports_async(config, user_email='user3@example.org')) == \
+           front.get_exports(config, user_email='user3@example.org')
+
+
+def test_histories_concurrent(config):
+    # 1 + 8 requests, the user ones 4 at a time
+    start = time.time()
+    asyncio.run(front.get_histories_async(config, limit=4))
+    assert time.time() - start < 6 * delay
+
+
+def test_bulk_requests(config):
+    Handler.requests = 0
+    front.get_histories(config)
+    asyncio.run(front.get_exports_async(config))
+
+    if Handler.bulk:
+        assert Handler.requests == 4
+    else:
+        # the 404 from /users/histories/ is remembered for the exports
+        assert Handler.requests == 1 + 1 + len(users) + 1 + len(users)
@@ -0,0 +1,172 @@
+import datetime
+import time
+
+import nels_galaxy_api.scheduler as scheduler
+
+
+class Galaxy(object):
+    # stands in for the instances, export states set by the test
+
+    def __init__(self):
+        self.states = {}
+        self.polls = []
+        self.changes = []
+        self.failed = []
+
+    def poll(self, instance: str, export_ids: []) -> {}:
+        self.polls.append((instance, sorted(export_ids)))
+        return {export_id: self.states[export_id] for export_id in export_ids if export_id in self.states}
+
+    def changed(self, tracker: {}, state: str) -> None:
+        self.changes.append((tracker['id'], state))
+
+    def fail(self, tracker: {}, log: str) -> None:
+        self.failed.append((tracker['id'], log))
+
+
+def tracker(id: str, instance: str = 'usegalaxy', state: str = 'pre-queueing') -> {}:
+    return {'id': id, 'export_id': f"e{id}", 'instance': instance, 'state': state}
+
+
+def test_batched_pr_instance():
+    galaxy = Galaxy()
+    s = scheduler.ExportScheduler(galaxy.poll, galaxy.changed, min_interval=0)
+    s.add(tracker('1'))
+    s.add(tracker('2'))
+    s.add(tracker('3', instance='other'))
+
+    s.poll()
+    assert sorted(galaxy.polls) == [('other', ['e3']), ('usegalaxy', ['e1', 'e2'])]
+
+
+def test_only_changes_written():
+    galaxy = Galaxy()
+    s = scheduler.ExportScheduler(galaxy.poll, galaxy.changed, min_interval=0)
+    s.add(tracker('1'))
+
+    galaxy.states['e1'] = 'running'
+    s.poll()
+    s.poll()
+    s.poll()
+    assert galaxy.changes == [('1', 'running')]
+
+    galaxy.states['e1'] = 'ok'
+    s.poll()
+    assert galaxy.changes == [('1', 'running'), ('1', 'ok')]
+    # done, so no longer polled
+    assert len(s) == 0
+
+
+def test_backoff():
+    galaxy = Galaxy()
+    s = scheduler.ExportScheduler(galaxy.poll, galaxy.changed, min_interval=0.01, max_interval=0.04)
+    s.add(tracker('1', state='running'))
+    galaxy.states['e1'] = 'running'
+
+    time.sleep(0.02)
+    waits = []
+    for _ in range(4):
+        waits.append(s.poll())
+        time.sleep(waits[-1])
+
+    assert 0.015 < waits[0] <= 0.02
+    assert 0.035 < waits[2] <= 0.04
+    assert 0.035 < waits[3] <= 0.04
+
+
+def test_failed_update_retried():
+    galaxy = Galaxy()
+    fail = [True]
+
+    def changed(tracker, state):
+        if fail[0]:
+            raise RuntimeError("master down")
+        galaxy.changed(tracker, state)
+
+    s = scheduler.ExportScheduler(galaxy.poll, changed, min_interval=0)
+    s.add(tracker('1'))
+    galaxy.states['e1'] = 'ok'
+
+    s.poll()
+    assert len(s) == 1
+
+    fail[0] = False
+    time.sleep(0.01)
+    s.poll()
+    assert galaxy.changes == [('1', 'ok')]
+    assert len(s) == 0
+
+
+def test_never_finishing_given_up():
+    galaxy = Galaxy()
+    s = scheduler.ExportScheduler(galaxy.poll, galaxy.changed, min_interval=0, failed=galaxy.fail)
+    for id in ['1', '2', '3', '4']:
+        s.add(tracker(id))
+    galaxy.states = {'e1': 'paused', 'e2': 'deleted', 'e3': 'running'}
+
+    s.poll()
+    assert sorted(galaxy.failed) == [('1', 'export paused in galaxy'), ('2', 'export deleted in galaxy'),
+                                     ('4', 'export not found in galaxy')]
+    assert galaxy.changes == [('3', 'running')]
+    assert len(s) == 1
+
+
+def test_max_age():
+    galaxy = Galaxy()
+    s = scheduler.ExportScheduler(galaxy.poll, galaxy.changed, min_interval=0, failed=galaxy.fail, max_age=0.01)
+    s.add(tracker('1'))
+    galaxy.states['e1'] = 'running'
+
+    s.poll()
+    time.sleep(0.02)
+    s.poll()
+    assert galaxy.failed == [('1', 'export not done after 0s')]
+    assert s.stats() == {'pending': 0, 'polls': 2, 'updates': 1, 'failures': 1}
+
+
+def test_max_age_from_create_time():
+    # a restarted runner picks the export up again, its age still counts from the tracker's creation
+    galaxy = Galaxy()
+    s = scheduler.ExportScheduler(galaxy.poll, galaxy.changed, min_interval=0, failed=galaxy.fail, max_age=3600)
+    old = tracker('1', state='running')
+    old['create_time'] = (datetime.datetime.now() - datetime.timedelta(hours=2)).isoformat()
+    new = tracker('2', state='running')
+    new['create_time'] = datetime.datetime.now()
+    s.add(old)
+    s.add(new)
+    galaxy.states = {'e1': 'running', 'e2': 'running'}
+
+    s.poll()
+    assert galaxy.failed == [('1', 'export not done after 3600s')]
+    assert len(s) == 1
+
+
+def test_unpolled_kept():
+    # an export that could not be polled this time is neither changed nor given up on
+    galaxy = Galaxy()
+    s = scheduler.ExportScheduler(galaxy.poll, galaxy.changed, min_interval=0, failed=galaxy.fail)
+    s.add(tracker('1'))
+    s.add(tracker('2'))
+    galaxy.states = {'e1': None, 'e2': 'running'}
+
+    s.poll()
+    assert galaxy.failed == []
+    assert galaxy.changes == [('2', 'running')]
+    assert len(s) == 2
+
+
+def test_thread():
+    galaxy = Galaxy()
+    s = scheduler.ExportScheduler(galaxy.poll, galaxy.changed, min_interval=0.01, max_interval=0.05)
+    s.start()
+    galaxy.states['e1'] = 'ok'
+    s.add(tracker('1'))
+
+    for _ in range(100):
+        if galaxy.changes:
+            break
+        time.sleep(0.01)
+
+    s.stop()
+    assert galaxy.changes == [('1', 'ok')]
+    assert s.stats()['pending'] == 0
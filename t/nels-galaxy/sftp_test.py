@@ -0,0 +1,350 @@
+import hashlib
+import io
+import os
+import socket
+import tempfile
+import threading
+
+import pytest
+
+paramiko = pytest.importorskip('paramiko')
+
+import nels_galaxy_api.sftp as sftp
+
+# Runs the transfers against a small in-process sftp server, serving a temporary directory. It
+# answers "sha256sum <file>" like a NeLS host, unless told to get it wrong.
+
+
+class Server(paramiko.ServerInterface):
+    root = None
+    wrong_sha256 = False
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        # answered once the reply to the exec request has gone out, after this returns
+        threading.Timer(0.1, self.sha256sum, args=(channel, command.decode())).start()
+        return True
+
+    def sha256sum(self, channel, command: str) -> None:
+        path = os.path.join(Server.root, command.split(' ', 1)[1].strip("'").lstrip('/'))
+        with open(path, 'rb') as f:
+            sha256 = hashlib.sha256(f.read() + (b'x' if Server.wrong_sha256 else b'')).hexdigest()
+        channel.sendall(f"{sha256}  {path}\n".encode())
+        channel.send_exit_status(0)
+        channel.close()
+
+
+class Handle(paramiko.SFTPHandle):
+
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+    def chattr(self, attr):
+        # only truncating is used
+        self.writefile.truncate(attr.st_size)
+        return paramiko.SFTP_OK
+
+
+class SFTPServer(paramiko.SFTPServerInterface):
+
+    def _path(self, path: str) -> str:
+        return os.path.join(Server.root, path.lstrip('/'))
+
+    def open(self, path, flags, attr):
+        try:
+            f = os.fdopen(os.open(self._path(path), flags, 0o600), 'r+b' if flags & (os.O_WRONLY | os.O_RDWR) else 'rb')
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+        handle = Handle(flags)
+        handle.readfile = f
+        handle.writefile = f
+        return handle
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._path(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def remove(self, path):
+        try:
+            os.remove(self._path(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def posix_rename(self, oldpath, newpath):
+        os.replace(self._path(oldpath), self._path(newpath))
+        return paramiko.SFTP_OK
+
+
+def serve(listener, host_key) -> None:
+    while True:
+        try:
+            conn, _ = listener.accept()
+        except OSError:
+            return
+
+        transport = paramiko.Transport(conn)
+        transport.add_server_key(host_key)
+        transport.set_subsystem_handler('sftp', paramiko.SFTPServer, SFTPServer)
+        transport.start_server(server=Server())
+        threading.Thread(target=accept, args=(transport,), daemon=True).start()
+
+
+def accept(transport) -> None:
+    # the channels have to be taken off the transport's queue, and kept open
+    channels = []
+    while transport.is_active():
+        channels.append(transport.accept(1))
+
+
+@pytest.fixture(scope='module')
+def host():
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen()
+    threading.Thread(target=serve, args=(listener, paramiko.RSAKey.generate(2048)), daemon=True).start()
+
+    key = io.StringIO()
+    paramiko.RSAKey.generate(2048).write_private_key(key)
+
+    with tempfile.TemporaryDirectory() as root:
+        Server.root = root
+        yield listener.getsockname()[1], key.getvalue(), root
+
+    listener.close()
+
+
+def test_copy():
+    chunks = [os.urandom(1000) for _ in range(50)]
+    outfile = io.BytesIO()
+
+    size, sha256 = sftp.copy(iter(chunks), outfile, buffer_size=4)
+    assert size == 50 * 1000
+    assert sha256 == hashlib.sha256(b''.join(chunks)).hexdigest()
+    assert outfile.getvalue() == b''.join(chunks)
+
+
+def test_copy_bounded():
+    read = []
+
+    def chunks():
+        for i in range(50):
+            read.append(i)
+            yield b'x'
+
+    class SlowFile(object):
+        written = 0
+
+        def write(self, chunk):
+            # the reader is never more than the buffer (and the chunk in hand) ahead
+            assert len(read) - self.written <= 4 + 2
+            self.written += 1
+            threading.Event().wait(0.001)
+
+    sftp.copy(chunks(), SlowFile(), buffer_size=4)
+    assert len(read) == 50
+
+
+def test_copy_read_error():
+    def chunks():
+        yield b'x'
+        raise ConnectionError('dropped')
+
+    with pytest.raises(ConnectionError):
+        sftp.copy(chunks(), io.BytesIO())
+
+
+def test_copy_write_error():
+    closed = []
+
+    def chunks():
+        try:
+            while True:
+                yield b'x'
+        finally:
+            closed.append(True)
+
+    class FullDisk(object):
+        def write(self, chunk):
+            raise IOError('no space left')
+
+    with pytest.raises(IOError):
+        sftp.copy(chunks(), FullDisk(), buffer_size=2)
+
+    # the reader stopped, and closed what it read from
+    assert closed == [True]
+
+
+def test_upload(host):
+    port, key, root = host
+    chunks = [os.urandom(100000) for _ in range(20)]
+
+    client = sftp.connect('127.0.0.1', 'user', key, port=port)
+    try:
+        sent = sftp.upload(client, iter(chunks), '/export.tgz', buffer_size=4)
+    finally:
+        client.close()
+
+    assert sent == {'size': 2000000, 'sha256': hashlib.sha256(b''.join(chunks)).hexdigest()}
+    assert os.listdir(root) == ['export.tgz']
+    with open(os.path.join(root, 'export.tgz'), 'rb') as f:
+        assert f.read() == b''.join(chunks)
+    os.remove(os.path.join(root, 'export.tgz'))
+
+
+def test_upload_checksum_mismatch(host):
+    port, key, root = host
+
+    Server.wrong_sha256 = True
+    client = sftp.connect('127.0.0.1', 'user', key, port=port)
+    try:
+        with pytest.raises(RuntimeError, match='sha256'):
+            sftp.upload(client, iter([b'x' * 1000]), '/broken.tgz')
+    finally:
+        Server.wrong_sha256 = False
+        client.close()
+
+    # nothing left behind, not even the .part file
+    assert os.listdir(root) == []
+
+
+def test_put_resumes(host, tmp_path):
+    port, key, root = host
+    data = os.urandom(10 * 1000)
+    local_file = tmp_path / 'export.tgz'
+    local_file.write_bytes(data)
+
+    # an earlier attempt got 4 chunks and a bit across, the last of them damaged on the way
+    progress = sftp.transfer.Transfer(str(local_file), chunk_size=1000)
+    progress.add(data[:4000])
+    with open(os.path.join(root, 'export.tgz.part'), 'wb') as f:
+        f.write(data[:3500] + b'x' * 500 + data[4000:4200])
+
+    client = sftp.connect('127.0.0.1', 'user', key, port=port)
+    try:
+        # the damaged chunk is caught by the final check, and nothing kept
+        with pytest.raises(RuntimeError, match='sha256'):
+            sftp.put(client, str(local_file), '/export.tgz', chunk_size=1000)
+        assert os.listdir(root) == []
+
+        # so the next attempt sends it all
+        sent = sftp.put(client, str(local_file), '/export.tgz', chunk_size=1000)
+    finally:
+        client.close()
+
+    assert sent == {'size': 10000, 'sha256': hashlib.sha256(data).hexdigest()}
+    assert not os.path.exists(f"{local_file}.progress")
+    os.remove(os.path.join(root, 'export.tgz'))
+
+
+def test_put_carries_on(host, tmp_path):
+    port, key, root = host
+    data = os.urandom(10 * 1000)
+    local_file = tmp_path / 'export.tgz'
+    local_file.write_bytes(data)
+
+    progress = sftp.transfer.Transfer(str(local_file), chunk_size=1000)
+    progress.add(data[:6000])
+    # the host only got 5 and a half of them
+    with open(os.path.join(root, 'carry.tgz.part'), 'wb') as f:
+        f.write(data[:5500])
+
+    written = []
+    write = paramiko.SFTPFile.write
+    client = sftp.connect('127.0.0.1', 'user', key, port=port)
+    try:
+        paramiko.SFTPFile.write = lambda self, data: written.append(len(data)) or write(self, data)
+        sftp.put(client, str(local_file), '/carry.tgz', chunk_size=1000)
+    finally:
+        paramiko.SFTPFile.write = write
+        client.close()
+
+    # only what was missing went across
+    assert sum(written) == 5000
+    with open(os.path.join(root, 'carry.tgz'), 'rb') as f:
+        assert f.read() == data
+    os.remove(os.path.join(root, 'carry.tgz'))
+
+
+def test_get_resumes(host, tmp_path):
+    port, key, root = host
+    data = os.urandom(10 * 1000)
+    with open(os.path.join(root, 'import.tgz'), 'wb') as f:
+        f.write(data)
+
+    local_file = tmp_path / 'import.tgz'
+    progress = sftp.transfer.Transfer(str(local_file), chunk_size=1000)
+    progress.add(data[:3000])
+    local_file.write_bytes(data[:3000] + b'x' * 700)
+
+    client = sftp.connect('127.0.0.1', 'user', key, port=port)
+    try:
+        got = sftp.get(client, '/import.tgz', str(local_file), chunk_size=1000)
+    finally:
+        client.close()
+
+    assert got == {'size': 10000, 'sha256': hashlib.sha256(data).hexdigest()}
+    assert local_file.read_bytes() == data
+    assert not os.path.exists(f"{local_file}.progress")
+    os.remove(os.path.join(root, 'import.tgz'))
+
+
+def test_connection_pool(host):
+    port, key, root = host
+    pool = sftp.ConnectionPool(max_channels=2, port=port)
+
+    with pool.connection('127.0.0.1', 'user', key) as client:
+        sftp.upload(client, iter([b'x' * 1000]), '/one.tgz')
+    with pool.connection('127.0.0.1', 'user', key) as other:
+        assert other is client
+        sftp.upload(other, iter([b'x' * 1000]), '/two.tgz')
+
+    # more transfers at the same time than channels on a connection
+    with pool.connection('127.0.0.1', 'user', key) as first, pool.connection('127.0.0.1', 'user', key) as second:
+        assert first is second
+        with pool.connection('127.0.0.1', 'user', key) as third:
+            assert third is not first
+
+    assert pool.stats() == {'connections': 2, 'in_use': 0, 'connects': 2, 'reuses': 3}
+
+    # another user, or a new key, is another connection
+    new_key = io.StringIO()
+    paramiko.RSAKey.generate(2048).write_private_key(new_key)
+    with pool.connection('127.0.0.1', 'other', key) as other:
+        assert other is not client
+    with pool.connection('127.0.0.1', 'user', new_key.getvalue()) as renewed:
+        assert renewed is not client
+    # the connections with the old key are closed once not in use
+    assert client.get_transport() is None or not client.get_transport().is_active()
+
+    pool.close()
+    assert pool.stats()['connections'] == 0
+    for name in ['one.tgz', 'two.tgz']:
+        os.remove(os.path.join(root, name))
+
+
+def test_connection_pool_idle(host):
+    port, key, root = host
+    pool = sftp.ConnectionPool(idle_timeout=0.1, port=port)
+
+    with pool.connection('127.0.0.1', 'user', key) as client:
+        pass
+    threading.Event().wait(0.5)
+
+    assert pool.stats()['connections'] == 0
+    with pool.connection('127.0.0.1', 'user', key) as other:
+        assert other is not client
+    pool.close()
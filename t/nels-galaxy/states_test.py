@@ -0,0 +1,67 @@
+import multiprocessing
+import os
+import tempfile
+import time
+
+import pytest
+
+import nels_galaxy_api.states as states
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def backend(request):
+    with tempfile.TemporaryDirectory() as dir:
+        states.init(request.param, ttl=0.2, path=os.path.join(dir, 'states.sqlite'))
+        yield request.param
+
+    states.init()
+
+
+def test_set_get(backend):
+    uuid = states.set({'user': 'user@example.org', 'history_id': 'bc729496af0697be'})
+    assert states.get(uuid) == {'user': 'user@example.org', 'history_id': 'bc729496af0697be'}
+    assert states.get(uuid) is not None
+    assert states.get('missing') is None
+
+
+def test_purge(backend):
+    uuid = states.set({'user': 1})
+    assert states.get(uuid, purge=True) == {'user': 1}
+    assert states.get(uuid) is None
+
+
+def test_expiry(backend):
+    uuid = states.set({'user': 1})
+    time.sleep(0.3)
+    assert states.get(uuid) is None
+
+
+def test_memory_sweep():
+    store = states.MemoryStore(ttl=0.1)
+    for i in range(100):
+        store.set(str(i), i)
+    assert len(store) == 100
+
+    time.sleep(0.2)
+    store.set('new', 1)
+    assert len(store) == 1
+
+
+def set_state(path: str, queue) -> None:
+    states.init('sqlite', path=path)
+    queue.put(states.set({'pid': os.getpid()}))
+
+
+def test_sqlite_shared():
+    with tempfile.TemporaryDirectory() as dir:
+        path = os.path.join(dir, 'states.sqlite')
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=set_state, args=(path, queue))
+        process.start()
+        uuid = queue.get(timeout=10)
+        process.join()
+
+        states.init('sqlite', path=path)
+        assert states.get(uuid) == {'pid': process.pid}
+
+    states.init()
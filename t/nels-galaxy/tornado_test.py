@@ -0,0 +1,145 @@
+import nels_galaxy_api.tornado as tornado
+
+
+def test_parse_range():
+    assert tornado.parse_range("bytes=0-99", 1000) == (0, 100)
+    assert tornado.parse_range("bytes=500-", 1000) == (500, 1000)
+    assert tornado.parse_range("bytes=-100", 1000) == (900, 1000)
+
+
+def test_parse_range_clipped():
+    assert tornado.parse_range("bytes=900-2000", 1000) == (900, 1000)
+    assert tornado.parse_range("bytes=-2000", 1000) == (0, 1000)
+
+
+def test_parse_range_unsatisfiable():
+    assert tornado.parse_range("bytes=1000-", 1000) is None
+    assert tornado.parse_range("bytes=10-5", 1000) is None
+
+
+def test_parse_range_unhandled():
+    # whole file for multiple ranges and junk
+    assert tornado.parse_range("bytes=0-1,5-9", 1000) == (0, 1000)
+    assert tornado.parse_range("bytes=-", 1000) == (0, 1000)
+    assert tornado.parse_range("lines=1-2", 1000) == (0, 1000)
+
+
+server_script = """
+import subprocess
+import sys
+from tornado import gen
+import nels_galaxy_api.tornado as tornado
+
+class Slow(tornado.BaseHandler):
+    async def get(self):
+        await gen.sleep(1)
+        self.write('done')
+
+# not a worker, but in the same process group. Left alone by the signals
+bystander = subprocess.Popen(['sleep', '30'])
+print(bystander.pid, flush=True)
+
+tornado.run_app([('/slow', Slow)], port=int(sys.argv[1]), processes=2)
+"""
+
+
+def test_run_app_graceful_stop():
+    import os
+    import signal
+    import socket
+    import subprocess
+    import sys
+    import threading
+    import time
+
+    import requests
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+
+    # own session, so the bystander is easy to clean up
+    server = subprocess.Popen([sys.executable, '-c', server_script, str(port)], start_new_session=True,
+                              env={**os.environ, 'PYTHONPATH': os.pathsep.join(sys.path)},
+                              stdout=subprocess.PIPE, text=True)
+    bystander = int(server.stdout.readline())
+    try:
+        url = f"http://127.0.0.1:{port}/slow"
+        for _ in range(100):
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+
+        responses = []
+        request = threading.Thread(target=lambda: responses.append(requests.get(url, timeout=10)))
+        request.start()
+        time.sleep(0.5)
+
+        server.send_signal(signal.SIGTERM)
+        request.join()
+
+        assert responses[0].status_code == 200
+        assert responses[0].text == 'done'
+        assert server.wait(timeout=10) == 0
+        # only the workers got the signal
+        os.kill(bystander, 0)
+    finally:
+        if server.poll() is None:
+            os.killpg(server.pid, signal.SIGKILL)
+        try:
+            os.kill(bystander, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+def test_send_file_range_truncated(tmp_path, monkeypatch):
+    import os
+    import types
+
+    import pytest
+    from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+    from tornado.httpserver import HTTPServer
+    from tornado.ioloop import IOLoop
+    from tornado.netutil import bind_sockets
+    from tornado.web import Application
+
+    path = tmp_path / 'archive'
+    path.write_bytes(b'x' * 1000)
+
+    # the size is taken before the file is cut short
+    stat = os.stat
+
+    def stat_before_truncate(file, *args, **kwargs):
+        if file != str(path):
+            return stat(file, *args, **kwargs)
+        return types.SimpleNamespace(st_size=2000, st_mtime_ns=stat(file).st_mtime_ns)
+
+    monkeypatch.setattr(tornado.os, 'stat', stat_before_truncate)
+
+    errors = []
+
+    class Download(tornado.BaseHandler):
+        async def get(self):
+            await self.send_file_range(str(path), chunk_size=100)
+
+        def log_exception(self, typ, value, tb):
+            errors.append(value)
+
+    async def fetch():
+        sockets = bind_sockets(0, '127.0.0.1')
+        server = HTTPServer(Application([('/download', Download)]))
+        server.add_sockets(sockets)
+        try:
+            port = sockets[0].getsockname()[1]
+            return await AsyncHTTPClient().fetch(f"http://127.0.0.1:{port}/download")
+        finally:
+            server.stop()
+
+    # a broken download, not 1000 bytes passed off as the whole file
+    with pytest.raises(Exception) as error:
+        IOLoop.current().run_sync(fetch)
+    assert not isinstance(error.value, HTTPClientError) or error.value.code == 599
+    # closed by the handler, not left to a Content-Length mismatch in finish()
+    assert errors == []
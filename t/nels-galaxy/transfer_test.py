@@ -0,0 +1,97 @@
+import hashlib
+import os
+
+import nels_galaxy_api.transfer as transfer
+
+
+def test_transfer(tmp_path):
+    path = str(tmp_path / 'file')
+    data = os.urandom(10 * 1000 + 300)
+
+    progress = transfer.Transfer(path, chunk_size=1000)
+    assert progress.resume() == 0
+    with open(path, 'wb') as f:
+        for i in range(0, len(data), 700):
+            f.write(data[i:i + 700])
+            progress.add(data[i:i + 700], f)
+
+    assert progress.offset == len(data)
+    assert progress.sha256 == hashlib.sha256(data).hexdigest()
+
+    progress.done()
+    assert not os.path.exists(progress.progress_file)
+
+
+def test_transfer_resume(tmp_path):
+    path = str(tmp_path / 'file')
+    data = os.urandom(10 * 1000)
+
+    progress = transfer.Transfer(path, chunk_size=1000)
+    progress.resume()
+    progress.add(data[:6500])
+    with open(path, 'wb') as f:
+        f.write(data[:6500])
+
+    # only whole chunks are recorded
+    progress = transfer.Transfer(path, chunk_size=1000)
+    assert progress.resume() == 6000
+    assert progress.resume(limit=4200) == 4000
+
+    # a damaged chunk, and everything after it, is done again
+    with open(path, 'r+b') as f:
+        f.seek(2500)
+        f.write(b'x')
+    progress = transfer.Transfer(path, chunk_size=1000)
+    assert progress.resume() == 2000
+
+    progress.add(data[2000:])
+    assert progress.sha256 == hashlib.sha256(data).hexdigest()
+
+
+def test_transfer_other_chunk_size(tmp_path):
+    path = str(tmp_path / 'file')
+    data = os.urandom(5000)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+    progress = transfer.Transfer(path, chunk_size=1000)
+    progress.add(data)
+
+    assert transfer.Transfer(path, chunk_size=1000).resume() == 5000
+    assert transfer.Transfer(path, chunk_size=2000).resume() == 0
+
+
+def test_transfer_reset(tmp_path):
+    path = str(tmp_path / 'file')
+    data = os.urandom(5000)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+    progress = transfer.Transfer(path, chunk_size=1000)
+    progress.add(data)
+    progress.reset()
+
+    assert progress.offset == 0
+    assert transfer.Transfer(path, chunk_size=1000).resume() == 0
+
+
+def test_transfer_appends(tmp_path):
+    path = str(tmp_path / 'file')
+    data = os.urandom(5000)
+
+    progress = transfer.Transfer(path, chunk_size=1000)
+    progress.add(data[:3000])
+    with open(progress.progress_file) as f:
+        lines = f.read().splitlines()
+    # a header, and a line pr chunk
+    assert len(lines) == 4
+    assert lines[1] == hashlib.sha256(data[:1000]).hexdigest()
+
+    # stopped half way through writing a line
+    progress.add(data[3000:4000])
+    with open(progress.progress_file, 'a') as f:
+        f.write('abc')
+    with open(path, 'wb') as f:
+        f.write(data[:4000])
+
+    assert transfer.Transfer(path, chunk_size=1000).resume() == 4000
@@ -1,3 +1,6 @@
+import hashlib
+import json
+import datetime
 import pytest
 import re
 import tempfile
@@ -30,3 +33,202 @@ def test_decrypt_str():
 
 
 
+def test_encrypt_values():
+    utils.init('Secret_key')
+    values = [42, '42', 1, 12345678, 123456789012, 42]
+    assert utils.encrypt_values(values) == [utils.encrypt_value(v) for v in values]
+
+
+def test_encrypt_values_empty():
+    utils.init('Secret_key')
+    assert utils.encrypt_values([]) == []
+
+
+def test_init_clears_id_cache():
+    utils.init('Secret_key')
+    assert utils.encrypt_value(42) == 'bc729496af0697be'
+    utils.init('Another_key')
+    assert utils.encrypt_value(42) != 'bc729496af0697be'
+    utils.init('Secret_key')
+    assert utils.encrypt_value(42) == 'bc729496af0697be'
+
+
+def test_list_encrypt_ids():
+    utils.init('Secret_key')
+    entries = [{'id': 42, 'history_id': 42, 'nels_id': 42, 'name': 'test', 'job_id': '42'},
+               {'id': 1, 'user_id': 3}]
+    entries = utils.list_encrypt_ids(entries)
+    assert entries[0] == {'id': 'bc729496af0697be', 'history_id': 'bc729496af0697be', 'nels_id': 42,
+                          'name': 'test', 'job_id': '42'}
+    assert entries[1] == {'id': utils.encrypt_value(1), 'user_id': utils.encrypt_value(3)}
+
+
+def test_encrypt_ids_dict():
+    utils.init('Secret_key')
+    assert utils.encrypt_ids({'id': 42}) == {'id': 'bc729496af0697be'}
+
+
+def make_dataset(dir: str, *path: str) -> str:
+    full_path = os.path.join(dir, *path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    open(full_path, 'w').close()
+    return full_path
+
+
+def test_construct_file_path_hashed():
+    utils.init_dataset_index()
+    with tempfile.TemporaryDirectory() as dir:
+        path = make_dataset(dir, '001', 'dataset_1234.dat')
+        assert utils.construct_file_path(1234, dir) == path
+
+
+def test_construct_file_path_flat():
+    utils.init_dataset_index()
+    with tempfile.TemporaryDirectory() as dir:
+        path = make_dataset(dir, 'dataset_12.dat')
+        assert utils.construct_file_path(12, dir) == path
+
+
+def test_construct_file_path_scan():
+    utils.init_dataset_index()
+    with tempfile.TemporaryDirectory() as dir:
+        path = make_dataset(dir, 'extra', 'a', 'dataset_7.dat')
+        other = make_dataset(dir, 'extra', 'b', 'dataset_8.dat')
+        assert utils.construct_file_path(7, dir) == path
+
+        # found on the way, so now a lookup in the index
+        hits = utils.dataset_index_stats()['hits']
+        assert utils.construct_file_path(8, dir) == other
+        assert utils.dataset_index_stats()['hits'] == hits + 1
+
+
+def test_construct_file_path_scan_limit():
+    utils.init_dataset_index(scan_limit=2)
+    with tempfile.TemporaryDirectory() as dir:
+        for i in range(5):
+            make_dataset(dir, 'extra', f"dataset_{i}.dat")
+        path = make_dataset(dir, 'extra', 'deeper', 'dataset_99.dat')
+
+        # each attempt looks at a bit more of the tree until it gets there
+        for _ in range(10):
+            try:
+                assert utils.construct_file_path(99, dir) == path
+                break
+            except FileNotFoundError:
+                pass
+        else:
+            assert False, "dataset_99.dat never found"
+
+        # everything walked on the way was indexed
+        scanned = utils.dataset_index_stats()['scanned']
+        for i in range(5):
+            assert utils.construct_file_path(i, dir).endswith(f"dataset_{i}.dat")
+        assert utils.dataset_index_stats()['scanned'] == scanned
+
+
+def test_construct_file_path_missing():
+    utils.init_dataset_index()
+    with tempfile.TemporaryDirectory() as dir:
+        with pytest.raises(FileNotFoundError):
+            utils.construct_file_path(5, dir)
+
+
+def test_dataset_index_file():
+    with tempfile.TemporaryDirectory() as dir:
+        utils.init_dataset_index(os.path.join(dir, 'index'))
+        path = make_dataset(dir, 'files', 'extra', 'dataset_3.dat')
+        assert utils.construct_file_path(3, os.path.join(dir, 'files')) == path
+
+        # survives a restart
+        utils.init_dataset_index(os.path.join(dir, 'index'))
+        hits = utils.dataset_index_stats()['hits']
+        assert utils.construct_file_path(3, os.path.join(dir, 'files')) == path
+        assert utils.dataset_index_stats()['hits'] == hits + 1
+
+        # stale entries are not used
+        os.remove(path)
+        with pytest.raises(FileNotFoundError):
+            utils.construct_file_path(3, os.path.join(dir, 'files'))
+
+    utils.init_dataset_index()
+
+
+def test_time_arg():
+    assert utils.time_arg('2021-03-01T12:00:00') == datetime.datetime(2021, 3, 1, 12)
+
+    two_days_ago = utils.time_arg('2d')
+    ago = datetime.datetime.now() - two_days_ago
+    assert datetime.timedelta(days=2) <= ago < datetime.timedelta(days=2, minutes=1)
+
+    with pytest.raises(ValueError):
+        utils.time_arg('yesterday')
+
+
+def test_timedelta_to_sec():
+    assert utils.timedelta_to_sec('5m') == 300
+    assert utils.timedelta_to_sec('2h') == 7200
+    assert utils.timedelta_to_sec('1M') == 30 * 24 * 3600
+    assert utils.timedelta_to_sec('1Y') == 365 * 24 * 3600
+    assert utils.timedelta_to_sec('') == 0
+
+    a_year_ago = utils.time_arg('1Y')
+    assert abs(datetime.datetime.now() - datetime.timedelta(days=365) - a_year_ago) < datetime.timedelta(minutes=1)
+
+    for value in ['1y', '2 d', '3dd', 'd']:
+        with pytest.raises(ValueError):
+            utils.timedelta_to_sec(value)
+
+
+def test_file_sha256():
+    with tempfile.TemporaryDirectory() as file_dir:
+        path = os.path.join(file_dir, 'export.tgz')
+        with open(path, 'wb') as f:
+            f.write(b'abc')
+
+        checksum = {'sha256': 'ba7816bf8f01cfea414140de5dae2223b00361a396177a9cb410ff61f20015ad', 'size': 3}
+        assert utils.file_sha256(path) == checksum
+        assert utils.file_sha256(path) == checksum
+
+        # kept next to the file, for the next process
+        with open(f"{path}.sha256") as f:
+            assert json.load(f)['sha256'] == checksum['sha256']
+        utils._file_sha256.cache_clear()
+        with open(f"{path}.sha256", 'w') as f:
+            stat = os.stat(path)
+            json.dump({'sha256': 'saved', 'size': 3, 'mtime_ns': stat.st_mtime_ns}, f)
+        assert utils.file_sha256(path)['sha256'] == 'saved'
+
+        # a changed file is read again
+        with open(path, 'wb') as f:
+            f.write(b'abcd')
+        assert utils.file_sha256(path)['size'] == 4
+        assert utils.file_sha256(path)['sha256'] == hashlib.sha256(b'abcd').hexdigest()
+
+
+def test_nels_ssh_credential(monkeypatch):
+    calls = []
+
+    class Response(object):
+        status_code = 200
+
+        def json(self):
+            return {'hostname': 'nels', 'username': 'u1', 'key-rsa': f"key{len(calls)}"}
+
+    def get(url, auth, timeout):
+        calls.append(url)
+        return Response()
+
+    monkeypatch.setattr(utils.requests, 'get', get)
+    utils.ssh_credentials.configure(ttl=300)
+
+    for _ in range(5):
+        credential = utils.nels_ssh_credential('https://storage/', 'key', 'secret', 42)
+    assert credential['key-rsa'] == 'key1'
+    assert calls == ['https://storage/users/42']
+
+    # a key turned down is asked for again
+    assert utils.nels_ssh_credential('https://storage', 'key', 'secret', 42, refresh=True)['key-rsa'] == 'key2'
+    assert utils.nels_ssh_credential('https://storage', 'key', 'secret', '42')['key-rsa'] == 'key2'
+
+    stats = utils.ssh_credentials.stats()
+    assert (stats['hits'], stats['misses']) == (5, 2)
@@ -0,0 +1,83 @@
+import threading
+import time
+
+import nels_galaxy_api.workers as workers
+
+
+def test_submit():
+    pool = workers.WorkerPool(2)
+    done = threading.Event()
+    assert pool.submit([], done.set)
+    assert done.wait(5)
+    pool.shutdown()
+
+
+def test_limit():
+    pool = workers.WorkerPool(4, {'stage:fetch': 1})
+    lock = threading.Lock()
+    running = []
+    most = []
+
+    def job():
+        with lock:
+            running.append(1)
+            most.append(len(running))
+        time.sleep(0.05)
+        with lock:
+            running.pop()
+
+    started = [pool.submit(['stage:fetch'], job) for _ in range(3)]
+    assert started == [True, False, False]
+
+    pool.shutdown(wait=False)
+    time.sleep(0.3)
+    # the waiting ones are dropped on shutdown
+    assert max(most) == 1
+
+
+def test_limit_releases():
+    pool = workers.WorkerPool(4, {'instance:a': 1})
+    done = []
+    finished = threading.Event()
+
+    def job(n):
+        time.sleep(0.02)
+        done.append(n)
+        if len(done) == 3:
+            finished.set()
+
+    for n in range(3):
+        pool.submit(['instance:a'], job, n)
+
+    assert finished.wait(5)
+    # one at a time, in the order submitted
+    assert done == [0, 1, 2]
+    pool.shutdown()
+
+
+def test_other_keys_not_held_up():
+    pool = workers.WorkerPool(2, {'instance:a': 1})
+    release = threading.Event()
+    other = threading.Event()
+
+    pool.submit(['instance:a'], release.wait, 5)
+    assert not pool.submit(['instance:a'], lambda: None)
+    assert pool.submit(['instance:b'], other.set)
+    assert other.wait(5)
+    assert pool.stats()['waiting'] == 1
+
+    release.set()
+    pool.shutdown()
+
+
+def test_failing_job():
+    pool = workers.WorkerPool(1, {'stage:push': 1})
+    done = threading.Event()
+
+    def fail():
+        raise RuntimeError("failed")
+
+    pool.submit(['stage:push'], fail)
+    pool.submit(['stage:push'], done.set)
+    assert done.wait(5)
+    pool.shutdown()